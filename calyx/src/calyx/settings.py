@@ -8,6 +8,8 @@ import datetime
 import os
 
 import dotenv
+from corsheaders.defaults import default_headers
+from django.core.exceptions import ImproperlyConfigured
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
@@ -88,14 +90,93 @@ DATABASES = {
     }
 }
 
-# TODO: 本番環境ではRedisかMemcachedにした方が良い
+# キャッシュのバックエンド．'locmem'はワーカーごと，'file'は同じホストのワーカー間でキャッシュを共有する．
+# 外部のキャッシュサーバのクライアント（python-memcached，django-redis）は依存関係に含めないため指定できない
+CACHE_BACKEND = os.getenv('CALYX_CACHE_BACKEND', 'locmem').lower()
+
+CACHE_BACKEND_CLASSES = {
+    'locmem': 'django.core.cache.backends.locmem.LocMemCache',
+    'file': 'django.core.cache.backends.filebased.FileBasedCache',
+}
+
+CACHE_DEFAULT_LOCATIONS = {
+    'locmem': 'unique-snowflake',
+    'file': '/tmp/calyx-cache',
+}
+
+if CACHE_BACKEND not in CACHE_BACKEND_CLASSES:
+    raise ImproperlyConfigured(
+        f"CALYX_CACHE_BACKEND must be one of {', '.join(CACHE_BACKEND_CLASSES)}, got '{CACHE_BACKEND}'."
+    )
+
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
-        'LOCATION': 'unique-snowflake',
+        'BACKEND': CACHE_BACKEND_CLASSES[CACHE_BACKEND],
+        'LOCATION': os.getenv('CALYX_CACHE_LOCATION', CACHE_DEFAULT_LOCATIONS[CACHE_BACKEND]),
     }
 }
 
+# キャッシュした値のバージョンをDBに記録し，他のワーカーによる更新を検出する．
+# ワーカー間でキャッシュを共有しない'locmem'の場合はデフォルトで有効
+CACHE_VERSION_CHECK = os.getenv('CALYX_CACHE_VERSION_CHECK', str(CACHE_BACKEND == 'locmem')).lower() == 'true'
+# DBから読み込んだバージョンをワーカー内で使い回す時間（秒）
+CACHE_VERSION_TTL = float(os.getenv('CALYX_CACHE_VERSION_TTL', '1'))
+
+# 課程の設定やサマリーのキャッシュの有効期限（秒）．ソフトTTLを過ぎた値は1つのリクエストのみが再計算し，
+# その間は他のリクエストに古い値を返す．ハードTTLを過ぎるとキャッシュから削除される
+CACHE_SOFT_TTL = int(os.getenv('CALYX_CACHE_SOFT_TTL', '300'))
+CACHE_HARD_TTL = int(os.getenv('CALYX_CACHE_HARD_TTL', '3600'))
+# 再計算の時刻を揃えないためにソフトTTLを短くする最大の割合
+CACHE_REFRESH_JITTER = float(os.getenv('CALYX_CACHE_REFRESH_JITTER', '0.1'))
+# 再計算中のロックの有効期限（秒）
+CACHE_LOCK_TIMEOUT = int(os.getenv('CALYX_CACHE_LOCK_TIMEOUT', '10'))
+
+# 希望調査のサマリーを再集計する間隔（秒）．0の場合は書き込みの度に再集計する
+SUMMARY_DEBOUNCE_SECONDS = int(os.getenv('CALYX_SUMMARY_DEBOUNCE_SECONDS', '0'))
+
+# サマリーをServer-Sent Eventsで配信する際に接続を保持する最大の時間（秒）．uwsgiのharakiriより短くすること．
+# 0の場合は変更があれば1度だけ送って切断し，クライアントはSUMMARY_STREAM_RETRY_MSの間隔で再接続する．
+# 接続の間はワーカーを占有するため，0より大きくするのはgeventなどの非同期のワーカーで動かす場合のみとする
+SUMMARY_STREAM_MAX_SECONDS = int(os.getenv('CALYX_SUMMARY_STREAM_MAX_SECONDS', '0'))
+# 接続を保持している間に課程のバージョンの変更を確認する間隔（秒）
+SUMMARY_STREAM_INTERVAL = float(os.getenv('CALYX_SUMMARY_STREAM_INTERVAL', '2'))
+SUMMARY_STREAM_RETRY_MS = int(os.getenv('CALYX_SUMMARY_STREAM_RETRY_MS', '5000'))
+
+# サマリーの履歴で全ての値を保存するキーフレームの間隔（スナップショットの数）
+SUMMARY_HISTORY_KEYFRAME_INTERVAL = int(os.getenv('CALYX_SUMMARY_HISTORY_KEYFRAME_INTERVAL', '60'))
+
+# 志望順位の提出時にX-Rank-Set-Versionヘッダを必須とするかどうか
+RANK_SET_VERSION_REQUIRED = os.getenv('CALYX_RANK_SET_VERSION_REQUIRED', 'False').lower() == 'true'
+
+# Idempotency-Keyで再送を検出する期間（秒），ユーザごとに保存するキーの数，保存するレスポンスの最大の大きさ（バイト）
+IDEMPOTENCY_TTL = int(os.getenv('CALYX_IDEMPOTENCY_TTL', '3600'))
+IDEMPOTENCY_MAX_KEYS_PER_USER = int(os.getenv('CALYX_IDEMPOTENCY_MAX_KEYS_PER_USER', '50'))
+IDEMPOTENCY_MAX_RESPONSE_BYTES = int(os.getenv('CALYX_IDEMPOTENCY_MAX_RESPONSE_BYTES', '65536'))
+# 処理中のキーを再送されたリクエストが引き継ぐまでの時間（秒）．uwsgiのharakiriより長くする
+IDEMPOTENCY_LEASE = int(os.getenv('CALYX_IDEMPOTENCY_LEASE', '30'))
+
+# CSVから志望順位を登録する際にまとめて書き込む行の数
+IMPORT_CHUNK_SIZE = int(os.getenv('CALYX_IMPORT_CHUNK_SIZE', '1000'))
+
+# 志望順位の変更履歴をまとめて追記する件数，提出ごとの変更をキューにためておく最大の時間（秒），1回に返す最大の件数
+RANK_CHANGE_BUFFER_SIZE = int(os.getenv('CALYX_RANK_CHANGE_BUFFER_SIZE', '500'))
+RANK_CHANGE_FLUSH_SECONDS = float(os.getenv('CALYX_RANK_CHANGE_FLUSH_SECONDS', '5'))
+RANK_CHANGE_PAGE_SIZE = int(os.getenv('CALYX_RANK_CHANGE_PAGE_SIZE', '100'))
+
+# 配属確率の推定の試行回数，並列に実行するプロセスの数（0の場合は同じプロセスで実行する）
+PROBABILITY_TRIALS = int(os.getenv('CALYX_PROBABILITY_TRIALS', '200'))
+PROBABILITY_WORKERS = int(os.getenv('CALYX_PROBABILITY_WORKERS', '2'))
+
+# 志望順位の組の助言の最大の試行回数，1回の助言で試行ごとに抽出するユーザの延べ人数の上限
+ADVISE_TRIALS = int(os.getenv('CALYX_ADVISE_TRIALS', '100'))
+ADVISE_WORK_LIMIT = int(os.getenv('CALYX_ADVISE_WORK_LIMIT', '5000'))
+
+# 研究室の詳細で志望順位ごとに返す志望者の最大の人数
+APPLICANT_PAGE_SIZE = int(os.getenv('CALYX_APPLICANT_PAGE_SIZE', '100'))
+
+# サマリーの統計量の計算方法．'auto'はNumPyがインストールされていれば使用する．'python'または'numpy'で固定できる
+SUMMARY_BACKEND = os.getenv('CALYX_SUMMARY_BACKEND', 'auto')
+
 DEFAULT_FROM_EMAIL = os.getenv('CALYX_EMAIL_DEFAULT_FROM', 'example@example.com')
 EMAIL_ENABLED = os.getenv('CALYX_EMAIL_ENABLED', 'False').lower() == 'true'
 
@@ -181,6 +262,10 @@ CORS_ORIGIN_WHITELIST = [
     origin.strip() for origin in os.getenv("CALYX_CORS_ORIGIN_WHITELIST", "*").split(",")
 ]
 
+# 志望順位のバージョンとIdempotency-Keyをブラウザから送受信できるようにする
+CORS_ALLOW_HEADERS = list(default_headers) + ['x-rank-set-version', 'idempotency-key']
+CORS_EXPOSE_HEADERS = ['X-Rank-Set-Version', 'Idempotent-Replayed']
+
 LANGUAGE_CODE = 'ja-jp'
 
 TIME_ZONE = 'Asia/Tokyo'
@@ -27,3 +27,14 @@ class NotAdminError(Exception):
 
     def __str__(self):
         return f'{self.user.username}は{self.course.name}の管理者ではありません．'
+
+
+class RankVersionConflictError(Exception):
+
+    def __init__(self, course, version):
+        super(RankVersionConflictError, self).__init__()
+        self.course = course
+        self.version = version
+
+    def __str__(self):
+        return f'{self.course.name}の志望順位は他の提出によって更新されています．最新の志望順位を取得してから再度提出してください．'
@@ -0,0 +1,53 @@
+import time
+from random import Random
+
+from django.core.management import BaseCommand
+
+from courses.services.assignment import MECHANISMS, AssignmentInput, simulate_assignment
+from courses.services.welfare import rank_profile
+
+
+class Command(BaseCommand):
+    help = '生成した志望順位で配属の各方式の実行時間と，志望順位ごとの配属人数を比較する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=5000, help='ユーザの人数')
+        parser.add_argument('--labs', type=int, default=200, help='研究室の数')
+        parser.add_argument('--rank-limit', type=int, default=5, help='志望の数')
+        parser.add_argument('--slack', type=float, default=1.0, help='許容人数の合計のユーザの人数に対する比')
+        parser.add_argument('--repeat', type=int, default=3, help='各方式の実行回数．最短の時間を表示する')
+        parser.add_argument('--seed', type=int, default=0, help='乱数のシード')
+
+    def generate(self, options) -> 'AssignmentInput':
+        """研究室の人気に偏りのある志望順位を生成する"""
+        random = Random(options['seed'])
+        n_users, n_labs = options['users'], options['labs']
+        rank_limit = min(options['rank_limit'], n_labs)
+        popularity = [random.paretovariate(1.2) for _ in range(n_labs)]
+        prefs = []
+        for _ in range(n_users):
+            row = []
+            while len(row) < rank_limit:
+                lab = random.choices(range(n_labs), popularity)[0]
+                if lab not in row:
+                    row.append(lab)
+            prefs.append(row)
+        gpa = [round(random.uniform(1.0, 4.3), 2) for _ in range(n_users)]
+        capacity = [int(n_users * options['slack']) // n_labs] * n_labs
+        return AssignmentInput(list(range(n_users)), list(range(n_labs)), prefs, gpa, capacity)
+
+    def handle(self, *args, **options):
+        data = self.generate(options)
+        self.stdout.write(f'{len(data.user_pks)}人，{len(data.lab_pks)}研究室，許容人数{data.capacity[0]}人')
+        lab_index = {lab_pk: i for i, lab_pk in enumerate(data.lab_pks)}
+        for mechanism in MECHANISMS:
+            elapsed = []
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                result = simulate_assignment(data, mechanism)
+                elapsed.append(time.perf_counter() - started)
+            assigned = [lab_index[lab_pk] if lab_pk is not None else -1 for lab_pk in result['users'].values()]
+            profile = rank_profile(data.prefs, assigned)
+            self.stdout.write(
+                f'{mechanism}: {min(elapsed) * 1000:.1f}ms, 志望順位ごとの人数 {profile[:-1]}, 未配属 {profile[-1]}人'
+            )
@@ -0,0 +1,20 @@
+from django.core.management import BaseCommand
+
+from courses.models import Course
+from courses.services import estimate_probabilities
+
+
+class Command(BaseCommand):
+    help = '研究室ごとの配属確率を推定してDBに保存する．締め切り前にcronなどで定期的に実行する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_pks', nargs='*', type=int, help='対象の課程のpk．省略した場合は全ての課程')
+        parser.add_argument('--trials', type=int, default=None, help='試行回数．省略した場合はPROBABILITY_TRIALS')
+
+    def handle(self, *args, **options):
+        courses = Course.objects.all()
+        if options['course_pks']:
+            courses = courses.filter(pk__in=options['course_pks'])
+        for course in courses.iterator():
+            table = estimate_probabilities(course, trials=options['trials'])
+            self.stdout.write(f'{course}: {len(table["users"])}人の配属確率を{table["trials"]}回の試行から推定しました．')
@@ -0,0 +1,26 @@
+from django.core.management import BaseCommand, CommandError
+
+from courses.models import Course
+from courses.services import import_ranks
+
+
+class Command(BaseCommand):
+    help = '「ユーザ名,志望順位,研究室名」のCSVから志望順位を一括で登録する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_pk', type=int, help='対象の課程のpk')
+        parser.add_argument('csv_path', type=str, help='CSVファイルのパス（UTF-8）')
+        parser.add_argument('--dry-run', action='store_true', help='検証のみを行い，何も登録しない')
+
+    def handle(self, *args, **options):
+        try:
+            course = Course.objects.get(pk=options['course_pk'])
+        except Course.DoesNotExist:
+            raise CommandError(f'課程（pk={options["course_pk"]}）は存在しません．')
+        with open(options['csv_path'], encoding='utf-8-sig', newline='') as lines:
+            result = import_ranks(course, lines, dry_run=options['dry_run'])
+        for error in result.errors:
+            self.stderr.write(f'{error["line"]}行目: {error["message"]}')
+        if result.errors:
+            raise CommandError('CSVに誤りがあるため，志望順位を登録しませんでした．')
+        self.stdout.write(f'{course}: {result.users}人の{result.imported}件の志望順位を登録しました．')
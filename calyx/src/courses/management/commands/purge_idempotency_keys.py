@@ -0,0 +1,11 @@
+from django.core.management import BaseCommand
+
+from courses.services.idempotency import purge_expired_keys
+
+
+class Command(BaseCommand):
+    help = '有効期限（IDEMPOTENCY_TTL）を過ぎたIdempotency-Keyを削除する．cronなどで定期的に実行する'
+
+    def handle(self, *args, **options):
+        count = purge_expired_keys()
+        self.stdout.write(f'{count}件のキーを削除しました．')
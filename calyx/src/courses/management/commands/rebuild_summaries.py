@@ -0,0 +1,19 @@
+from django.core.management import BaseCommand
+
+from courses.models import Course
+from courses.services import update_summary_cache
+
+
+class Command(BaseCommand):
+    help = '志望順位から希望調査のサマリー（LabSummary）を作り直す'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_pks', nargs='*', type=int, help='対象の課程のpk．省略した場合は全ての課程')
+
+    def handle(self, *args, **options):
+        courses = Course.objects.all()
+        if options['course_pks']:
+            courses = courses.filter(pk__in=options['course_pks'])
+        for course in courses.iterator():
+            summary = update_summary_cache(course)
+            self.stdout.write(f'{course}: {len(summary)}件の研究室のサマリーを作成しました．')
@@ -0,0 +1,19 @@
+from django.core.management import BaseCommand
+
+from courses.models import Course
+from courses.services import take_snapshot
+
+
+class Command(BaseCommand):
+    help = '希望調査のサマリーを履歴（LabSummarySnapshot）に追加する．cronなどで定期的に実行する'
+
+    def add_arguments(self, parser):
+        parser.add_argument('course_pks', nargs='*', type=int, help='対象の課程のpk．省略した場合は全ての課程')
+
+    def handle(self, *args, **options):
+        courses = Course.objects.all()
+        if options['course_pks']:
+            courses = courses.filter(pk__in=options['course_pks'])
+        for course in courses.iterator():
+            count = take_snapshot(course)
+            self.stdout.write(f'{course}: {count}件の研究室のサマリーを保存しました．')
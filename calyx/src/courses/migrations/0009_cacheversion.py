@@ -0,0 +1,26 @@
+# Generated by Django 2.2 on 2026-10-18 16:46
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0008_auto_20190112_0041'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CacheVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, unique=True, verbose_name='キャッシュのキー')),
+                ('version', models.PositiveIntegerField(default=0, verbose_name='バージョン')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+            ],
+            options={
+                'verbose_name': 'キャッシュのバージョン',
+                'verbose_name_plural': 'キャッシュのバージョン',
+            },
+        ),
+    ]
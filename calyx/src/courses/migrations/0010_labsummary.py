@@ -0,0 +1,35 @@
+# Generated by Django 2.2 on 2026-10-18 16:47
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0009_cacheversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('order', models.IntegerField(blank=True, null=True, verbose_name='志望順位')),
+                ('count', models.IntegerField(default=0, verbose_name='志望人数')),
+                ('border', models.FloatField(blank=True, null=True, verbose_name='ボーダー')),
+                ('mean', models.FloatField(blank=True, null=True, verbose_name='平均値')),
+                ('median', models.FloatField(blank=True, null=True, verbose_name='中央値')),
+                ('max', models.FloatField(blank=True, null=True, verbose_name='最大値')),
+                ('min', models.FloatField(blank=True, null=True, verbose_name='最小値')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('course', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lab_summaries', to='courses.Course', verbose_name='課程')),
+                ('lab', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='summaries', to='courses.Lab', verbose_name='研究室')),
+            ],
+            options={
+                'verbose_name': 'サマリー',
+                'verbose_name_plural': 'サマリー',
+                'unique_together': {('lab', 'order')},
+            },
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 2.2 on 2026-10-18 16:56
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0010_labsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LabSummarySnapshot',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('taken_at', models.DateTimeField(verbose_name='取得日時')),
+                ('is_keyframe', models.BooleanField(default=False, verbose_name='キーフレーム')),
+                ('delta', models.TextField(verbose_name='差分')),
+                ('lab', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='snapshots', to='courses.Lab', verbose_name='研究室')),
+            ],
+            options={
+                'verbose_name': 'サマリーの履歴',
+                'verbose_name_plural': 'サマリーの履歴',
+                'index_together': {('lab', 'taken_at')},
+            },
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 2.2 on 2026-10-18 17:09
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('courses', '0011_labsummarysnapshot'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankSetVersion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(default=0, verbose_name='バージョン')),
+                ('updated_at', models.DateTimeField(auto_now=True, verbose_name='更新日時')),
+                ('course', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='courses.Course', verbose_name='課程')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='ユーザ')),
+            ],
+            options={
+                'verbose_name': '志望順位のバージョン',
+                'verbose_name_plural': '志望順位のバージョン',
+                'unique_together': {('user', 'course')},
+            },
+        ),
+    ]
@@ -0,0 +1,33 @@
+# Generated by Django 2.2 on 2026-10-18 17:10
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('courses', '0012_ranksetversion'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IdempotencyKey',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=255, verbose_name='キー')),
+                ('fingerprint', models.CharField(max_length=64, verbose_name='リクエストのハッシュ')),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='ステータスコード')),
+                ('response', models.TextField(blank=True, default='', verbose_name='レスポンス')),
+                ('created_at', models.DateTimeField(auto_now_add=True, db_index=True, verbose_name='作成日時')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL, verbose_name='ユーザ')),
+            ],
+            options={
+                'verbose_name': '冪等キー',
+                'verbose_name_plural': '冪等キー',
+                'unique_together': {('user', 'key')},
+            },
+        ),
+    ]
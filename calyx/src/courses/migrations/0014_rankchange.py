@@ -0,0 +1,34 @@
+# Generated by Django 2.2 on 2026-10-18 17:19
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('courses', '0013_idempotencykey'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RankChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.PositiveSmallIntegerField(choices=[(0, '提出'), (1, 'CSVからの登録'), (2, '研究室の削除')], default=0, verbose_name='変更の種類')),
+                ('labs', models.TextField(verbose_name='変更後の志望順位')),
+                ('changed_at', models.DateTimeField(default=django.utils.timezone.now, verbose_name='変更日時')),
+                ('actor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='変更したユーザ')),
+                ('course', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='rank_changes', to='courses.Course', verbose_name='課程')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='ユーザ')),
+            ],
+            options={
+                'verbose_name': '志望順位の変更履歴',
+                'verbose_name_plural': '志望順位の変更履歴',
+                'index_together': {('course', 'user')},
+            },
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 2.2 on 2026-10-18 17:21
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0014_rankchange'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FrozenCourse',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('frozen_at', models.DateTimeField(auto_now_add=True, verbose_name='凍結日時')),
+                ('course', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='frozen', to='courses.Course', verbose_name='課程')),
+            ],
+            options={
+                'verbose_name': '凍結した課程',
+                'verbose_name_plural': '凍結した課程',
+            },
+        ),
+        migrations.CreateModel(
+            name='FrozenPayload',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, verbose_name='キー')),
+                ('payload', models.TextField(verbose_name='内容')),
+                ('frozen_course', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='payloads', to='courses.FrozenCourse', verbose_name='凍結した課程')),
+            ],
+            options={
+                'verbose_name': '凍結したレスポンス',
+                'verbose_name_plural': '凍結したレスポンス',
+                'unique_together': {('frozen_course', 'key')},
+            },
+        ),
+    ]
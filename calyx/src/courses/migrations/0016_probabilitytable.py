@@ -0,0 +1,29 @@
+# Generated by Django 2.2 on 2026-10-18 18:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('courses', '0015_frozencourse'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProbabilityTable',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('version', models.PositiveIntegerField(verbose_name='課程のバージョン')),
+                ('trials', models.PositiveIntegerField(verbose_name='試行回数')),
+                ('payload', models.TextField(verbose_name='内容')),
+                ('estimated_at', models.DateTimeField(auto_now=True, verbose_name='推定日時')),
+                ('course', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='probability_table', to='courses.Course', verbose_name='課程')),
+            ],
+            options={
+                'verbose_name': '配属確率',
+                'verbose_name_plural': '配属確率',
+            },
+        ),
+    ]
@@ -8,7 +8,7 @@ from django.contrib.auth.models import Group
 from django.db import models, transaction, IntegrityError
 from django.utils import timezone
 
-from .errors import AlreadyJoinedError, NotJoinedError, NotAdminError
+from .errors import AlreadyJoinedError, NotJoinedError, NotAdminError, RankVersionConflictError
 
 if TYPE_CHECKING:
     from typing import Optional
@@ -196,6 +196,16 @@ class Config(models.Model):
         return f'{self.course.name}の表示設定'
 
 
+class LabQuerySet(models.QuerySet):
+    """研究室のクエリセット"""
+
+    def delete(self):
+        """研究室をまとめて削除する．志望順位の繰り上げは全ての研究室について1度に行う"""
+        with transaction.atomic():
+            Rank.objects.move_up_ranks(list(self.values_list('pk', flat=True)))
+            return super(LabQuerySet, self).delete()
+
+
 class Lab(models.Model):
     """研究室のモデル"""
 
@@ -203,6 +213,8 @@ class Lab(models.Model):
     capacity = models.IntegerField("許容人数", default=0)
     course = models.ForeignKey(Course, on_delete=models.CASCADE, related_name='labs')
 
+    objects = LabQuerySet.as_manager()
+
     class Meta:
         verbose_name = "研究室"
         verbose_name_plural = "研究室"
@@ -212,6 +224,12 @@ class Lab(models.Model):
     def __str__(self):
         return f'{self.course} - {self.name}'
 
+    def delete(self, using=None, keep_parents=False):
+        """研究室を削除し，この研究室より下の志望順位を自動で繰り上げる"""
+        with transaction.atomic():
+            Rank.objects.move_up_ranks([self.pk])
+            return super(Lab, self).delete(using=using, keep_parents=keep_parents)
+
 
 class RankManager(models.Manager):
     """研究室志望順位を操作するマネージャー"""
@@ -222,6 +240,64 @@ class RankManager(models.Manager):
             raise IntegrityError
         return super(RankManager, self).create(lab=lab, course=course, user=user, order=order)
 
+    def move_up_ranks(self, lab_pks) -> int:
+        """
+        削除する研究室より下の志望順位を繰り上げ，空いた最後の志望をNULLにする．
+        研究室を志望していたユーザの志望順位を1回で読み込み，変わった行を1回のUPDATEで書き込む
+        :param lab_pks: 削除する研究室のpk
+        :return: 更新した志望順位の数
+        """
+        lab_pks = set(lab_pks)
+        if not lab_pks:
+            return 0
+        with transaction.atomic():
+            deleted = self.filter(lab_id__in=lab_pks, user_id=models.OuterRef('user_id'),
+                                  course_id=models.OuterRef('course_id'))
+            ranks = self.select_for_update().annotate(affected=models.Exists(deleted)).filter(affected=True) \
+                .only('pk', 'user_id', 'course_id', 'order', 'lab_id').order_by('course_id', 'user_id', 'order')
+            ranks_per_user = dict()
+            for rank in ranks:
+                ranks_per_user.setdefault((rank.course_id, rank.user_id), []).append(rank)
+            to_update = []
+            changes = []
+            for (course_pk, user_pk), user_ranks in ranks_per_user.items():
+                # 削除する研究室を除いて詰め，余った志望はNULLにする
+                remaining = [rank.lab_id for rank in user_ranks if rank.lab_id not in lab_pks]
+                remaining += [None] * (len(user_ranks) - len(remaining))
+                for rank, lab_pk in zip(user_ranks, remaining):
+                    if rank.lab_id != lab_pk:
+                        rank.lab_id = lab_pk
+                        to_update.append(rank)
+                changes.append(RankChange(course_id=course_pk, user_id=user_pk, source=RankChange.SOURCE_LAB_DELETED,
+                                          labs=RankChange.encode_labs(remaining)))
+            if to_update:
+                self.bulk_update(to_update, ['lab'])
+            RankChange.objects.bulk_create(changes)
+        return len(to_update)
+
+    def replace_ranks(self, course, user, lab_pks) -> list:
+        """
+        ユーザの志望順位をまとめて差し替える．既存の行は1回のUPDATEで，足りない行は1回のINSERTで書き込む．
+        同じユーザの同時の提出はRankSetVersionで検出するため，行のロックは取らない
+        :param course: 課程
+        :param user: ユーザ
+        :param lab_pks: 志望順に並べた研究室のpk．課程に属することは呼び出し側で確認しておくこと
+        :return: 志望順に並べた志望順位
+        """
+        with transaction.atomic():
+            existing = dict(
+                self.filter(course=course, user=user, order__lt=len(lab_pks)).values_list('order', 'pk')
+            )
+            ranks = [
+                self.model(pk=existing.get(order, None), lab_id=lab_pk, course=course, user=user, order=order)
+                for order, lab_pk in enumerate(lab_pks)
+            ]
+            to_update = [rank for rank in ranks if rank.pk is not None]
+            if to_update:
+                self.bulk_update(to_update, ['lab'])
+            self.bulk_create([rank for rank in ranks if rank.pk is None])
+        return ranks
+
 
 class Rank(models.Model):
     """研究室志望順位のモデル"""
@@ -244,6 +320,285 @@ class Rank(models.Model):
         return f'{self.user}-{self.order}-{self.lab}'
 
 
+class RankSetVersionManager(models.Manager):
+    """志望順位の組のバージョンを操作するマネージャー"""
+
+    def get_version(self, course, user) -> int:
+        return self.filter(course=course, user=user).values_list('version', flat=True).first() or 0
+
+    def bump(self, course, user, expected: 'Optional[int]' = None) -> int:
+        """
+        バージョンが期待した値のままであれば1つ上げる．ロックを待って再試行することはせず，競合した場合は例外とする
+        :param course: 課程
+        :param user: ユーザ
+        :param expected: クライアントが取得したバージョン．Noneの場合は現在のバージョンとし，同時に行われた提出のみを競合とする
+        :return: 新しいバージョン
+        """
+        if expected is None:
+            expected = self.get_version(course, user)
+        updated = self.filter(course=course, user=user, version=expected) \
+            .update(version=models.F('version') + 1, updated_at=timezone.now())
+        if updated:
+            return expected + 1
+        if expected == 0:
+            try:
+                with transaction.atomic():
+                    self.create(course=course, user=user, version=1)
+                return 1
+            except IntegrityError:
+                # 最初の提出が同時に行われた
+                pass
+        raise RankVersionConflictError(course, self.get_version(course, user))
+
+
+class RankSetVersion(models.Model):
+    """
+    ユーザが課程に提出した志望順位の組のバージョン．提出する度にインクリメントし，同じユーザの提出の競合を検出する
+    """
+
+    user = models.ForeignKey(User, verbose_name='ユーザ', on_delete=models.CASCADE)
+    course = models.ForeignKey(Course, verbose_name='課程', on_delete=models.CASCADE)
+    version = models.PositiveIntegerField("バージョン", default=0)
+    updated_at = models.DateTimeField("更新日時", auto_now=True)
+
+    objects = RankSetVersionManager()
+
+    class Meta:
+        verbose_name = "志望順位のバージョン"
+        verbose_name_plural = "志望順位のバージョン"
+        unique_together = ["user", "course"]
+
+    def __str__(self):
+        return f'{self.user}-{self.course}（{self.version}）'
+
+
+class RankChangeQuerySet(models.QuerySet):
+    """
+    志望順位の変更履歴のクエリセット．追記のみを許し，更新・削除はTypeErrorとする．
+    課程やユーザの削除に伴うカスケード削除はこのクエリセットを経由しないため妨げない
+    """
+
+    def update(self, **kwargs):
+        raise TypeError('志望順位の変更履歴は追記のみを行います．')
+
+    def bulk_update(self, objs, fields, batch_size=None):
+        raise TypeError('志望順位の変更履歴は追記のみを行います．')
+
+    def delete(self):
+        raise TypeError('志望順位の変更履歴は追記のみを行います．')
+
+    delete.queryset_only = True
+
+
+class RankChange(models.Model):
+    """
+    志望順位の変更履歴．追記のみを行い，更新はしない．
+    変更ごとに1行とし，変更後の志望順位を研究室のpkのカンマ区切りで保存する．研究室が削除されても履歴は残す
+    """
+
+    SOURCE_SUBMIT = 0
+    SOURCE_IMPORT = 1
+    SOURCE_LAB_DELETED = 2
+    SOURCE_CHOICES = (
+        (SOURCE_SUBMIT, '提出'),
+        (SOURCE_IMPORT, 'CSVからの登録'),
+        (SOURCE_LAB_DELETED, '研究室の削除'),
+    )
+
+    course = models.ForeignKey(Course, verbose_name='課程', on_delete=models.CASCADE, related_name='rank_changes')
+    user = models.ForeignKey(User, verbose_name='ユーザ', on_delete=models.CASCADE, related_name='+')
+    # 変更を行ったユーザ．本人による提出以外では管理者
+    actor = models.ForeignKey(User, verbose_name='変更したユーザ', on_delete=models.SET_NULL,
+                              blank=True, null=True, related_name='+')
+    source = models.PositiveSmallIntegerField('変更の種類', choices=SOURCE_CHOICES, default=SOURCE_SUBMIT)
+    # 志望順に並べた研究室のpk．NULLの志望は空文字とする（例: '12,5,'）
+    labs = models.TextField('変更後の志望順位')
+    changed_at = models.DateTimeField('変更日時', default=timezone.now)
+
+    objects = RankChangeQuerySet.as_manager()
+
+    class Meta:
+        verbose_name = "志望順位の変更履歴"
+        verbose_name_plural = "志望順位の変更履歴"
+        # 課程とユーザで絞り込み，pkの降順に読み出す．課程のみの場合は外部キーのインデックスを使う
+        index_together = ["course", "user"]
+
+    def __str__(self):
+        return f'{self.user_id}-{self.course_id}（{self.changed_at}）'
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise TypeError('志望順位の変更履歴は追記のみを行います．')
+        super(RankChange, self).save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise TypeError('志望順位の変更履歴は追記のみを行います．')
+
+    @staticmethod
+    def encode_labs(lab_pks) -> str:
+        return ','.join('' if lab_pk is None else str(lab_pk) for lab_pk in lab_pks)
+
+    @property
+    def lab_pks(self) -> list:
+        """志望順に並べた研究室のpk"""
+        if not self.labs:
+            return []
+        return [int(lab_pk) if lab_pk else None for lab_pk in self.labs.split(',')]
+
+
+class LabSummary(models.Model):
+    """
+    研究室・志望順位ごとの希望調査のサマリー．志望順位の書き込みと同時に更新し，キャッシュが無い場合に読み出す．
+    GPAを表示しない課程ではGPAの統計量はNULLとなる．
+    """
+
+    course = models.ForeignKey(Course, verbose_name='課程', on_delete=models.CASCADE, related_name='lab_summaries')
+    lab = models.ForeignKey(Lab, verbose_name='研究室', on_delete=models.CASCADE, related_name='summaries')
+    # NULLの場合は志望順位に関係ない全体のサマリー
+    order = models.IntegerField("志望順位", blank=True, null=True)
+    count = models.IntegerField("志望人数", default=0)
+    border = models.FloatField("ボーダー", blank=True, null=True)
+    mean = models.FloatField("平均値", blank=True, null=True)
+    median = models.FloatField("中央値", blank=True, null=True)
+    max = models.FloatField("最大値", blank=True, null=True)
+    min = models.FloatField("最小値", blank=True, null=True)
+    updated_at = models.DateTimeField("更新日時", auto_now=True)
+
+    stat_fields = ('border', 'mean', 'median', 'max', 'min')
+
+    class Meta:
+        verbose_name = "サマリー"
+        verbose_name_plural = "サマリー"
+        unique_together = ["lab", "order"]
+
+    def __str__(self):
+        return f'{self.lab}-{self.order}'
+
+    def to_fragment(self) -> dict:
+        """get_summaryの'detail'，'abstract'の要素と同じ形式に変換する"""
+        fragment = {key: getattr(self, key) for key in self.stat_fields if getattr(self, key) is not None}
+        fragment['count'] = self.count
+        return fragment
+
+
+class LabSummarySnapshot(models.Model):
+    """
+    研究室ごとのサマリーの履歴．直前のスナップショットから変わった値のみを差分として保存し，
+    一定の数ごとに全ての値を持つキーフレームを保存する．サマリーが変わらなかった研究室は保存しない．
+    """
+
+    lab = models.ForeignKey(Lab, verbose_name='研究室', on_delete=models.CASCADE, related_name='snapshots')
+    taken_at = models.DateTimeField("取得日時")
+    is_keyframe = models.BooleanField("キーフレーム", default=False)
+    # 平坦化したサマリーの差分のJSON．値がnullのキーは削除されたことを表す
+    delta = models.TextField("差分")
+
+    class Meta:
+        verbose_name = "サマリーの履歴"
+        verbose_name_plural = "サマリーの履歴"
+        index_together = ["lab", "taken_at"]
+
+    def __str__(self):
+        return f'{self.lab}-{self.taken_at}'
+
+
+class IdempotencyKey(models.Model):
+    """
+    Idempotency-Keyヘッダを付けたリクエストのレスポンス．同じキーで再送されたリクエストにはこのレスポンスを返す．
+    status_codeがNULLの間は最初のリクエストを処理中であることを表す
+    """
+
+    user = models.ForeignKey(User, verbose_name='ユーザ', on_delete=models.CASCADE)
+    key = models.CharField("キー", max_length=255)
+    # メソッド，パス，ボディのハッシュ．同じキーが異なるリクエストに使われていないかを確認する
+    fingerprint = models.CharField("リクエストのハッシュ", max_length=64)
+    status_code = models.PositiveSmallIntegerField("ステータスコード", blank=True, null=True)
+    response = models.TextField("レスポンス", blank=True, default='')
+    created_at = models.DateTimeField("作成日時", auto_now_add=True, db_index=True)
+
+    class Meta:
+        verbose_name = "冪等キー"
+        verbose_name_plural = "冪等キー"
+        unique_together = ["user", "key"]
+
+    def __str__(self):
+        return f'{self.user}-{self.key}'
+
+
+class FrozenCourse(models.Model):
+    """
+    締め切り後に凍結した課程．凍結中は志望順位，研究室，設定を変更できず，
+    サマリーや研究室の詳細などの読み出しには凍結時に生成したFrozenPayloadを返す
+    """
+
+    course = models.OneToOneField(Course, verbose_name='課程', on_delete=models.CASCADE, related_name='frozen')
+    frozen_at = models.DateTimeField("凍結日時", auto_now_add=True)
+
+    class Meta:
+        verbose_name = "凍結した課程"
+        verbose_name_plural = "凍結した課程"
+
+    def __str__(self):
+        return f'{self.course}（{self.frozen_at}）'
+
+
+class FrozenPayload(models.Model):
+    """凍結時に生成したレスポンスのJSON．凍結を解除するまで変更しない"""
+
+    frozen_course = models.ForeignKey(FrozenCourse, verbose_name='凍結した課程', on_delete=models.CASCADE,
+                                      related_name='payloads')
+    key = models.CharField("キー", max_length=64)
+    payload = models.TextField("内容")
+
+    class Meta:
+        verbose_name = "凍結したレスポンス"
+        verbose_name_plural = "凍結したレスポンス"
+        unique_together = ["frozen_course", "key"]
+
+    def __str__(self):
+        return f'{self.frozen_course_id}-{self.key}'
+
+
+class ProbabilityTable(models.Model):
+    """
+    課程の最新の配属確率の推定結果．estimate_probabilitiesコマンドが推定した時点の課程のバージョンとともに保存し，
+    全てのワーカーがこの表を読み出す
+    """
+
+    course = models.OneToOneField(Course, verbose_name='課程', on_delete=models.CASCADE,
+                                  related_name='probability_table')
+    version = models.PositiveIntegerField("課程のバージョン")
+    trials = models.PositiveIntegerField("試行回数")
+    # {ユーザのpk: {研究室のpk: 確率}}のJSON
+    payload = models.TextField("内容")
+    estimated_at = models.DateTimeField("推定日時", auto_now=True)
+
+    class Meta:
+        verbose_name = "配属確率"
+        verbose_name_plural = "配属確率"
+
+    def __str__(self):
+        return f'{self.course}-{self.version}'
+
+
+class CacheVersion(models.Model):
+    """
+    キャッシュされた値のバージョン．値を更新する度にインクリメントし，
+    ワーカーごとのキャッシュが他のワーカーによって古くなっていないかを検出するために使用する
+    """
+
+    key = models.CharField("キャッシュのキー", max_length=255, unique=True)
+    version = models.PositiveIntegerField("バージョン", default=0)
+    updated_at = models.DateTimeField("更新日時", auto_now=True)
+
+    class Meta:
+        verbose_name = "キャッシュのバージョン"
+        verbose_name_plural = "キャッシュのバージョン"
+
+    def __str__(self):
+        return f'{self.key}（{self.version}）'
+
+
 # Signalsの記述を分離するために，動的にimportのみを行う．
 # importしない場合，Signalの登録が行われないため処理が実行されなくなってしまう．
 # `from . import signals`をするとOptimize importsで消されるので注意
@@ -8,13 +8,15 @@ from .course import (
     PINCodeUpdateSerializer,
     YearSerializer
 )
-from .lab import LabAbstractSerializer, LabListCreateSerializer, LabSerializer
+from .lab import LabAbstractSerializer, LabListCreateSerializer, LabSerializer, LabCapacitySerializer
 from .rank import (
     RankSerializer,
     RankListSerializer,
     RankPerLabSerializer,
     RankPerLabListSerializer,
-    RankSummaryPerLabSerializer
+    RankSummaryPerLabSerializer,
+    RankSummarySnapshotSerializer,
+    RankChangeSerializer
 )
 from .user import UserSerializer
 from .course_user import CourseStatusSerializer, CourseStatusDetailSerializer, JoinSerializer
@@ -1,9 +1,14 @@
+from typing import TYPE_CHECKING
+
 from django.contrib.auth import get_user_model
 from rest_framework import serializers
 
 from courses.models import Course, Lab
 from .rank import RankPerLabSerializer
 
+if TYPE_CHECKING:
+    from typing import Dict
+
 User = get_user_model()
 
 
@@ -56,6 +61,8 @@ class LabSerializer(LabAbstractSerializer):
     """
 
     rank_set = RankPerLabSerializer(many=True, read_only=True)
+    # 志望順位ごとの次のページのカーソル．次のページが無ければnull
+    rank_set_next = serializers.SerializerMethodField()
 
     parent_lookup_kwargs = {
         'course_pk': 'course_id'
@@ -63,9 +70,45 @@ class LabSerializer(LabAbstractSerializer):
 
     class Meta:
         model = Lab
-        fields = ("pk", "name", "capacity", "course", "rank_set")
+        fields = ("pk", "name", "capacity", "course", "rank_set", "rank_set_next")
+
+    def get_rank_set_next(self, obj) -> list:
+        # rank_setを表現する際に求めたカーソルを返す
+        return getattr(self.fields['rank_set'], 'next_cursors', [])
 
     def validate_capacity(self, obj):
         if obj < 0:
             raise serializers.ValidationError({"capacity": "許容人数は0人以上である必要があります．"})
         return obj
+
+
+class LabCapacityListSerializer(serializers.ListSerializer):
+    """
+    複数の研究室の許容人数をまとめて受け取るシリアライザ
+    """
+
+    def validate(self, data):
+        lab_pks = [d['lab'].pk for d in data]
+        if len(lab_pks) != len(set(lab_pks)):
+            raise serializers.ValidationError({'lab': '同じ研究室を複数回指定することはできません．'})
+        course = self.context.get('course')
+        if any(d['lab'].course_id != course.pk for d in data):
+            raise serializers.ValidationError({'lab': 'この課程に存在しない研究室が含まれています．'})
+        return data
+
+    def to_capacities(self) -> 'Dict[int, int]':
+        """研究室のpk -> 許容人数"""
+        return {d['lab'].pk: d['capacity'] for d in self.validated_data}
+
+
+class LabCapacitySerializer(serializers.Serializer):
+    """
+    研究室の許容人数のシリアライザ
+    """
+
+    lab = serializers.PrimaryKeyRelatedField(queryset=Lab.objects.all())
+    capacity = serializers.IntegerField(min_value=0)
+
+    class Meta:
+        fields = ("lab", "capacity")
+        list_serializer_class = LabCapacityListSerializer
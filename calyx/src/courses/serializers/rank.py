@@ -1,9 +1,8 @@
 from django.contrib.auth import get_user_model
-from django.db import transaction
 from rest_framework import serializers
 
-from courses.models import Course, Config, Lab, Rank
-from courses.services import get_config_cache
+from courses.models import Course, Config, Lab, Rank, RankChange
+from courses.services import get_config_cache, ApplicantQuery
 from .user import UserSerializer
 
 User = get_user_model()
@@ -18,32 +17,29 @@ class RankListSerializer(serializers.ListSerializer):
             raise serializers.ValidationError(
                 {'non_field_errors': f'希望順位の提出数は{config.rank_limit}個である必要があります．'}
             )
-        labs = [attr['lab'] for attr in attrs]
-        if len(labs) != len(list(set(labs))):
-            return serializers.ValidationError(
+        lab_pks = [attr['lab_id'] for attr in attrs]
+        if len(lab_pks) != len(set(lab_pks)):
+            raise serializers.ValidationError(
                 {'non_field_errors': '同じ研究室を複数指定することはできません．'}
             )
+        # 課程に属する研究室であることを1回のクエリで確認する
+        found = Lab.objects.filter(course_id=self.context['course'].pk, pk__in=lab_pks).count()
+        if found != len(lab_pks):
+            raise serializers.ValidationError(
+                {'non_field_errors': '指定された研究室は見つかりませんでした．'}
+            )
         return super(RankListSerializer, self).validate(attrs)
 
     def create(self, validated_data):
         user = self.context['request'].user  # type: User
         course = self.context['course']  # type: Course
-        rank_list = []
-        with transaction.atomic():
-            for i, data in enumerate(validated_data):
-                rank, _ = Rank.objects.update_or_create(
-                    user=user, course=course, order=i, defaults={'lab': data['lab']}
-                )
-                rank_list.append(rank)
-        return rank_list
+        return Rank.objects.replace_ranks(course, user, [data['lab_id'] for data in validated_data])
 
 
 class RankSerializer(serializers.ModelSerializer):
     """希望順位を作成するシリアライザ"""
-    lab = serializers.PrimaryKeyRelatedField(
-        queryset=Lab.objects.select_related('course').all(),
-        error_messages={'does_not_exist': "指定された研究室は見つかりませんでした．"},
-    )
+    # 研究室の存在はRankListSerializerでまとめて確認するため，ここではpkのみを受け取る
+    lab = serializers.IntegerField(source='lab_id')
 
     class Meta:
         model = Rank
@@ -57,17 +53,16 @@ class RankPerLabListSerializer(serializers.ListSerializer):
     def to_representation(self, data):
         """
         [[第1志望のユーザのリスト],[第2志望のユーザのリスト],...]
+        志望者は1回のクエリで読み込み，contextの'applicant_query'に従って並べ替え・ページ分割する．
+        次のページのカーソルはnext_cursorsに格納する
         :param data:
         :return:
         """
         course = self.context['course']
         config = get_config_cache(course.pk)
-        rank_per_order = list()
-        for order in range(config["rank_limit"]):
-            rank_per_order.append(
-                [self.child.to_representation(rank) for rank in data.filter(order=order).all()]
-            )
-        return rank_per_order
+        query = self.context.get('applicant_query', None) or ApplicantQuery()
+        rank_per_order, self.next_cursors = query.paginate(data.all(), config["rank_limit"])
+        return [[self.child.to_representation(rank) for rank in ranks] for ranks in rank_per_order]
 
 
 class RankPerLabSerializer(serializers.ModelSerializer):
@@ -92,6 +87,17 @@ class RankPerLabSerializer(serializers.ModelSerializer):
         return data['user']
 
 
+class RankChangeSerializer(serializers.ModelSerializer):
+    """志望順位の変更履歴のシリアライザ"""
+    labs = serializers.ListField(source='lab_pks', child=serializers.IntegerField(allow_null=True), read_only=True)
+    source = serializers.CharField(source='get_source_display', read_only=True)
+
+    class Meta:
+        model = RankChange
+        fields = ('pk', 'user', 'actor', 'source', 'labs', 'changed_at')
+        read_only_fields = fields
+
+
 # 以降，スキーマ生成のためのシリアライザ．実際には使用されない．
 class RankSummaryFragmentSerializer(serializers.Serializer):
     """
@@ -128,3 +134,18 @@ class RankSummaryPerLabSerializer(serializers.Serializer):
 
     def update(self, instance, validated_data):
         raise NotImplementedError
+
+
+class RankSummarySnapshotSerializer(serializers.Serializer):
+    """
+    研究室ごとのサマリーの履歴のシリアライザ
+    """
+
+    taken_at = serializers.DateTimeField(read_only=True)
+    summary = RankSummaryPerLabSerializer(read_only=True)
+
+    def create(self, validated_data):
+        raise NotImplementedError
+
+    def update(self, instance, validated_data):
+        raise NotImplementedError
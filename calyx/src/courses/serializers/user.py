@@ -40,7 +40,10 @@ class UserSerializer(serializers.ModelSerializer):
         represent = super(UserSerializer, self).to_representation(instance)
         course = self.context.get('course', None)
         if course:
-            config = get_config_cache(course.pk)
+            # 志望者の一覧では同じインスタンスが繰り返し使われるため，設定は1度のみ読み込む
+            if getattr(self, '_config', None) is None:
+                self._config = get_config_cache(course.pk)
+            config = self._config
             represent = self._rm_from_represent(represent, config, 'show_gpa', 'gpa')
             represent = self._rm_from_represent(represent, config, 'show_username', 'screen_name')
         return represent
@@ -1,3 +1,21 @@
 from .status import Status, StatusMessage
 from .config import get_config_cache, make_config_cache, set_config_from_instance
-from .summary import Summary, get_summary, update_summary_cache
+from .summary import Summary, get_summary, update_summary_cache, invalidate_summary, is_summary_stale
+from .store import (
+    SummaryStore, update_summary_for_user, update_summary_for_capacity, update_summary_for_capacities, load_user_labs
+)
+from .version import CourseVersion, get_course_version, bump_course_version
+from .snapshot import CourseSnapshot, get_course_snapshot, get_cached_snapshot
+from .stream import stream_summary
+from .history import take_snapshot, get_lab_history
+from .applicants import ApplicantQuery
+from .imports import ImportResult, import_ranks
+from .changelog import RankChangeBuffer, append_rank_change, flush_rank_changes, get_rank_changes
+from .freeze import freeze_course, unfreeze_course, get_frozen
+from .assignment import simulate_assignment, get_assignment
+from .probability import estimate_probabilities, get_probabilities
+from .matching import (
+    AssignmentState, update_assignment_for_user, update_assignment_for_capacity, update_assignment_for_capacities
+)
+from .advice import advise_ranks
+from .capacity import project_capacities, commit_capacities
@@ -0,0 +1,248 @@
+"""
+志望順位の組の助言．提出し直さずに，候補の研究室から作れる志望順位の組のうち，配属される確率の高いものを返す．
+GPAの高い順に配属する場合，あるユーザが各研究室に入れるかどうかは自分より優先されるユーザの配属だけで決まり，
+自分の志望順位には依らない．そのため，シミュレーションを1度まとめて行って試行ごとに入れる研究室を求めておけば，
+任意の組の確率は試行の集合の和を数えるだけで求まる．試行の集合は研究室ごとのビット列（int）で表し，
+組の探索では確率の上界で枝刈りする．DBへの書き込みやキャッシュの無効化は行わない．
+"""
+import heapq
+import random
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+
+from courses.models import Rank
+from . import caching
+from .assignment import AssignmentInput, load_assignment_input
+from .config import get_config_cache
+from .matching import AssignmentState, priority_key
+from .probability import TIE_BREAK_NOISE
+from .snapshot import get_course_snapshot
+from .version import get_course_version
+
+if TYPE_CHECKING:
+    from typing import List, Optional, Sequence, Tuple
+    from courses.models import Course
+
+
+def get_trials() -> int:
+    return getattr(settings, 'ADVISE_TRIALS', 100)
+
+
+def get_work_limit() -> int:
+    return getattr(settings, 'ADVISE_WORK_LIMIT', 5000)
+
+
+def load_snapshot(course: 'Course') -> dict:
+    """
+    助言に使う課程のデータを読み込む
+    :return: {'input': AssignmentInput, 'gpa_pool': 観測されたGPA, 'members': 参加しているユーザのpk}
+    """
+    snapshot = get_course_snapshot(course.pk)
+    return {
+        'input': load_assignment_input(course),
+        'gpa_pool': snapshot.gpa_values(),
+        'members': frozenset(snapshot.user_pks),
+    }
+
+
+def get_snapshot(course: 'Course') -> dict:
+    """課程のバージョンをキーに含めてキャッシュしたデータを返す"""
+    version = get_course_version(course.pk).version
+    return caching.get_or_compute(f'course-advise-snapshot-{course.pk}-{version}', lambda: load_snapshot(course))
+
+
+def availability_masks(snapshot: dict, user_pk: int, gpa: 'Optional[float]',
+                       trials: int, seed: int = 0) -> 'Tuple[List[int], int]':
+    """
+    試行ごとに，ユーザの番が来た時点で空きのある研究室を求める．
+    GPAが確定している他のユーザは優先順位の高い順に1度だけ配属の状態に加え，
+    試行ごとに抽出するユーザ（GPA未入力，志望順位の未提出）のみを差分で加えて取り除く
+    :param snapshot: get_snapshotの結果
+    :param user_pk: 助言を求めるユーザのpk
+    :param gpa: そのユーザのGPA．Noneの場合は観測されたGPAから抽出する
+    :param trials: 最大の試行回数．試行回数×抽出するユーザの数がget_work_limitを超えないように減らす
+    :return: (研究室ごとに，空きのあった試行のビットを立てた整数, 実際の試行回数)
+    """
+    data = snapshot['input']
+    gpa_pool = snapshot['gpa_pool']
+    known = sorted(
+        (priority_key(other_pk, value), other_pk, prefs, value)
+        for other_pk, prefs, value in zip(data.user_pks, data.prefs, data.gpa)
+        if other_pk != user_pk and value is not None
+    )
+    unknown = [
+        (other_pk, prefs) for other_pk, prefs, value in zip(data.user_pks, data.prefs, data.gpa)
+        if other_pk != user_pk and value is None
+    ]
+    # 志望順位を提出していない他の参加者は，提出済みの志望順位から抽出する
+    rank_pool = data.prefs
+    n_pending = len(snapshot['members'] - set(data.user_pks) - {user_pk}) if rank_pool else 0
+    n_sampled = len(unknown) + n_pending
+    if gpa is None or n_sampled:
+        trials = max(1, min(trials, get_work_limit() // max(n_sampled, 1)))
+    else:
+        trials = 1
+    rng = random.Random(seed)
+
+    def draw() -> 'Optional[float]':
+        return rng.choice(gpa_pool) + rng.uniform(0, TIE_BREAK_NOISE) if gpa_pool else None
+
+    # 試行ごとの(自分の優先順位, 試行の番号, 抽出したユーザの(pk, 志望, GPA))
+    samples = []
+    for trial in range(trials):
+        own = gpa if gpa is not None else draw()
+        sampled = [(other_pk, prefs, draw()) for other_pk, prefs in unknown]
+        # 未提出のユーザにはpkが無いため，負の番号で区別する
+        sampled += [(-1 - i, rng.choice(rank_pool), draw()) for i in range(n_pending)]
+        samples.append((priority_key(user_pk, own), trial, sampled))
+    # 自分の優先順位の高い試行から順に処理し，自分より優先されるユーザを状態に加えていく
+    samples.sort(key=lambda sample: sample[:2])
+    n_labs = len(data.lab_pks)
+    # 最初の試行で自分より優先されるGPAの確定したユーザはまとめて配属する
+    added = 0
+    while added < len(known) and known[added][0] < samples[0][0]:
+        added += 1
+    ahead = known[:added]
+    state = AssignmentState.from_input(AssignmentInput(
+        [other_pk for _, other_pk, _, _ in ahead], list(range(n_labs)), [prefs for _, _, prefs, _ in ahead],
+        [value for _, _, _, value in ahead], data.capacity
+    ))
+    masks = [0] * n_labs
+    for own_key, trial, sampled in samples:
+        while added < len(known) and known[added][0] < own_key:
+            _, other_pk, prefs, value = known[added]
+            state.update_user(other_pk, value, prefs)
+            added += 1
+        ahead = [(other_pk, prefs, value) for other_pk, prefs, value in sampled
+                 if priority_key(other_pk, value) < own_key]
+        for other_pk, prefs, value in ahead:
+            state.update_user(other_pk, value, prefs)
+        bit = 1 << trial
+        for lab in range(n_labs):
+            if state.counts[lab] < state.capacity[lab]:
+                masks[lab] |= bit
+        for other_pk, _, _ in ahead:
+            state.remove_user(other_pk)
+    return masks, trials
+
+
+def search_lists(masks: 'Sequence[int]', candidates: 'Sequence[int]', length: int,
+                 limit: int) -> 'List[Tuple[int, List[int]]]':
+    """
+    候補の研究室を希望する順に並べたまま，配属される試行の数が多い組を深さ優先探索で求める．
+    配属される試行を増やさない研究室は加えず，上界が上位の組に届かない枝は打ち切る
+    :param masks: 研究室ごとの空きのあった試行のビット列
+    :param candidates: 希望する順に並べた研究室の番号
+    :param length: 組に含める最大の研究室の数
+    :param limit: 返す組の数
+    :return: 配属される試行の数の降順に並べた(試行の数, 研究室の番号のリスト)．同数の場合は希望する順に近い組を先にする
+    """
+    n = len(candidates)
+    candidate_masks = [masks[lab] for lab in candidates]
+    suffix_union = [0] * (n + 1)
+    suffix_max = [0] * (n + 1)
+    for i in range(n - 1, -1, -1):
+        suffix_union[i] = suffix_union[i + 1] | candidate_masks[i]
+        suffix_max[i] = max(suffix_max[i + 1], bin(candidate_masks[i]).count('1'))
+    # (試行の数, -見つけた順, 組)の最小ヒープ．先に見つけた組ほど希望する順に近い
+    best = []  # type: List[Tuple[int, int, List[int]]]
+    found = [0]
+
+    def visit(start: int, chosen: 'List[int]', covered: int):
+        count = bin(covered).count('1')
+        slots = length - len(chosen)
+        if chosen and (slots == 0 or not suffix_union[start] & ~covered):
+            found[0] += 1
+            entry = (count, -found[0], [candidates[i] for i in chosen])
+            if len(best) < limit:
+                heapq.heappush(best, entry)
+            elif entry > best[0]:
+                heapq.heapreplace(best, entry)
+            return
+        bound = min(bin(covered | suffix_union[start]).count('1'), count + slots * suffix_max[start])
+        if len(best) >= limit and bound <= best[0][0]:
+            return
+        for i in range(start, n):
+            if candidate_masks[i] & ~covered:
+                visit(i + 1, chosen + [i], covered | candidate_masks[i])
+
+    if length > 0:
+        visit(0, [], 0)
+    return [(count, chosen) for count, _, chosen in sorted(best, reverse=True)]
+
+
+def pad_list(masks: 'Sequence[int]', chosen: 'Sequence[int]', candidates: 'Sequence[int]',
+             length: int) -> 'List[int]':
+    """
+    志望順位の提出数に満たない組の後に残りの研究室を加え，そのまま提出できる長さにする．
+    候補の研究室を先に，その中では組に加えたときに配属される試行が多く増えるものから加え，同数の場合は希望する順とする
+    :param masks: 研究室ごとの空きのあった試行のビット列
+    :param chosen: search_listsで求めた組
+    :param candidates: 希望する順に並べた研究室の番号
+    :param length: 志望順位の提出数
+    :return: 加えた研究室を含む組．課程の研究室が足りなければlengthより短い
+    """
+    padded = list(chosen)
+    covered = 0
+    for lab in padded:
+        covered |= masks[lab]
+    rest = [lab for lab in candidates if lab not in padded]
+    rest += [lab for lab in range(len(masks)) if lab not in padded and lab not in rest]
+    is_candidate = set(candidates)
+    while len(padded) < length and rest:
+        i = max(range(len(rest)),
+                key=lambda i: (rest[i] in is_candidate, bin(masks[rest[i]] & ~covered).count('1'), -i))
+        lab = rest.pop(i)
+        padded.append(lab)
+        covered |= masks[lab]
+    return padded
+
+
+def advise_ranks(course: 'Course', user, lab_pks: 'Optional[Sequence[int]]' = None, limit: int = 5,
+                 seed: int = 0) -> dict:
+    """
+    ユーザに配属される確率の高い志望順位の組を返す．ユーザ自身の提出済みの志望順位は無いものとして扱う．
+    組は志望順位の提出数まで残りの研究室で埋め，そのまま提出できるようにする．埋めた研究室の数は'padded'に入れる
+    :param course: 課程
+    :param user: 助言を求めるユーザ
+    :param lab_pks: 希望する順に並べた候補の研究室のpk．Noneの場合は提出済みの志望順位の後に残りの研究室をpk順に並べる
+    :param limit: 返す組の数
+    :param seed: 乱数のシード
+    :return: {'version', 'trials', 'lists': [{'labs': 研究室のpk, 'probability': 確率, 'probabilities': 志望順位ごとの確率,
+                                           'padded': 埋めた研究室の数}]}
+    """
+    version = get_course_version(course.pk).version
+    snapshot = get_snapshot(course)
+    data = snapshot['input']
+    lab_index = {lab_pk: i for i, lab_pk in enumerate(data.lab_pks)}
+    if lab_pks is None:
+        submitted = Rank.objects.filter(course_id=course.pk, user_id=user.pk).order_by('order') \
+            .values_list('lab_id', flat=True)
+        lab_pks = [lab_pk for lab_pk in submitted if lab_pk is not None]
+        lab_pks += [lab_pk for lab_pk in data.lab_pks if lab_pk not in lab_pks]
+    candidates = []  # type: List[int]
+    for lab_pk in lab_pks:
+        if lab_pk in lab_index and lab_index[lab_pk] not in candidates:
+            candidates.append(lab_index[lab_pk])
+    # 試行の結果は候補の研究室に依らないため，候補を変えて繰り返し呼び出す場合に備えてキャッシュする
+    masks, trials = caching.get_or_compute(
+        f'course-advise-masks-{course.pk}-{version}-{user.pk}-{seed}',
+        lambda: availability_masks(snapshot, user.pk, user.gpa, get_trials(), seed)
+    )
+    rank_limit = get_config_cache(course.pk)['rank_limit']
+    lists = []
+    for _, chosen in search_lists(masks, candidates, rank_limit, limit):
+        padded = pad_list(masks, chosen, candidates, rank_limit)
+        covered = 0
+        probabilities = []
+        for lab in padded:
+            probabilities.append(round(bin(masks[lab] & ~covered).count('1') / trials, 4))
+            covered |= masks[lab]
+        lists.append({
+            'labs': [data.lab_pks[lab] for lab in padded],
+            'probability': round(bin(covered).count('1') / trials, 4),
+            'probabilities': probabilities,
+            'padded': len(padded) - len(chosen),
+        })
+    return {'version': version, 'trials': trials, 'lists': lists}
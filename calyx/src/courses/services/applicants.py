@@ -0,0 +1,138 @@
+"""
+研究室の志望者を志望順位ごとにまとめて読み出す．
+志望順位ごとにキーセットページネーションを行い，次のページはカーソルで指定する．
+"""
+import base64
+import json
+import math
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import F, Q
+from rest_framework.exceptions import ValidationError
+
+if TYPE_CHECKING:
+    from typing import List, Optional, Tuple
+    from django.db.models import QuerySet
+    from courses.models import Rank
+
+SORT_DEFAULT = 'default'
+SORT_GPA = 'gpa'
+
+
+def get_page_size() -> int:
+    return getattr(settings, 'APPLICANT_PAGE_SIZE', 100)
+
+
+class ApplicantQuery(object):
+    """
+    研究室の志望者の並び順とページ
+    :param sort: 'default'は提出順，'gpa'はGPAの降順（未入力は最後）
+    :param order: ページを指定する志望順位．Noneの場合は全ての志望順位の最初のページ
+    :param cursor: orderの志望順位について，このカーソルより後の志望者を返す
+    :param limit: 志望順位ごとの最大の人数
+    """
+
+    def __init__(self, sort: str = SORT_DEFAULT, order: 'Optional[int]' = None,
+                 cursor: 'Optional[str]' = None, limit: 'Optional[int]' = None):
+        if sort not in (SORT_DEFAULT, SORT_GPA):
+            raise ValueError(f'Unknown sort: {sort}')
+        self.sort = sort
+        self.order = order
+        # 不正なカーソルはここでValidationErrorとする
+        self.after = self.decode_cursor(cursor) if cursor else None
+        self.limit = min(limit or get_page_size(), get_page_size())
+
+    def encode_cursor(self, rank: 'Rank') -> str:
+        key = [rank.user.gpa, rank.pk] if self.sort == SORT_GPA else [rank.pk]
+        return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+    def decode_cursor(self, cursor: str) -> list:
+        """カーソルを[GPA, pk]または[pk]に戻す．GPAは有限の数値かNone，pkは整数でなければValidationErrorとする"""
+        try:
+            key = json.loads(base64.urlsafe_b64decode(cursor.encode()).decode())
+        except (ValueError, UnicodeError):
+            key = None
+        length = 2 if self.sort == SORT_GPA else 1
+        if not isinstance(key, list) or len(key) != length or not self._is_pk(key[-1]) \
+                or (self.sort == SORT_GPA and not self._is_gpa(key[0])):
+            raise ValidationError({'cursor': 'カーソルが正しくありません．'})
+        return key
+
+    @staticmethod
+    def _is_pk(value) -> bool:
+        # boolはintのサブクラスのため除く
+        return isinstance(value, int) and not isinstance(value, bool)
+
+    @staticmethod
+    def _is_gpa(value) -> bool:
+        if value is None:
+            return True
+        return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+    def _ordering(self) -> list:
+        if self.sort == SORT_GPA:
+            return [F('user__gpa').desc(nulls_last=True), 'pk']
+        return ['pk']
+
+    def _sort_key(self, rank: 'Rank') -> tuple:
+        """_orderingと同じ並び順のキー"""
+        if self.sort == SORT_GPA:
+            gpa = rank.user.gpa
+            return rank.order, gpa is None, -(gpa or 0.0), rank.pk
+        return rank.order, rank.pk
+
+    def _first_pages(self, ranks: 'QuerySet', rank_limit: int) -> 'List[Rank]':
+        """
+        志望順位ごとに最初のページと次のページの有無を知るための1件を，1回のクエリでSQLのLIMITにより絞り込む
+        """
+        if rank_limit <= 0:
+            return []
+        size = self.limit + 1
+        if connections[ranks.db].features.supports_slicing_ordering_in_compound:
+            # MySQLなどでは志望順位ごとのLIMIT付きのSELECTをUNION ALLでまとめる．全体の並び順は保証されない
+            pages = [ranks.filter(order=order)[:size] for order in range(rank_limit)]
+            selected = list(pages[0].union(*pages[1:], all=True))
+        else:
+            # SQLiteは複合文の中のLIMITに対応しないため，LIMIT付きのサブクエリで絞り込む
+            condition = Q()
+            for order in range(rank_limit):
+                condition |= Q(pk__in=ranks.filter(order=order).values('pk')[:size])
+            selected = list(ranks.filter(condition))
+        return sorted(selected, key=self._sort_key)
+
+    def _after(self) -> 'Q':
+        """カーソルより後の志望者の条件"""
+        if self.sort == SORT_GPA:
+            gpa, pk = self.after
+            if gpa is None:
+                return Q(user__gpa__isnull=True, pk__gt=pk)
+            return Q(user__gpa__lt=gpa) | Q(user__gpa=gpa, pk__gt=pk) | Q(user__gpa__isnull=True)
+        return Q(pk__gt=self.after[0])
+
+    def paginate(self, ranks: 'QuerySet', rank_limit: int) -> 'Tuple[List[List[Rank]], List[Optional[str]]]':
+        """
+        志望者を1回のクエリで読み込み，志望順位ごとに分ける．読み込むのは志望順位ごとにlimit+1人まで
+        :param ranks: 研究室の志望順位のクエリセット
+        :param rank_limit: 志望順位の数
+        :return: (志望順位ごとの志望順位のリスト, 志望順位ごとの次のページのカーソル)
+        """
+        ranks = ranks.filter(order__lt=rank_limit).select_related('user').order_by('order', *self._ordering())
+        if self.order is not None:
+            ranks = ranks.filter(order=self.order)
+            if self.after is not None:
+                ranks = ranks.filter(self._after())
+            # 次のページの有無を知るために1件多く読み込む
+            ranks = ranks[:self.limit + 1]
+        else:
+            ranks = self._first_pages(ranks, rank_limit)
+        ranks_per_order = [[] for _ in range(rank_limit)]
+        cursors = [None] * rank_limit  # type: List[Optional[str]]
+        for rank in ranks:
+            page = ranks_per_order[rank.order]
+            if len(page) < self.limit:
+                page.append(rank)
+            elif cursors[rank.order] is None:
+                cursors[rank.order] = self.encode_cursor(page[-1])
+        return ranks_per_order, cursors
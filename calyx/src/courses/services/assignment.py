@@ -0,0 +1,183 @@
+"""
+課程の志望順位，GPA，研究室の許容人数から配属を予測する．
+志望順位はユーザ×志望順位の研究室の番号の行列（志望が無ければ-1），GPAと許容人数はベクトルとして扱う．
+GPAの高い順に希望を叶えるシリアルディクテイターシップと，受入保留方式（deferred acceptance）を実装する．
+全ての研究室が同じGPA順で受け入れる場合は両者の結果は一致するが，受入保留方式は研究室ごとの優先順位も扱える．
+GPAを使わずに志望の満足度を最大化する配属（welfare）はwelfareモジュールの最小費用流で求める．
+"""
+from collections import namedtuple
+from typing import TYPE_CHECKING
+
+from . import caching, kernels
+from .welfare import min_cost_assignment
+from .snapshot import get_course_snapshot
+from .version import get_course_version
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+if TYPE_CHECKING:
+    from typing import List, Optional, Sequence
+    from courses.models import Course
+
+MECHANISM_SERIAL_DICTATORSHIP = 'serial_dictatorship'
+MECHANISM_DEFERRED_ACCEPTANCE = 'deferred_acceptance'
+MECHANISM_WELFARE = 'welfare'
+MECHANISMS = (MECHANISM_SERIAL_DICTATORSHIP, MECHANISM_DEFERRED_ACCEPTANCE, MECHANISM_WELFARE)
+
+# prefs: ユーザ×志望順位の研究室の番号，gpa: ユーザごとのGPA（未入力はNone），capacity: 研究室ごとの許容人数
+AssignmentInput = namedtuple('AssignmentInput', ['user_pks', 'lab_pks', 'prefs', 'gpa', 'capacity'])
+
+
+def load_assignment_input(course: 'Course') -> 'AssignmentInput':
+    """課程のスナップショットから配列を作る．志望順位を提出していないユーザは含めない"""
+    snapshot = get_course_snapshot(course.pk)
+    user_pks, prefs, gpa = [], [], []
+    for user_pk, user_gpa, labs in snapshot.iter_submitted():
+        user_pks.append(user_pk)
+        prefs.append([lab if lab >= 0 else -1 for lab in labs])
+        gpa.append(user_gpa)
+    return AssignmentInput(user_pks, list(snapshot.lab_pks), prefs, gpa,
+                           [max(capacity, 0) for capacity in snapshot.capacity])
+
+
+def priority_order(gpa: 'Sequence[Optional[float]]') -> 'List[int]':
+    """GPAの降順に並べたユーザの番号．GPA未入力のユーザは最後とし，同じGPAでは番号の小さい順とする"""
+    return sorted(range(len(gpa)), key=lambda i: (gpa[i] is None, -(gpa[i] or 0.0), i))
+
+
+def serial_dictatorship(prefs: 'Sequence[Sequence[int]]', gpa: 'Sequence[Optional[float]]',
+                        capacity: 'Sequence[int]') -> 'List[int]':
+    """
+    GPAの高いユーザから順に，空きのある最も志望順位の高い研究室に配属する
+    :return: ユーザごとの配属先の研究室の番号．配属されなければ-1
+    """
+    remaining = list(capacity)
+    assigned = [-1] * len(prefs)
+    for i in priority_order(gpa):
+        for lab in prefs[i]:
+            if lab >= 0 and remaining[lab] > 0:
+                remaining[lab] -= 1
+                assigned[i] = lab
+                break
+    return assigned
+
+
+def deferred_acceptance(prefs: 'Sequence[Sequence[int]]', gpa: 'Sequence[Optional[float]]',
+                        capacity: 'Sequence[int]', scores: 'Optional[np.ndarray]' = None) -> 'List[int]':
+    """
+    受入保留方式で配属する．各ラウンドで未配属のユーザが次の志望の研究室に一斉に応募し，
+    研究室は保留中のユーザと合わせて優先順位の高い順に許容人数まで保留し，残りを拒否する
+    :param scores: 研究室×ユーザの優先順位（小さいほど優先）．Noneの場合は全ての研究室でGPAの降順
+    :return: ユーザごとの配属先の研究室の番号．配属されなければ-1
+    """
+    if not kernels.is_enabled():
+        if scores is not None:
+            raise ImportError('Lab-specific priorities require NumPy.')
+        # 全ての研究室が同じ優先順位の場合，結果はシリアルディクテイターシップと一致する
+        return serial_dictatorship(prefs, gpa, capacity)
+    n_users = len(prefs)
+    n_labs = len(capacity)
+    if n_users == 0 or n_labs == 0:
+        return [-1] * n_users
+    prefs = np.asarray(prefs, dtype=np.int64).reshape(n_users, -1)
+    capacity = np.asarray(capacity, dtype=np.int64)
+    if scores is None:
+        rank = np.empty(n_users, dtype=np.int64)
+        rank[priority_order(gpa)] = np.arange(n_users)
+    assigned = np.full(n_users, -1, dtype=np.int64)
+    next_choice = np.zeros(n_users, dtype=np.int64)
+    while True:
+        proposers = np.flatnonzero((assigned < 0) & (next_choice < prefs.shape[1]))
+        if len(proposers) == 0:
+            break
+        labs = prefs[proposers, next_choice[proposers]]
+        next_choice[proposers] += 1
+        proposers, labs = proposers[labs >= 0], labs[labs >= 0]
+        if len(proposers) == 0:
+            continue
+        holders = np.flatnonzero(assigned >= 0)
+        candidates = np.concatenate([holders, proposers])
+        candidate_labs = np.concatenate([assigned[holders], labs])
+        candidate_scores = rank[candidates] if scores is None else scores[candidate_labs, candidates]
+        # 研究室ごとに優先順位の高い順に並べ，許容人数以内の順位のユーザのみを保留する
+        order = np.lexsort((candidate_scores, candidate_labs))
+        candidates, candidate_labs = candidates[order], candidate_labs[order]
+        counts = np.bincount(candidate_labs, minlength=n_labs)
+        starts = np.cumsum(counts) - counts
+        position = np.arange(len(candidates)) - starts[candidate_labs]
+        accepted = position < capacity[candidate_labs]
+        assigned[candidates] = np.where(accepted, candidate_labs, -1)
+    return assigned.tolist()
+
+
+def lab_cutoffs(assigned: 'Sequence[int]', gpa: 'Sequence[Optional[float]]',
+                capacity: 'Sequence[int]') -> 'List[Optional[float]]':
+    """
+    研究室ごとの配属されるために必要なGPA．定員に達した研究室では配属されたユーザの最低のGPA，
+    定員に空きがあればNone
+    """
+    counts = [0] * len(capacity)
+    lowest = [None] * len(capacity)  # type: List[Optional[float]]
+    for i, lab in enumerate(assigned):
+        if lab < 0:
+            continue
+        counts[lab] += 1
+        if gpa[i] is not None and (lowest[lab] is None or gpa[i] < lowest[lab]):
+            lowest[lab] = gpa[i]
+    return [lowest[lab] if counts[lab] >= capacity[lab] else None for lab in range(len(capacity))]
+
+
+def simulate_assignment(data: 'AssignmentInput', mechanism: str = MECHANISM_SERIAL_DICTATORSHIP) -> dict:
+    """
+    配属を予測する．welfareではGPAで配属を決めないため，ボーダーは常にNoneとする
+    :return: {'mechanism': 方式, 'labs': [{'pk', 'capacity', 'count', 'cutoff'}], 'users': {ユーザのpk: 研究室のpk}}
+    """
+    if mechanism == MECHANISM_SERIAL_DICTATORSHIP:
+        assigned = serial_dictatorship(data.prefs, data.gpa, data.capacity)
+    elif mechanism == MECHANISM_DEFERRED_ACCEPTANCE:
+        assigned = deferred_acceptance(data.prefs, data.gpa, data.capacity)
+    elif mechanism == MECHANISM_WELFARE:
+        assigned = min_cost_assignment(data.prefs, data.capacity)
+    else:
+        raise ValueError(f'Unknown mechanism: {mechanism}')
+    counts = [0] * len(data.lab_pks)
+    for lab in assigned:
+        if lab >= 0:
+            counts[lab] += 1
+    if mechanism == MECHANISM_WELFARE:
+        cutoffs = [None] * len(data.lab_pks)
+    else:
+        cutoffs = lab_cutoffs(assigned, data.gpa, data.capacity)
+    return {
+        'mechanism': mechanism,
+        'labs': [
+            {'pk': lab_pk, 'capacity': data.capacity[i], 'count': counts[i], 'cutoff': cutoffs[i]}
+            for i, lab_pk in enumerate(data.lab_pks)
+        ],
+        'users': {
+            user_pk: data.lab_pks[lab] if lab >= 0 else None for user_pk, lab in zip(data.user_pks, assigned)
+        },
+    }
+
+
+def get_assignment(course: 'Course', mechanism: str = MECHANISM_SERIAL_DICTATORSHIP) -> dict:
+    """
+    課程の配属の予測を取得する．課程のバージョンをキーに含めるため，データが変わらない限り再計算しない．
+    シリアルディクテイターシップでは，差分更新された配属の状態があればそれを使う
+    """
+    # matchingはこのモジュールに依存するため，ここでimportする
+    from .matching import get_assignment_state
+
+    if mechanism not in MECHANISMS:
+        raise ValueError(f'Unknown mechanism: {mechanism}')
+    version = get_course_version(course.pk).version
+
+    def compute():
+        if mechanism == MECHANISM_SERIAL_DICTATORSHIP:
+            return get_assignment_state(course).to_result(mechanism)
+        return simulate_assignment(load_assignment_input(course), mechanism)
+
+    return caching.get_or_compute(f'course-assignment-{course.pk}-{version}-{mechanism}', compute)
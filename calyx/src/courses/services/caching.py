@@ -0,0 +1,159 @@
+"""
+Stale-while-revalidateなキャッシュの読み書き．
+値と一緒に再計算すべき時刻（ソフトTTL）を保存し，キャッシュ自体の有効期限はハードTTLとする．
+ソフトTTLを過ぎた値は1つの呼び出しのみが再計算し，その間の他の呼び出しには古い値を返す．
+
+CACHE_VERSION_CHECKが有効な場合，値と一緒にDBに保存したバージョンを記録する．
+LocMemCacheのようにワーカー間でキャッシュが共有されない場合でも，
+他のワーカーが値を更新したことをバージョンの違いから検出して再計算する．
+"""
+import random
+import time
+from collections import namedtuple
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+
+from courses.models import CacheVersion
+
+if TYPE_CHECKING:
+    from typing import Any, Callable
+
+CacheEntry = namedtuple('CacheEntry', ['value', 'refresh_at', 'version'])
+
+# キャッシュが存在しない場合に，他の呼び出しの再計算を待つ際のポーリング間隔（秒）
+POLL_INTERVAL = 0.05
+
+# ワーカー内で最後にDBから読み込んだバージョン．key -> (バージョン, 読み込んだ時刻)
+_local_versions = dict()
+
+
+def get_soft_ttl() -> int:
+    return getattr(settings, 'CACHE_SOFT_TTL', 300)
+
+
+def get_hard_ttl() -> int:
+    return getattr(settings, 'CACHE_HARD_TTL', 3600)
+
+
+def get_lock_timeout() -> int:
+    return getattr(settings, 'CACHE_LOCK_TIMEOUT', 10)
+
+
+def is_versioned() -> bool:
+    return getattr(settings, 'CACHE_VERSION_CHECK', False)
+
+
+def get_counter(key: str, fresh: bool = False) -> int:
+    """
+    DBに保存されたキーの値を返す．CACHE_VERSION_CHECKに関わらず，ワーカー間で共有する値として使える．
+    CACHE_VERSION_TTLの間はワーカー内に保持した値を使う
+    :param key: キャッシュのキー
+    :param fresh: Trueの場合は必ずDBから読み込む
+    """
+    now = time.time()
+    local = _local_versions.get(key, None)
+    if not fresh and local is not None and now - local[1] < getattr(settings, 'CACHE_VERSION_TTL', 1):
+        return local[0]
+    version = CacheVersion.objects.filter(key=key).values_list('version', flat=True).first() or 0
+    _local_versions[key] = (version, now)
+    return version
+
+
+def increment_counter(key: str) -> int:
+    """DBに保存されたキーの値をインクリメントして新しい値を返す"""
+    updated = CacheVersion.objects.filter(key=key).update(version=F('version') + 1)
+    if not updated:
+        CacheVersion.objects.get_or_create(key=key)
+        CacheVersion.objects.filter(key=key).update(version=F('version') + 1)
+    return get_counter(key, fresh=True)
+
+
+def reset_counter(key: str, expected: int) -> bool:
+    """DBに保存されたキーの値がexpectedのままであれば0に戻す．その間に他の呼び出しが値を変えていればFalse"""
+    if expected == 0:
+        return True
+    reset = CacheVersion.objects.filter(key=key, version=expected).update(version=0) > 0
+    if reset:
+        _local_versions[key] = (0, time.time())
+    return reset
+
+
+def get_version(key: str, fresh: bool = False) -> int:
+    """
+    DBに保存されたキーのバージョンを返す．CACHE_VERSION_TTLの間はワーカー内に保持した値を使う
+    :param key: キャッシュのキー
+    :param fresh: Trueの場合は必ずDBから読み込む
+    """
+    if not is_versioned():
+        return 0
+    return get_counter(key, fresh)
+
+
+def bump_version(key: str) -> int:
+    """キーのバージョンをインクリメントして新しいバージョンを返す"""
+    if not is_versioned():
+        return 0
+    return increment_counter(key)
+
+
+def _make_entry(value: 'Any', version: int) -> 'CacheEntry':
+    # 同時に作られたキャッシュが一斉に再計算されないよう，ソフトTTLを最大でJITTERの割合だけ短くする
+    jitter = getattr(settings, 'CACHE_REFRESH_JITTER', 0.1)
+    soft_ttl = get_soft_ttl() * (1 - random.uniform(0, jitter))
+    return CacheEntry(value, time.time() + soft_ttl, version)
+
+
+def set_value(key: str, value: 'Any', version: int = 0) -> 'Any':
+    """値をキャッシュに格納する"""
+    cache.set(key, _make_entry(value, version), get_hard_ttl())
+    return value
+
+
+def publish(key: str, value: 'Any') -> 'Any':
+    """元のデータが変わったときに，バージョンを上げて他のワーカーのキャッシュを無効にしつつ値を格納する"""
+    return set_value(key, value, bump_version(key))
+
+
+def get_value(key: str, default: 'Any' = None) -> 'Any':
+    """鮮度に関わらずキャッシュされた値を返す"""
+    entry = cache.get(key, None)
+    if entry is None:
+        return default
+    return entry.value
+
+
+def get_or_compute(key: str, compute: 'Callable[[], Any]') -> 'Any':
+    """
+    キャッシュから値を取得する．ソフトTTLを過ぎていれば再計算するが，同じキーを同時に再計算するのは1つの呼び出しのみとする．
+    :param key: キャッシュのキー
+    :param compute: 値を計算する関数
+    :return: キャッシュされた値，または再計算した値
+    """
+    entry = cache.get(key, None)
+    version = get_version(key)
+    if entry is not None and entry.version != version:
+        # 他のワーカーが更新したため，手元の値は使えない
+        entry = None
+    if entry is not None and entry.refresh_at > time.time():
+        return entry.value
+    lock_key = f"{key}-lock"
+    lock_timeout = get_lock_timeout()
+    if cache.add(lock_key, True, lock_timeout):
+        try:
+            return set_value(key, compute(), version)
+        finally:
+            cache.delete(lock_key)
+    if entry is not None:
+        # 他の呼び出しが再計算しているので古い値を返す
+        return entry.value
+    # 値が無い場合は他の呼び出しの再計算が終わるのを待ち，それでも無ければ自分で計算する
+    deadline = time.time() + lock_timeout
+    while time.time() < deadline:
+        time.sleep(POLL_INTERVAL)
+        entry = cache.get(key, None)
+        if entry is not None and entry.version == version:
+            return entry.value
+    return set_value(key, compute(), version)
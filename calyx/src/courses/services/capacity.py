@@ -0,0 +1,71 @@
+"""
+研究室の許容人数の変更の試算と一括反映．
+試算では課程の配属の状態の複製に許容人数の変更を差分で適用し，DBへの書き込みやキャッシュの無効化は行わない．
+反映では全ての研究室の許容人数を1回のクエリで更新し，サマリーと配属の状態をまとめて差分更新する．
+"""
+from typing import TYPE_CHECKING
+
+from django.db import transaction
+
+from courses.models import Lab
+from .assignment import MECHANISM_SERIAL_DICTATORSHIP, get_assignment, load_assignment_input, simulate_assignment
+from .matching import get_assignment_state, update_assignment_for_capacities
+from .store import update_summary_for_capacities
+from .version import bump_course_version, get_course_version
+
+if TYPE_CHECKING:
+    from typing import Dict, List
+    from courses.models import Course
+
+
+def project_capacities(course: 'Course', capacities: 'Dict[int, int]',
+                       mechanism: str = MECHANISM_SERIAL_DICTATORSHIP) -> dict:
+    """
+    許容人数を変更した場合の配属を試算する
+    :param course: 課程
+    :param capacities: 研究室のpk -> 変更後の許容人数．含まれない研究室は現在の許容人数のまま
+    :param mechanism: 配属の方式
+    :return: {'mechanism', 'version', 'labs': [{'pk', 'capacity', 'count', 'cutoff', 'current_capacity',
+              'current_count', 'current_cutoff'}], 'moved': [{'user', 'from', 'to'}]}
+    """
+    current = get_assignment(course, mechanism)
+    if mechanism == MECHANISM_SERIAL_DICTATORSHIP:
+        # キャッシュから取り出した状態は複製のため，変更してもキャッシュには影響しない
+        state = get_assignment_state(course)
+        for lab_pk, capacity in capacities.items():
+            state.set_capacity(lab_pk, capacity)
+        projected = state.to_result(mechanism)
+    else:
+        data = load_assignment_input(course)
+        capacity = [capacities.get(lab_pk, value) for lab_pk, value in zip(data.lab_pks, data.capacity)]
+        projected = simulate_assignment(data._replace(capacity=[max(value, 0) for value in capacity]), mechanism)
+    labs = [
+        dict(lab, current_capacity=before['capacity'], current_count=before['count'], current_cutoff=before['cutoff'])
+        for lab, before in zip(projected['labs'], current['labs'])
+    ]
+    moved = [
+        {'user': user_pk, 'from': lab_pk, 'to': projected['users'].get(user_pk, None)}
+        for user_pk, lab_pk in current['users'].items() if projected['users'].get(user_pk, None) != lab_pk
+    ]
+    return {
+        'mechanism': mechanism,
+        'version': get_course_version(course.pk).version,
+        'labs': labs,
+        'moved': moved,
+    }
+
+
+def commit_capacities(course: 'Course', capacities: 'Dict[int, int]') -> 'List[Lab]':
+    """
+    研究室の許容人数をまとめて更新する．研究室ごとの保存によるシグナルは飛ばさず，最後に1度だけ差分を適用する
+    :return: 課程の全ての研究室
+    """
+    with transaction.atomic():
+        labs = list(Lab.objects.select_for_update().filter(course_id=course.pk, pk__in=capacities.keys()))
+        for lab in labs:
+            lab.capacity = capacities[lab.pk]
+        Lab.objects.bulk_update(labs, ['capacity'])
+    update_summary_for_capacities(course.pk, capacities)
+    bump_course_version(course.pk)
+    update_assignment_for_capacities(course.pk, capacities)
+    return list(Lab.objects.filter(course_id=course.pk).order_by('pk'))
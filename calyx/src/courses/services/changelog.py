@@ -0,0 +1,154 @@
+"""
+志望順位の変更履歴を追記専用のログとして書き込み，課程とユーザを指定して読み出す．
+提出ごとの変更はワーカー内のキューにためておき，RANK_CHANGE_BUFFER_SIZE件たまるか，
+最も古い変更からRANK_CHANGE_FLUSH_SECONDSが過ぎた時点で1回のINSERTでまとめて追記する．
+キューに加えるのは志望順位をコミットした後とするため，取り消された提出の履歴は残らない．
+ワーカーの終了時にも残りを書き込むが，harakiriなどで強制終了された場合はその間の変更を失う．
+CSVからの登録のように1回の処理で多くのユーザを変更する場合は，RankChangeBufferで志望順位と同じトランザクションで書き込む．
+"""
+import atexit
+import threading
+import time
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.utils import timezone
+
+from courses.models import RankChange
+
+if TYPE_CHECKING:
+    from datetime import datetime
+    from typing import Iterable, List, Optional, Tuple
+    from courses.models import Course
+
+
+def get_buffer_size() -> int:
+    return getattr(settings, 'RANK_CHANGE_BUFFER_SIZE', 500)
+
+
+def get_flush_seconds() -> float:
+    return getattr(settings, 'RANK_CHANGE_FLUSH_SECONDS', 5)
+
+
+def get_page_size() -> int:
+    return getattr(settings, 'RANK_CHANGE_PAGE_SIZE', 100)
+
+
+# 提出ごとの変更のキュー．(キューに加えた時刻, 変更)のリスト
+_pending = []  # type: List[Tuple[float, RankChange]]
+_pending_lock = threading.Lock()
+
+
+class RankChangeBuffer(object):
+    """
+    多くのユーザの志望順位の変更履歴をためておき，まとめて追記する．with文を抜ける際に残りを書き込み，例外の場合は破棄する
+    :param course_pk: 課程のpk
+    :param source: 変更の種類（RankChange.SOURCE_*）
+    :param actor_pk: 変更を行ったユーザのpk
+    """
+
+    def __init__(self, course_pk: int, source: int = RankChange.SOURCE_SUBMIT, actor_pk: 'Optional[int]' = None):
+        self.course_pk = course_pk
+        self.source = source
+        self.actor_pk = actor_pk
+        self.buffer = []  # type: List[RankChange]
+        self.size = get_buffer_size()
+        self.written = 0
+
+    def add(self, user_pk: int, lab_pks: 'Iterable[Optional[int]]'):
+        """ユーザの変更後の志望順位を追加する．バッファが一杯になれば書き込む"""
+        self.buffer.append(RankChange(
+            course_id=self.course_pk, user_id=user_pk, actor_id=self.actor_pk, source=self.source,
+            labs=RankChange.encode_labs(lab_pks), changed_at=timezone.now()
+        ))
+        if len(self.buffer) >= self.size:
+            self.flush()
+
+    def flush(self):
+        if not self.buffer:
+            return
+        RankChange.objects.bulk_create(self.buffer)
+        self.written += len(self.buffer)
+        self.buffer = []
+
+    def __enter__(self) -> 'RankChangeBuffer':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.flush()
+        else:
+            self.buffer = []
+
+
+def append_rank_change(course_pk: int, user_pk: int, lab_pks: 'Iterable[Optional[int]]',
+                       source: int = RankChange.SOURCE_SUBMIT, actor_pk: 'Optional[int]' = None):
+    """
+    1人分の志望順位の変更をキューに加え，キューが一杯か古くなっていればまとめて追記する．
+    志望順位を書き込んだトランザクションのコミット後に呼び出すこと
+    """
+    now = time.monotonic()
+    with _pending_lock:
+        _pending.append((now, RankChange(
+            course_id=course_pk, user_id=user_pk, actor_id=actor_pk, source=source,
+            labs=RankChange.encode_labs(lab_pks), changed_at=timezone.now()
+        )))
+        due = len(_pending) >= get_buffer_size() or now - _pending[0][0] >= get_flush_seconds()
+    if due:
+        flush_rank_changes()
+
+
+def flush_rank_changes() -> int:
+    """
+    キューにたまった変更を1回のINSERTで追記する．書き込みに失敗した場合は変更をキューに戻す
+    :return: 追記した変更の数
+    """
+    with _pending_lock:
+        batch = list(_pending)
+        del _pending[:]
+    if not batch:
+        return 0
+    try:
+        RankChange.objects.bulk_create([change for _, change in batch])
+    except Exception:
+        with _pending_lock:
+            _pending[:0] = batch
+        raise
+    return len(batch)
+
+
+# ワーカーが正常に終了する際（max-requestsによる再起動を含む）に残りを書き込む
+atexit.register(flush_rank_changes)
+
+
+def get_rank_changes(course: 'Course', user_pk: 'Optional[int]' = None, since: 'Optional[datetime]' = None,
+                     until: 'Optional[datetime]' = None, before: 'Optional[int]' = None,
+                     limit: 'Optional[int]' = None) -> 'Tuple[List[RankChange], Optional[int]]':
+    """
+    志望順位の変更履歴を新しい順に取得する．課程とユーザのインデックスをpkの降順にたどるため，履歴全体は走査しない．
+    他のワーカーのキューにある変更は，RANK_CHANGE_FLUSH_SECONDS程度遅れて読み出せるようになる
+    :param course: 課程
+    :param user_pk: ユーザのpk．Noneの場合は課程の全てのユーザ
+    :param since: 期間の開始
+    :param until: 期間の終了
+    :param before: このpkより前の履歴を返す．前のページの戻り値を指定する
+    :param limit: 最大の件数
+    :return: (変更履歴のリスト, 次のページのbefore)
+    """
+    limit = min(limit or get_page_size(), get_page_size())
+    # このワーカーのキューにある変更も読み出せるようにする
+    flush_rank_changes()
+    changes = RankChange.objects.filter(course_id=course.pk)
+    if user_pk is not None:
+        changes = changes.filter(user_id=user_pk)
+    if since is not None:
+        changes = changes.filter(changed_at__gte=since)
+    if until is not None:
+        changes = changes.filter(changed_at__lte=until)
+    if before is not None:
+        changes = changes.filter(pk__lt=before)
+    # 次のページの有無を知るために1件多く読み込む
+    changes = list(changes.order_by('-pk')[:limit + 1])
+    if len(changes) > limit:
+        return changes[:limit], changes[limit - 1].pk
+    return changes, None
@@ -0,0 +1,127 @@
+"""
+締め切り後の課程の凍結．
+凍結時にサマリー，研究室の詳細，課程の詳細のレスポンスと，それらを閲覧できるユーザを1度だけ生成してDBに保存する．
+凍結中は内容が変わらないため，キャッシュのキーに凍結のpkを含めて無効化せずに使い続ける．
+"""
+import json
+from typing import TYPE_CHECKING
+
+from django.db import transaction
+from django.db.models import Count
+from rest_framework.utils.encoders import JSONEncoder
+
+from courses.models import FrozenCourse, FrozenPayload, Lab, Rank
+from . import caching
+from .config import get_config_cache
+from .summary import update_summary_cache
+
+if TYPE_CHECKING:
+    from typing import Any, Dict, Optional
+    from courses.models import Course
+
+PAYLOAD_SUMMARY = 'summary'
+PAYLOAD_COURSE = 'course'
+PAYLOAD_ACCESS = 'access'
+
+
+def lab_payload_key(lab_pk: int) -> str:
+    return f'lab-{lab_pk}'
+
+
+def _dumps(payload: 'Any') -> str:
+    return json.dumps(payload, cls=JSONEncoder, separators=(',', ':'), ensure_ascii=False)
+
+
+def make_access(course: 'Course') -> 'Dict[str, list]':
+    """
+    凍結時点で各レスポンスを閲覧できるユーザを権限クラスと同じ条件でまとめて求める
+    :return: {'admins': 管理者, 'course_readers': 課程の詳細を閲覧できるユーザ, 'rank_readers': サマリーと研究室の詳細を閲覧できるユーザ}
+    """
+    config = get_config_cache(course.pk)
+    course_readers = [
+        user_pk for user_pk, gpa, screen_name in course.users.values_list('pk', 'gpa', 'screen_name')
+        if (not config['show_gpa'] or gpa is not None) and (not config['show_username'] or screen_name)
+    ]
+    submitted = set(
+        Rank.objects.filter(course_id=course.pk).values('user_id').annotate(count=Count('pk'))
+        .filter(count=config['rank_limit']).values_list('user_id', flat=True)
+    )
+    admins = []
+    if course.admin_user_group_id is not None:
+        admins = list(course.admin_user_group.user_set.values_list('pk', flat=True))
+    return {
+        'admins': admins,
+        'course_readers': course_readers,
+        'rank_readers': [user_pk for user_pk in course_readers if user_pk in submitted],
+    }
+
+
+def make_payloads(course: 'Course') -> 'Dict[str, Any]':
+    """凍結時点のレスポンスを生成する"""
+    # シリアライザはservicesに依存するため，ここでimportする
+    from courses.serializers import ReadOnlyCourseSerializer, LabSerializer
+
+    payloads = {
+        PAYLOAD_SUMMARY: update_summary_cache(course),
+        PAYLOAD_COURSE: ReadOnlyCourseSerializer(course).data,
+        PAYLOAD_ACCESS: make_access(course),
+    }
+    context = {'course': course}
+    for lab in Lab.objects.filter(course_id=course.pk).select_related('course'):
+        payloads[lab_payload_key(lab.pk)] = LabSerializer(lab, context=context).data
+    return payloads
+
+
+def _frozen_key(course_pk: int) -> str:
+    return f'course-frozen-{course_pk}'
+
+
+def _load_frozen(course_pk: int) -> 'Optional[dict]':
+    frozen = FrozenCourse.objects.filter(course_id=course_pk).first()
+    if frozen is None:
+        return None
+    access = json.loads(FrozenPayload.objects.get(frozen_course=frozen, key=PAYLOAD_ACCESS).payload)
+    info = {key: frozenset(user_pks) for key, user_pks in access.items()}
+    info['pk'] = frozen.pk
+    info['frozen_at'] = frozen.frozen_at
+    return info
+
+
+def get_frozen(course_pk: int) -> 'Optional[dict]':
+    """
+    課程が凍結されていれば，凍結の情報と閲覧できるユーザを返す．凍結されていなければNone
+    :return: {'pk', 'frozen_at', 'admins', 'course_readers', 'rank_readers'}
+    """
+    return caching.get_or_compute(_frozen_key(course_pk), lambda: _load_frozen(course_pk))
+
+
+def get_frozen_payload(frozen: dict, key: str) -> 'Optional[Any]':
+    """凍結時に生成したレスポンスを返す．存在しなければNone"""
+
+    def load():
+        payload = FrozenPayload.objects.filter(frozen_course_id=frozen['pk'], key=key) \
+            .values_list('payload', flat=True).first()
+        return None if payload is None else json.loads(payload)
+
+    # 凍結中は変わらないため，凍結のpkをキーに含めて無効化しない
+    return caching.get_or_compute(f'course-frozen-payload-{frozen["pk"]}-{key}', load)
+
+
+def freeze_course(course: 'Course') -> 'FrozenCourse':
+    """課程を凍結し，読み出し用のレスポンスを生成する．既に凍結されていれば作り直す"""
+    with transaction.atomic():
+        FrozenCourse.objects.filter(course_id=course.pk).delete()
+        frozen = FrozenCourse.objects.create(course=course)
+        FrozenPayload.objects.bulk_create([
+            FrozenPayload(frozen_course=frozen, key=key, payload=_dumps(payload))
+            for key, payload in make_payloads(course).items()
+        ])
+    caching.publish(_frozen_key(course.pk), _load_frozen(course.pk))
+    return frozen
+
+
+def unfreeze_course(course: 'Course') -> bool:
+    """課程の凍結を解除する．凍結されていなければFalseを返す"""
+    deleted, _ = FrozenCourse.objects.filter(course_id=course.pk).delete()
+    caching.publish(_frozen_key(course.pk), None)
+    return bool(deleted)
@@ -0,0 +1,168 @@
+"""
+サマリーの履歴を研究室ごとに差分で保存し，期間を指定して読み出す．
+サマリーは'capacity'や'detail.0.border'のようなキーを持つ平坦な辞書に変換し，直前の状態から変わったキーのみを保存する．
+読み出す際は期間の開始以前で最も新しいキーフレームから順に差分を適用するため，履歴全体を復元する必要はない．
+履歴には取得時の表示設定のサマリーが残るため，読み出す際に現在の表示設定を適用する．
+"""
+import json
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from courses.models import LabSummary, LabSummarySnapshot
+from .config import get_config_cache
+from .summary import get_summary
+
+if TYPE_CHECKING:
+    from datetime import datetime
+    from typing import Dict, Iterable, List, Optional, Tuple
+    from courses.models import Course, Lab
+
+
+def get_keyframe_interval() -> int:
+    return getattr(settings, 'SUMMARY_HISTORY_KEYFRAME_INTERVAL', 60)
+
+
+def flatten_summary(summary_per_lab: dict) -> 'Dict[str, object]':
+    """研究室ごとのサマリーを平坦な辞書に変換する．pkは含めない"""
+    state = {'name': summary_per_lab['name'], 'capacity': summary_per_lab['capacity']}
+    for key, value in summary_per_lab['abstract'].items():
+        state[f'abstract.{key}'] = value
+    for order, fragment in enumerate(summary_per_lab['detail']):
+        for key, value in fragment.items():
+            state[f'detail.{order}.{key}'] = value
+    return state
+
+
+def unflatten_summary(lab_pk: int, state: 'Dict[str, object]') -> dict:
+    """flatten_summaryの逆変換"""
+    summary_per_lab = {'pk': lab_pk, 'name': None, 'capacity': None, 'detail': [], 'abstract': {}}
+    for path, value in state.items():
+        keys = path.split('.')
+        if keys[0] == 'abstract':
+            summary_per_lab['abstract'][keys[1]] = value
+        elif keys[0] == 'detail':
+            order = int(keys[1])
+            while len(summary_per_lab['detail']) <= order:
+                summary_per_lab['detail'].append({})
+            summary_per_lab['detail'][order][keys[2]] = value
+        else:
+            summary_per_lab[keys[0]] = value
+    return summary_per_lab
+
+
+def hide_gpa(summary_per_lab: dict) -> dict:
+    """GPAを表示しない課程のサマリーと同じく，GPAの統計量を取り除く"""
+    def strip(fragment: dict) -> dict:
+        return {key: value for key, value in fragment.items() if key not in LabSummary.stat_fields}
+
+    return dict(summary_per_lab, abstract=strip(summary_per_lab['abstract']),
+                detail=[strip(fragment) for fragment in summary_per_lab['detail']])
+
+
+def diff_state(previous: 'Dict[str, object]', current: 'Dict[str, object]') -> 'Dict[str, object]':
+    """previousからcurrentへの差分を返す．削除されたキーの値はNone"""
+    delta = {key: value for key, value in current.items() if previous.get(key, None) != value}
+    delta.update({key: None for key in previous.keys() if key not in current})
+    return delta
+
+
+def _apply_delta(state: 'Dict[str, object]', snapshot: 'LabSummarySnapshot') -> 'Dict[str, object]':
+    delta = json.loads(snapshot.delta)
+    if snapshot.is_keyframe:
+        return delta
+    state = dict(state)
+    for key, value in delta.items():
+        if value is None:
+            state.pop(key, None)
+        else:
+            state[key] = value
+    return state
+
+
+def _load_latest_states(lab_pks: 'Iterable[int]') -> 'Dict[int, Tuple[Dict[str, object], int]]':
+    """
+    研究室ごとに最新の状態と，最後のキーフレーム以降の差分の数を復元する
+    :return: lab_pk -> (状態, 差分の数)
+    """
+    keyframes = dict(
+        LabSummarySnapshot.objects.filter(lab_id__in=lab_pks, is_keyframe=True)
+        .values('lab_id').annotate(last=Max('taken_at')).values_list('lab_id', 'last')
+    )
+    if not keyframes:
+        return dict()
+    snapshots = LabSummarySnapshot.objects.filter(lab_id__in=keyframes.keys(), taken_at__gte=min(keyframes.values())) \
+        .order_by('lab_id', 'taken_at', 'pk')
+    states = dict()
+    for snapshot in snapshots.iterator():
+        if snapshot.taken_at < keyframes[snapshot.lab_id]:
+            continue
+        state, count = states.get(snapshot.lab_id, (dict(), 0))
+        states[snapshot.lab_id] = (_apply_delta(state, snapshot), 0 if snapshot.is_keyframe else count + 1)
+    return states
+
+
+def take_snapshot(course: 'Course', taken_at: 'Optional[datetime]' = None) -> int:
+    """
+    課程の現在のサマリーを履歴に追加する
+    :param course: 課程
+    :param taken_at: 取得日時．省略した場合は現在時刻
+    :return: 保存したスナップショットの数
+    """
+    if taken_at is None:
+        taken_at = timezone.now()
+    summary = get_summary(course)
+    states = _load_latest_states([summary_per_lab['pk'] for summary_per_lab in summary])
+    interval = get_keyframe_interval()
+    snapshots = []
+    for summary_per_lab in summary:
+        current = flatten_summary(summary_per_lab)
+        previous, count = states.get(summary_per_lab['pk'], (None, 0))
+        is_keyframe = previous is None or count + 1 >= interval
+        delta = current if is_keyframe else diff_state(previous, current)
+        if not delta:
+            continue
+        snapshots.append(LabSummarySnapshot(
+            lab_id=summary_per_lab['pk'], taken_at=taken_at, is_keyframe=is_keyframe,
+            delta=json.dumps(delta, separators=(',', ':'), ensure_ascii=False)
+        ))
+    LabSummarySnapshot.objects.bulk_create(snapshots)
+    return len(snapshots)
+
+
+def get_lab_history(lab: 'Lab', since: 'Optional[datetime]' = None,
+                    until: 'Optional[datetime]' = None) -> 'List[dict]':
+    """
+    研究室のサマリーの履歴を期間を指定して取得する．
+    GPAを表示していた間のスナップショットも，現在GPAを表示しない課程ではGPAの統計量を除いて返す
+    :param lab: 研究室
+    :param since: 期間の開始．開始時点のサマリーとして，開始以前で最も新しいスナップショットも含める
+    :param until: 期間の終了
+    :return: {'taken_at': 取得日時, 'summary': 研究室ごとのサマリー}のリスト
+    """
+    snapshots = LabSummarySnapshot.objects.filter(lab_id=lab.pk)
+    if since is not None:
+        start = snapshots.filter(is_keyframe=True, taken_at__lte=since).aggregate(start=Max('taken_at'))['start']
+        if start is not None:
+            snapshots = snapshots.filter(taken_at__gte=start)
+    if until is not None:
+        snapshots = snapshots.filter(taken_at__lte=until)
+    history = []
+    state = dict()
+    for snapshot in snapshots.order_by('taken_at', 'pk').iterator():
+        state = _apply_delta(state, snapshot)
+        if since is not None and snapshot.taken_at <= since:
+            # 期間の開始時点のサマリーとして，開始以前で最も新しい状態を含める
+            history[:] = [{'taken_at': snapshot.taken_at, 'summary': state}]
+            continue
+        history.append({'taken_at': snapshot.taken_at, 'summary': state})
+    show_gpa = get_config_cache(lab.course_id)['show_gpa']
+    result = []
+    for item in history:
+        summary_per_lab = unflatten_summary(lab.pk, item['summary'])
+        if not show_gpa:
+            summary_per_lab = hide_gpa(summary_per_lab)
+        result.append({'taken_at': item['taken_at'], 'summary': summary_per_lab})
+    return result
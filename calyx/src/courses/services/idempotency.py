@@ -0,0 +1,120 @@
+"""
+Idempotency-Keyヘッダによる再送されたリクエストの検出．
+最初のリクエストのレスポンスをIDEMPOTENCY_TTLの間だけ保存し，同じキーで再送されたリクエストにはそれを返す．
+保存する量は有効期限，ユーザごとのキーの数，レスポンスの大きさで制限する．
+処理中のままIDEMPOTENCY_LEASEを過ぎたキーは，ワーカーが強制終了されたものとみなして再送されたリクエストが引き継ぐ．
+有効期限を過ぎたキーの削除はリクエストの処理中には行わず，purge_idempotency_keysコマンドで定期的に行う．
+"""
+import hashlib
+import json
+from datetime import timedelta
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils import timezone
+
+from courses.models import IdempotencyKey
+
+if TYPE_CHECKING:
+    from typing import Dict, Optional, Tuple
+
+
+def get_ttl() -> int:
+    return getattr(settings, 'IDEMPOTENCY_TTL', 3600)
+
+
+def get_lease() -> int:
+    return getattr(settings, 'IDEMPOTENCY_LEASE', 30)
+
+
+def get_max_keys_per_user() -> int:
+    return getattr(settings, 'IDEMPOTENCY_MAX_KEYS_PER_USER', 50)
+
+
+def get_max_response_bytes() -> int:
+    return getattr(settings, 'IDEMPOTENCY_MAX_RESPONSE_BYTES', 65536)
+
+
+def make_fingerprint(method: str, path: str, body: bytes) -> str:
+    return hashlib.sha256(b'\n'.join([method.encode(), path.encode(), body])).hexdigest()
+
+
+def begin_request(user, key: str, fingerprint: str) -> 'Tuple[IdempotencyKey, bool]':
+    """
+    キーを処理中として登録する．既に登録されていれば登録されているものを返す
+    :return: (キー, 新しく登録したかどうか)
+    """
+    try:
+        with transaction.atomic():
+            record = IdempotencyKey.objects.create(user=user, key=key, fingerprint=fingerprint)
+    except IntegrityError:
+        record = IdempotencyKey.objects.get(user=user, key=key)
+        if not _is_reclaimable(record):
+            return record, False
+        # 同時に引き継ごうとしたリクエストのうち，作成日時が変わる前に更新できたものだけが引き継ぐ
+        now = timezone.now()
+        taken = IdempotencyKey.objects.filter(pk=record.pk, created_at=record.created_at) \
+            .update(fingerprint=fingerprint, status_code=None, response='', created_at=now)
+        if not taken:
+            return IdempotencyKey.objects.get(pk=record.pk), False
+        record.fingerprint, record.status_code, record.response, record.created_at = fingerprint, None, '', now
+        return record, True
+    # ユーザごとに新しいものから一定の数のみを残す
+    stale = list(
+        IdempotencyKey.objects.filter(user=user).order_by('-created_at', '-pk')
+        .values_list('pk', flat=True)[get_max_keys_per_user():]
+    )
+    if stale:
+        IdempotencyKey.objects.filter(pk__in=stale).delete()
+    return record, True
+
+
+def _is_reclaimable(record: 'IdempotencyKey') -> bool:
+    """有効期限を過ぎたキーと，処理中のままリースを過ぎたキーは新しいリクエストが引き継ぐ"""
+    age = timezone.now() - record.created_at
+    if age > timedelta(seconds=get_ttl()):
+        return True
+    return record.status_code is None and age > timedelta(seconds=get_lease())
+
+
+def purge_expired_keys() -> int:
+    """
+    有効期限を過ぎたキーを削除する
+    :return: 削除したキーの数
+    """
+    count, _ = IdempotencyKey.objects.filter(created_at__lt=timezone.now() - timedelta(seconds=get_ttl())).delete()
+    return count
+
+
+def complete_request(record: 'IdempotencyKey', status_code: int, data: str, headers: 'Dict[str, str]'):
+    """
+    処理したリクエストのレスポンスを保存する．大きすぎるレスポンスは保存せずキーを削除する
+    :param record: begin_requestで登録したキー
+    :param status_code: ステータスコード
+    :param data: JSONに変換したレスポンスのボディ
+    :param headers: 再送時にも返すヘッダ
+    """
+    response = json.dumps({'data': data, 'headers': headers}, separators=(',', ':'), ensure_ascii=False)
+    if len(response.encode()) > get_max_response_bytes():
+        discard_request(record)
+        return
+    record.status_code = status_code
+    record.response = response
+    record.save(update_fields=['status_code', 'response'])
+
+
+def discard_request(record: 'IdempotencyKey'):
+    """失敗したリクエストのキーを削除し，再送されたリクエストを改めて処理できるようにする"""
+    IdempotencyKey.objects.filter(pk=record.pk).delete()
+
+
+def load_response(record: 'IdempotencyKey') -> 'Optional[Tuple[int, str, Dict[str, str]]]':
+    """
+    保存したレスポンスを返す
+    :return: (ステータスコード, JSONに変換したレスポンスのボディ, ヘッダ)．処理中の場合はNone
+    """
+    if record.status_code is None:
+        return None
+    response = json.loads(record.response)
+    return record.status_code, response['data'], response['headers']
@@ -0,0 +1,179 @@
+"""
+紙などで集めた志望順位をCSVから一括で登録する．
+CSVは1行につき「ユーザ名,志望順位,研究室名」とし，志望順位は1から始まる．1行目が見出しであれば読み飛ばす．
+行は一定の数ごとにまとめ，ユーザの解決と志望順位の書き込みをそれぞれまとめて行う．
+"""
+import csv
+from collections import namedtuple
+from itertools import islice
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import F
+
+from courses.models import Lab, Rank, RankChange, RankSetVersion
+from .changelog import RankChangeBuffer
+from .config import get_config_cache
+from .summary import update_summary_cache
+from .version import bump_course_version
+
+if TYPE_CHECKING:
+    from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+    from courses.models import Course
+
+ImportResult = namedtuple('ImportResult', ['imported', 'users', 'errors'])
+
+# 返すエラーの最大の数
+MAX_ERRORS = 100
+
+
+def get_chunk_size() -> int:
+    return getattr(settings, 'IMPORT_CHUNK_SIZE', 1000)
+
+
+class RankImporter(object):
+    """
+    CSVの志望順位を課程に登録する．エラーが1つでもあれば何も書き込まない
+    :param course: 課程
+    :param actor_pk: 登録を行ったユーザのpk
+    """
+
+    def __init__(self, course: 'Course', actor_pk: 'Optional[int]' = None):
+        self.course = course
+        self.actor_pk = actor_pk
+        self.rank_limit = get_config_cache(course.pk)['rank_limit']
+        self.labs = dict(Lab.objects.filter(course_id=course.pk).values_list('name', 'pk'))
+        self.errors = []  # type: List[dict]
+        self.error_count = 0
+        self.imported = 0
+        # user_pk -> 登録した志望順位と研究室．重複と不足を検出する
+        self.orders = dict()  # type: Dict[int, Dict[int, int]]
+        self.user_labs = dict()  # type: Dict[int, Set[int]]
+        self.usernames = dict()  # type: Dict[int, str]
+
+    def error(self, line: int, message: str):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append({'line': line, 'message': message})
+
+    def parse(self, lines: 'Iterable[str]') -> 'Iterator[Tuple[int, str, int, int]]':
+        """CSVを1行ずつ読み，(行番号, ユーザ名, 志望順位, 研究室のpk)を返す"""
+        for line, row in enumerate(csv.reader(lines), 1):
+            if not any(column.strip() for column in row):
+                continue
+            if len(row) != 3:
+                self.error(line, '「ユーザ名,志望順位,研究室名」の3列で指定してください．')
+                continue
+            username, order, lab_name = [column.strip() for column in row]
+            if not order.isdigit():
+                if line != 1:
+                    self.error(line, f'志望順位「{order}」は整数で指定してください．')
+                # 1行目は見出しとみなす
+                continue
+            order = int(order)
+            if not 1 <= order <= self.rank_limit:
+                self.error(line, f'志望順位は1から{self.rank_limit}の間で指定してください．')
+                continue
+            if lab_name not in self.labs:
+                self.error(line, f'研究室「{lab_name}」は見つかりませんでした．')
+                continue
+            yield line, username, order - 1, self.labs[lab_name]
+
+    def write_chunk(self, rows: 'List[Tuple[int, str, int, int]]'):
+        """ユーザの解決，既存の志望順位の読み込み，書き込みをそれぞれまとめて行う"""
+        users = dict(
+            self.course.users.filter(username__in={row[1] for row in rows}).values_list('username', 'pk')
+        )
+        ranks = dict()  # type: Dict[Tuple[int, int], int]
+        for line, username, order, lab_pk in rows:
+            user_pk = users.get(username, None)
+            if user_pk is None:
+                self.error(line, f'ユーザ「{username}」は課程に参加していません．')
+                continue
+            orders = self.orders.setdefault(user_pk, dict())
+            user_labs = self.user_labs.setdefault(user_pk, set())
+            if order in orders or lab_pk in user_labs:
+                self.error(line, f'ユーザ「{username}」の志望順位または研究室が重複しています．')
+                continue
+            orders[order] = lab_pk
+            user_labs.add(lab_pk)
+            self.usernames[user_pk] = username
+            ranks[(user_pk, order)] = lab_pk
+        if not ranks or self.error_count:
+            # エラーがあれば書き込みは全て取り消すので，以降は検証のみを行う
+            return
+        user_pks = {user_pk for user_pk, _ in ranks.keys()}
+        existing = Rank.objects.filter(course_id=self.course.pk, user_id__in=user_pks).values_list('user_id', 'order', 'pk')
+        existing = {(user_pk, order): pk for user_pk, order, pk in existing if (user_pk, order) in ranks}
+        rank_objects = [
+            Rank(pk=existing.get(key, None), course_id=self.course.pk, user_id=key[0], order=key[1], lab_id=lab_pk)
+            for key, lab_pk in ranks.items()
+        ]
+        Rank.objects.bulk_update([rank for rank in rank_objects if rank.pk is not None], ['lab'])
+        Rank.objects.bulk_create([rank for rank in rank_objects if rank.pk is None])
+        self.imported += len(ranks)
+
+    def bump_versions(self, chunk_size: int):
+        """画面で取得していた志望順位は古くなるため，提出と同様にユーザごとにバージョンを1度上げる"""
+        user_pks = list(self.orders.keys())
+        for start in range(0, len(user_pks), chunk_size):
+            chunk = user_pks[start:start + chunk_size]
+            RankSetVersion.objects.filter(course_id=self.course.pk, user_id__in=chunk) \
+                .update(version=F('version') + 1)
+            RankSetVersion.objects.bulk_create(
+                [RankSetVersion(course_id=self.course.pk, user_id=user_pk, version=1) for user_pk in chunk],
+                ignore_conflicts=True
+            )
+
+    def record_changes(self):
+        """登録したユーザごとに変更履歴を追記する"""
+        with RankChangeBuffer(self.course.pk, RankChange.SOURCE_IMPORT, self.actor_pk) as buffer:
+            for user_pk, orders in self.orders.items():
+                buffer.add(user_pk, [orders[order] for order in sorted(orders.keys())])
+
+    def check_complete(self):
+        """全てのユーザについて全ての志望順位が指定されているかを確認する"""
+        for user_pk, orders in self.orders.items():
+            if len(orders) != self.rank_limit:
+                self.error(0, f'ユーザ「{self.usernames[user_pk]}」の志望順位は{self.rank_limit}個である必要があります．')
+
+    def run(self, lines: 'Iterable[str]', dry_run: bool = False) -> 'ImportResult':
+        """
+        CSVを読み込んで志望順位を登録し，最後にサマリーを1度だけ作り直す
+        :param lines: CSVの行
+        :param dry_run: Trueの場合は検証のみを行い，何も書き込まない
+        """
+        rows = self.parse(lines)
+        chunk_size = get_chunk_size()
+        with transaction.atomic():
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                self.write_chunk(chunk)
+            self.check_complete()
+            if not self.error_count:
+                self.bump_versions(chunk_size)
+                self.record_changes()
+            if self.error_count or dry_run:
+                transaction.set_rollback(True)
+        if self.error_count:
+            return ImportResult(0, 0, self.errors)
+        if not dry_run and self.imported:
+            bump_course_version(self.course.pk)
+            update_summary_cache(self.course)
+        return ImportResult(self.imported, len(self.orders), self.errors)
+
+
+def import_ranks(course: 'Course', lines: 'Iterable[str]', dry_run: bool = False,
+                 actor_pk: 'Optional[int]' = None) -> 'ImportResult':
+    """
+    CSVの志望順位を課程に登録する
+    :param course: 課程
+    :param lines: CSVの行
+    :param dry_run: Trueの場合は検証のみを行い，何も書き込まない
+    :param actor_pk: 登録を行ったユーザのpk．変更履歴に記録する
+    :return: (登録した志望順位の数, ユーザの数, エラーのリスト)
+    """
+    return RankImporter(course, actor_pk).run(lines, dry_run)
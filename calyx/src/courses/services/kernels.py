@@ -0,0 +1,136 @@
+"""
+NumPyを用いてサマリーの統計量をまとめて計算するカーネル．
+NumPyがインストールされていない環境ではis_enabled()がFalseを返し，純Pythonの実装が使われる．
+平均値は浮動小数点数の合計では丸め誤差が生じ，差分更新や純Pythonの実装と最後の桁が食い違うため，厳密な分数の合計から丸める．
+"""
+from fractions import Fraction
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+
+try:
+    import numpy as np
+except ImportError:  # pragma: no cover
+    np = None
+
+if TYPE_CHECKING:
+    from typing import Iterable, List, Optional, Tuple
+
+BACKEND_AUTO = 'auto'
+BACKEND_PYTHON = 'python'
+BACKEND_NUMPY = 'numpy'
+
+
+def is_available() -> bool:
+    return np is not None
+
+
+def is_enabled() -> bool:
+    """設定とNumPyの有無からベクトル化したカーネルを使うかどうかを決める"""
+    backend = getattr(settings, 'SUMMARY_BACKEND', BACKEND_AUTO)
+    if backend == BACKEND_PYTHON:
+        return False
+    if backend == BACKEND_NUMPY and not is_available():
+        raise ImportError("SUMMARY_BACKEND is 'numpy' but NumPy is not installed.")
+    return is_available()
+
+
+def summarize_groups(groups: 'np.ndarray', gpa: 'Optional[np.ndarray]', n_groups: int,
+                     rank_limit: int) -> 'dict':
+    """
+    グループ番号ごとにGPAの統計量を計算する
+    :param groups: 各行が属するグループの番号
+    :param gpa: 各行のGPA．Noneの場合は人数のみを数える
+    :param n_groups: グループの数
+    :param rank_limit: ボーダーラインとして何番目に高いGPAを取るか
+    :return: {'count': 配列, 'border': 配列, ...}．GPAが無いグループの統計量は0.0
+    """
+    counts = np.bincount(groups, minlength=n_groups)
+    result = {'count': counts}
+    if gpa is None:
+        return result
+    # グループの昇順，同じグループ内ではGPAの降順に並べる
+    sorted_gpa = gpa[np.lexsort((-gpa, groups))]
+    starts = np.cumsum(counts) - counts
+    nonempty = counts > 0
+    last = len(sorted_gpa) - 1
+
+    def pick(positions):
+        values = sorted_gpa[np.clip(positions, 0, max(last, 0))] if last >= 0 else np.zeros(n_groups)
+        return np.where(nonempty, values, 0.0)
+
+    # 降順でrank_limit番目，人数が足りなければ最も低いGPA
+    result['border'] = pick(starts + np.minimum(counts, rank_limit) - 1)
+    result['max'] = pick(starts)
+    result['min'] = pick(starts + counts - 1)
+    result['median'] = (pick(starts + (counts - 1) // 2) + pick(starts + counts // 2)) / 2
+    result['mean'] = exact_means(sorted_gpa, starts, counts)
+    return result
+
+
+def exact_means(sorted_gpa: 'np.ndarray', starts: 'np.ndarray', counts: 'np.ndarray') -> 'np.ndarray':
+    """
+    グループごとの平均値をstatistics.meanと同じく厳密な分数の合計から丸めて求める．GPAが無いグループは0.0
+    :param sorted_gpa: グループの昇順に並べたGPA
+    :param starts: グループごとの先頭の位置
+    :param counts: グループごとの行の数
+    """
+    means = np.zeros(len(counts))
+    values = sorted_gpa.tolist()
+    # GPAの値の種類は少ないため，分数への変換は値ごとに1度だけ行う
+    fractions = dict()
+    for group in np.flatnonzero(counts).tolist():
+        start, count = int(starts[group]), int(counts[group])
+        total = Fraction(0)
+        for value in values[start:start + count]:
+            fraction = fractions.get(value, None)
+            if fraction is None:
+                fraction = fractions[value] = Fraction(value)
+            total += fraction
+        means[group] = float(total / count)
+    return means
+
+
+def summarize_labs(labs: 'List[dict]', rows: 'Iterable[Tuple[int, int, Optional[float]]]',
+                   rank_limit: int, show_gpa: bool) -> 'List[dict]':
+    """
+    課程の全ての研究室・志望順位のサマリーを一度に計算する．make_summary_cacheと同じ形式を返す．
+    :param labs: 'pk', 'name', 'capacity'を持つ研究室のリスト
+    :param rows: (研究室のpk, 志望順位, GPA)の行．show_gpaがTrueの場合，GPA未入力の行は除いておくこと
+    :param rank_limit: 志望順位の数
+    :param show_gpa: GPAの統計量を含めるかどうか
+    """
+    lab_index = {lab['pk']: i for i, lab in enumerate(labs)}
+    # 志望順位ごとのグループに加え，順位に関係ない全体のグループを研究室ごとに1つ用意する
+    width = rank_limit + 1
+    n_groups = len(labs) * width
+    lab_idx, orders, gpa_list = [], [], []
+    for lab_pk, order, gpa in rows:
+        if lab_pk not in lab_index:
+            continue
+        lab_idx.append(lab_index[lab_pk])
+        orders.append(order)
+        gpa_list.append(gpa)
+    lab_idx = np.asarray(lab_idx, dtype=np.int64)
+    groups = np.concatenate([lab_idx * width + np.asarray(orders, dtype=np.int64), lab_idx * width + rank_limit])
+    gpa = None
+    if show_gpa:
+        gpa = np.asarray(gpa_list, dtype=np.float64)
+        gpa = np.concatenate([gpa, gpa])
+    stats = summarize_groups(groups, gpa, n_groups, rank_limit)
+    keys = ['border', 'mean', 'median', 'max', 'min'] if show_gpa else []
+    columns = {key: stats[key].reshape(len(labs), width).tolist() for key in keys + ['count']}
+
+    def fragment(i, j):
+        return {key: columns[key][i][j] for key in keys + ['count']}
+
+    summary = []
+    for i, lab in enumerate(labs):
+        summary.append({
+            'pk': lab['pk'],
+            'name': lab['name'],
+            'capacity': lab['capacity'],
+            'detail': [fragment(i, order) for order in range(rank_limit)],
+            'abstract': fragment(i, rank_limit),
+        })
+    return summary
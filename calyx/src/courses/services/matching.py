@@ -0,0 +1,314 @@
+"""
+配属の予測を差分で更新するための状態．
+全ての研究室がGPAの降順で受け入れる場合，安定なマッチングは1つに定まり，シリアルディクテイターシップの結果と一致する．
+あるユーザの志望やGPA，研究室の許容人数が変わった際は，空いた席を待機中のユーザで埋め，
+押し出されたユーザに次の志望へ応募させることで安定なマッチングに戻す．
+計算量は全体の人数ではなく，配属先が変わったユーザの数に比例する．
+"""
+import heapq
+from typing import TYPE_CHECKING
+
+from django.core.cache import cache
+
+from . import caching
+from .assignment import load_assignment_input, serial_dictatorship
+from .config import get_config_cache
+from .version import get_course_version
+
+if TYPE_CHECKING:
+    from typing import Dict, List, Optional, Sequence, Tuple
+    from courses.models import Course, Lab
+    from .assignment import AssignmentInput
+
+# 差分更新中に他のリクエストと競合した場合に待たずに諦めるためのロックの有効期限（秒）
+STATE_LOCK_TIMEOUT = 10
+
+
+def priority_key(user_pk: int, gpa: 'Optional[float]') -> tuple:
+    """小さいほど優先される．GPAの降順，未入力は最後，同じGPAではpkの昇順"""
+    return gpa is None, -(gpa or 0.0), user_pk
+
+
+def _worst_first(key: tuple) -> tuple:
+    """priority_keyの順序を逆にする"""
+    return not key[0], -key[1], -key[2]
+
+
+class AssignmentState(object):
+    """
+    課程の配属の状態．研究室ごとに配属されたユーザを優先順位の低い順に，
+    その研究室を現在の配属先より志望しているユーザを優先順位の高い順にヒープで保持する．
+    ヒープからの削除は行わず，取り出す際に現在の状態と一致するかを確かめる
+    """
+
+    def __init__(self, lab_pks: 'Sequence[int]', capacity: 'Sequence[int]'):
+        self.lab_pks = list(lab_pks)
+        self.lab_index = {lab_pk: i for i, lab_pk in enumerate(self.lab_pks)}
+        self.capacity = list(capacity)
+        self.counts = [0] * len(self.lab_pks)
+        # 研究室ごとの(優先順位の逆順, ユーザのpk, 提出の番号)のヒープ
+        self.holders = [[] for _ in self.lab_pks]  # type: List[List[Tuple[tuple, int, int]]]
+        # 研究室ごとの(優先順位, ユーザのpk, 提出の番号)のヒープ
+        self.waiting = [[] for _ in self.lab_pks]  # type: List[List[Tuple[tuple, int, int]]]
+        # user_pk -> [研究室の番号の志望順のリスト, 優先順位, 配属先の番号, GPA, 提出の番号]
+        self.users = dict()  # type: Dict[int, list]
+        self._serial = 0
+        # 更新中に配属先を変えたユーザの更新前の配属先
+        self._before = dict()  # type: Dict[int, int]
+        # 状態に対応する課程のバージョン
+        self.version = 0
+
+    @classmethod
+    def from_input(cls, data: 'AssignmentInput') -> 'AssignmentState':
+        """シリアルディクテイターシップで全体を配属して状態を構築する"""
+        state = cls(data.lab_pks, data.capacity)
+        assigned = serial_dictatorship(data.prefs, data.gpa, data.capacity)
+        for user_pk, prefs, gpa, lab in zip(data.user_pks, data.prefs, data.gpa, assigned):
+            state._register(user_pk, prefs, gpa)
+            if lab >= 0:
+                state._assign(user_pk, lab)
+            state._wait_above(user_pk, lab)
+        return state
+
+    @classmethod
+    def from_course(cls, course: 'Course') -> 'AssignmentState':
+        return cls.from_input(load_assignment_input(course))
+
+    def _register(self, user_pk: int, prefs: 'Sequence[int]', gpa: 'Optional[float]'):
+        self._serial += 1
+        self.users[user_pk] = [list(prefs), priority_key(user_pk, gpa), -1, gpa, self._serial]
+
+    def _position(self, user: list, lab: int) -> int:
+        """志望の中での研究室の位置．配属されていなければ志望の数"""
+        return user[0].index(lab) if lab >= 0 else len(user[0])
+
+    def _touch(self, user_pk: int):
+        self._before.setdefault(user_pk, self.users[user_pk][2])
+
+    def _count_moved(self) -> int:
+        """更新の前後で配属先が変わったユーザの数を数え，記録を消す"""
+        moved = sum(
+            1 for user_pk, lab in self._before.items()
+            if user_pk in self.users and self.users[user_pk][2] != lab
+        )
+        self._before = dict()
+        return moved
+
+    def _assign(self, user_pk: int, lab: int):
+        user = self.users[user_pk]
+        user[2] = lab
+        self.counts[lab] += 1
+        heapq.heappush(self.holders[lab], (_worst_first(user[1]), user_pk, user[4]))
+
+    def _wait_above(self, user_pk: int, lab: int):
+        """配属先より上位の志望の研究室で待機させる"""
+        user = self.users[user_pk]
+        for above in user[0][:self._position(user, lab)]:
+            if above >= 0:
+                heapq.heappush(self.waiting[above], (user[1], user_pk, user[4]))
+
+    def _is_holder(self, lab: int, user_pk: int, serial: int) -> bool:
+        user = self.users.get(user_pk, None)
+        return user is not None and user[4] == serial and user[2] == lab
+
+    def _is_waiting(self, lab: int, user_pk: int, serial: int) -> bool:
+        user = self.users.get(user_pk, None)
+        if user is None or user[4] != serial:
+            return False
+        # 現在の配属先より上位の志望であれば待機中
+        return lab in user[0] and user[0].index(lab) < self._position(user, user[2])
+
+    def _peek_worst(self, lab: int) -> 'Optional[int]':
+        heap = self.holders[lab]
+        while heap and not self._is_holder(lab, heap[0][1], heap[0][2]):
+            heapq.heappop(heap)
+        return heap[0][1] if heap else None
+
+    def _pop_waiting(self, lab: int) -> 'Optional[int]':
+        heap = self.waiting[lab]
+        while heap:
+            _, user_pk, serial = heapq.heappop(heap)
+            if self._is_waiting(lab, user_pk, serial):
+                return user_pk
+        return None
+
+    def _fill(self, labs: 'List[int]'):
+        """空きのある研究室を，その研究室を志望して待機している優先順位の高いユーザで埋める"""
+        while labs:
+            lab = labs.pop()
+            while self.counts[lab] < self.capacity[lab]:
+                user_pk = self._pop_waiting(lab)
+                if user_pk is None:
+                    break
+                self._touch(user_pk)
+                old = self.users[user_pk][2]
+                if old >= 0:
+                    self.counts[old] -= 1
+                    labs.append(old)
+                self._assign(user_pk, lab)
+
+    def _propose(self, user_pk: int, start: int):
+        """志望のstart番目から順に応募させる．押し出されたユーザも続けて応募させる"""
+        queue = [(user_pk, start)]
+        while queue:
+            user_pk, start = queue.pop()
+            user = self.users[user_pk]
+            for position in range(start, len(user[0])):
+                lab = user[0][position]
+                if lab < 0:
+                    continue
+                if self.counts[lab] < self.capacity[lab]:
+                    self._assign(user_pk, lab)
+                    break
+                worst = self._peek_worst(lab)
+                if worst is not None and user[1] < self.users[worst][1]:
+                    # 優先順位の最も低いユーザを押し出す
+                    heapq.heappop(self.holders[lab])
+                    self._touch(worst)
+                    self.users[worst][2] = -1
+                    self.counts[lab] -= 1
+                    self._assign(user_pk, lab)
+                    heapq.heappush(self.waiting[lab], (self.users[worst][1], worst, self.users[worst][4]))
+                    queue.append((worst, self.users[worst][0].index(lab) + 1))
+                    break
+                heapq.heappush(self.waiting[lab], (user[1], user_pk, user[4]))
+
+    def remove_user(self, user_pk: int):
+        """ユーザを取り除き，空いた席を埋める"""
+        user = self.users.pop(user_pk, None)
+        if user is not None and user[2] >= 0:
+            self.counts[user[2]] -= 1
+            self._fill([user[2]])
+
+    def update_user(self, user_pk: int, gpa: 'Optional[float]',
+                    lab_pks: 'Optional[Sequence[Optional[int]]]' = None) -> int:
+        """
+        ユーザのGPAや志望を差し替えて配属を修復する
+        :param user_pk: ユーザのpk
+        :param gpa: 現在のGPA
+        :param lab_pks: 志望順に並べた研究室のpk．Noneの場合は以前の志望のまま
+        :return: 配属先が変わったユーザの数
+        """
+        if lab_pks is None:
+            if user_pk not in self.users:
+                # 志望を提出していないユーザは配属に影響しない
+                return 0
+            prefs = self.users[user_pk][0]
+        else:
+            prefs = [self.lab_index.get(lab_pk, -1) for lab_pk in lab_pks]
+        self._before[user_pk] = self.users[user_pk][2] if user_pk in self.users else -1
+        self.remove_user(user_pk)
+        self._register(user_pk, prefs, gpa)
+        self._propose(user_pk, 0)
+        return self._count_moved()
+
+    def set_capacity(self, lab_pk: int, capacity: int) -> int:
+        """
+        研究室の許容人数を変えて配属を修復する
+        :return: 配属先が変わったユーザの数
+        """
+        lab = self.lab_index.get(lab_pk, None)
+        if lab is None:
+            return 0
+        self.capacity[lab] = max(capacity, 0)
+        displaced = []
+        while self.counts[lab] > self.capacity[lab]:
+            worst = self._peek_worst(lab)
+            heapq.heappop(self.holders[lab])
+            self._touch(worst)
+            self.users[worst][2] = -1
+            self.counts[lab] -= 1
+            displaced.append(worst)
+        for user_pk in displaced:
+            user = self.users[user_pk]
+            heapq.heappush(self.waiting[lab], (user[1], user_pk, user[4]))
+            self._propose(user_pk, user[0].index(lab) + 1)
+        self._fill([lab])
+        return self._count_moved()
+
+    def assigned_labs(self) -> 'Dict[int, Optional[int]]':
+        """ユーザのpk -> 配属先の研究室のpk"""
+        return {user_pk: self.lab_pks[user[2]] if user[2] >= 0 else None for user_pk, user in self.users.items()}
+
+    def to_result(self, mechanism: str) -> dict:
+        """simulate_assignmentと同じ形式の結果を返す"""
+        lowest = [None] * len(self.lab_pks)  # type: List[Optional[float]]
+        for user in self.users.values():
+            lab, gpa = user[2], user[3]
+            if lab >= 0 and gpa is not None and (lowest[lab] is None or gpa < lowest[lab]):
+                lowest[lab] = gpa
+        return {
+            'mechanism': mechanism,
+            'labs': [
+                {
+                    'pk': lab_pk, 'capacity': self.capacity[i], 'count': self.counts[i],
+                    'cutoff': lowest[i] if self.counts[i] >= self.capacity[i] else None
+                } for i, lab_pk in enumerate(self.lab_pks)
+            ],
+            'users': self.assigned_labs(),
+        }
+
+
+def _state_key(course_pk: int) -> str:
+    return f'course-assignment-state-{course_pk}'
+
+
+def get_assignment_state(course: 'Course') -> 'AssignmentState':
+    """課程の現在のバージョンに対応する配属の状態を返す．無ければ全体を配属して作る"""
+    version = get_course_version(course.pk).version
+    state = cache.get(_state_key(course.pk), None)
+    if state is None or state.version != version:
+        state = AssignmentState.from_course(course)
+        state.version = version
+        cache.set(_state_key(course.pk), state, caching.get_hard_ttl())
+    return state
+
+
+def _apply_to_state(course_pk: int, apply) -> 'Optional[int]':
+    """
+    キャッシュ上の配属の状態に差分を適用する．課程のバージョンを上げた後に呼び出すこと．
+    状態が1つ前のバージョンのものでなければ，他の変更を取りこぼしているため破棄し，次の読み出しで全体を配属させる
+    :return: 配属先が変わったユーザの数．状態を破棄した場合はNone
+    """
+    key = _state_key(course_pk)
+    lock_key = f'{key}-lock'
+    if not cache.add(lock_key, True, STATE_LOCK_TIMEOUT):
+        cache.delete(key)
+        return None
+    try:
+        state = cache.get(key, None)
+        version = get_course_version(course_pk).version
+        if state is None or state.version != version - 1:
+            cache.delete(key)
+            return None
+        moved = apply(state)
+        state.version = version
+        cache.set(key, state, caching.get_hard_ttl())
+        return moved
+    finally:
+        cache.delete(lock_key)
+
+
+def update_assignment_for_user(course: 'Course', user, labs: 'Optional[Sequence[Optional[int]]]' = None):
+    """
+    あるユーザの志望またはGPAが変わったときに配属を差分更新する
+    :param course: 課程
+    :param user: 志望を提出した，またはGPAを変更したユーザ
+    :param labs: 志望順に並べた研究室のpk．GPAのみが変わった場合はNone
+    """
+    if labs is not None:
+        rank_limit = get_config_cache(course.pk)['rank_limit']
+        labs = list(labs)[:rank_limit] + [None] * (rank_limit - len(labs))
+    return _apply_to_state(course.pk, lambda state: state.update_user(user.pk, user.gpa, labs))
+
+
+def update_assignment_for_capacity(lab: 'Lab'):
+    """研究室の許容人数が変わったときに配属を差分更新する"""
+    return _apply_to_state(lab.course_id, lambda state: state.set_capacity(lab.pk, lab.capacity))
+
+
+def update_assignment_for_capacities(course_pk: int, capacities: 'Dict[int, int]'):
+    """複数の研究室の許容人数をまとめて変えたときに配属を差分更新する"""
+    return _apply_to_state(
+        course_pk, lambda state: sum(state.set_capacity(lab_pk, capacity) for lab_pk, capacity in capacities.items())
+    )
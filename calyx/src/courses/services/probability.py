@@ -0,0 +1,119 @@
+"""
+モンテカルロ法による研究室ごとの配属確率の推定．
+GPA未入力のユーザのGPAと，志望順位をまだ提出していないユーザの志望順位を課程で観測された値から抽出し，
+配属のシミュレーションを繰り返して，提出済みのユーザが各研究室に配属された割合を数える．
+シミュレーションはプロセスプールで並列に実行し，結果は課程のバージョンとともにDB（ProbabilityTable）に保存する．
+推定はestimate_probabilitiesコマンドからのみ行い，リクエストの処理中には保存された結果を読み出すだけとする．
+"""
+import json
+import random
+from concurrent.futures import ProcessPoolExecutor
+from typing import TYPE_CHECKING
+
+import django
+from django.conf import settings
+
+from courses.models import Course, ProbabilityTable
+from .assignment import load_assignment_input, serial_dictatorship
+from .snapshot import get_course_snapshot
+from .version import get_course_version
+
+if TYPE_CHECKING:
+    from typing import List, Optional, Sequence
+
+# 同じGPAのユーザの順序を試行ごとに入れ替えるための揺らぎ．GPAの刻み（0.01）より十分小さくする
+TIE_BREAK_NOISE = 1e-6
+
+
+def get_trials() -> int:
+    return getattr(settings, 'PROBABILITY_TRIALS', 200)
+
+
+def get_workers() -> int:
+    return getattr(settings, 'PROBABILITY_WORKERS', 2)
+
+
+def run_trials(prefs: 'List[List[int]]', gpa: 'List[Optional[float]]', capacity: 'List[int]',
+               gpa_pool: 'Sequence[float]', rank_pool: 'Sequence[List[int]]', n_pending: int,
+               trials: int, seed: int) -> 'List[int]':
+    """
+    配属のシミュレーションを繰り返す．プロセスプールから呼び出すため，DBにはアクセスしない
+    :param prefs: 提出済みのユーザの志望順位の行列
+    :param gpa: 提出済みのユーザのGPA．Noneの場合はgpa_poolから抽出する
+    :param capacity: 研究室ごとの許容人数
+    :param gpa_pool: 課程で観測されたGPA
+    :param rank_pool: 課程で観測された志望順位
+    :param n_pending: 志望順位を提出していないユーザの数
+    :param trials: 試行回数
+    :param seed: 乱数のシード
+    :return: ユーザ×志望順位ごとに，その志望に配属された回数（平坦化したリスト）
+    """
+    rng = random.Random(seed)
+    n_users = len(prefs)
+    width = len(prefs[0]) if prefs else 0
+    counts = [0] * (n_users * width)
+    for _ in range(trials):
+        trial_gpa = [rng.choice(gpa_pool) if value is None and gpa_pool else value for value in gpa]
+        trial_prefs = prefs
+        if n_pending and rank_pool:
+            trial_prefs = prefs + [rng.choice(rank_pool) for _ in range(n_pending)]
+            trial_gpa += [rng.choice(gpa_pool) if gpa_pool else None for _ in range(n_pending)]
+        trial_gpa = [value + rng.uniform(0, TIE_BREAK_NOISE) if value is not None else None for value in trial_gpa]
+        assigned = serial_dictatorship(trial_prefs, trial_gpa, capacity)
+        for i in range(n_users):
+            if assigned[i] >= 0:
+                counts[i * width + prefs[i].index(assigned[i])] += 1
+    return counts
+
+
+def estimate_probabilities(course: 'Course', trials: 'Optional[int]' = None, seed: int = 0) -> dict:
+    """
+    課程の配属確率を推定してDBに保存する．時間がかかりプロセスを起動するため，リクエストの処理中には呼び出さないこと
+    :return: {'version': 課程のバージョン, 'trials': 試行回数, 'users': {ユーザのpk: {研究室のpk: 確率}}}
+    """
+    trials = trials or get_trials()
+    version = get_course_version(course.pk).version
+    data = load_assignment_input(course)
+    snapshot = get_course_snapshot(course.pk)
+    gpa_pool = snapshot.gpa_values()
+    n_pending = len(snapshot) - len(data.user_pks)
+    args = (data.prefs, data.gpa, data.capacity, gpa_pool, data.prefs, n_pending)
+    workers = get_workers()
+    if workers <= 0:
+        counts = run_trials(*args, trials, seed)
+    else:
+        # 試行を分割し，それぞれ異なるシードで実行する
+        chunks = [trials // workers + (1 if i < trials % workers else 0) for i in range(workers)]
+        # spawnで起動したプロセスでもモデルを読み込めるよう，Djangoを初期化する
+        with ProcessPoolExecutor(max_workers=workers, initializer=django.setup) as pool:
+            futures = [pool.submit(run_trials, *args, chunk, seed + i) for i, chunk in enumerate(chunks) if chunk]
+            results = [future.result() for future in futures]
+        counts = [sum(values) for values in zip(*results)]
+    width = len(data.prefs[0]) if data.prefs else 0
+    users = dict()
+    for i, user_pk in enumerate(data.user_pks):
+        users[user_pk] = {
+            data.lab_pks[lab]: round(counts[i * width + order] / trials, 4)
+            for order, lab in enumerate(data.prefs[i]) if lab >= 0 and counts[i * width + order]
+        }
+    ProbabilityTable.objects.update_or_create(course=course, defaults={
+        'version': version, 'trials': trials, 'payload': json.dumps(users, separators=(',', ':')),
+    })
+    return {'version': version, 'trials': trials, 'users': users}
+
+
+def get_probabilities(course: 'Course') -> 'Optional[dict]':
+    """
+    保存された配属確率を返す．課程のバージョンが変わっていれば'stale'を付けて返す．再計算はしない
+    :return: estimate_probabilitiesの結果に'stale'を加えたもの．まだ推定されていなければNone
+    """
+    table = ProbabilityTable.objects.filter(course=course).first()
+    if table is None:
+        return None
+    # JSONのキーは文字列になるため，pkに戻す
+    users = {
+        int(user_pk): {int(lab_pk): value for lab_pk, value in labs.items()}
+        for user_pk, labs in json.loads(table.payload).items()
+    }
+    version = get_course_version(course.pk).version
+    return {'version': table.version, 'trials': table.trials, 'users': users, 'stale': table.version != version}
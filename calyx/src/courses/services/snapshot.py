@@ -0,0 +1,159 @@
+"""
+課程ごとの列指向のスナップショット．参加者のpk，GPA，表示名の有無，提出した志望順位の数，
+参加者×志望順位の研究室の番号の行列と研究室のpk，許容人数をarrayの列として保持する．
+Modelのインスタンスを作らずに参加者と志望順位をまとめて読み込み，課程のバージョンをキーに含めてキャッシュするため，
+サマリー，ステータス，配属のシミュレーションで同じスナップショットを共有できる．
+キーにはバージョンを上げた日時も含め，トランザクションが取り消されて同じバージョンが再び使われても古いスナップショットを返さない．
+"""
+from array import array
+from bisect import bisect_left
+from math import isnan
+from typing import TYPE_CHECKING
+
+from django.contrib.auth import get_user_model
+from django.db.models import FilteredRelation, Q
+
+from courses.models import Lab
+from . import caching
+from .config import get_config_cache
+from .version import CourseVersion, get_course_version
+
+if TYPE_CHECKING:
+    from typing import Iterator, List, Optional, Sequence, Tuple
+
+User = get_user_model()
+
+# 志望順位の行列の値．0以上は研究室の番号
+NO_RANK = -1  # 志望順位を提出していない
+NO_LAB = -2  # 志望順位はあるが研究室が無い
+
+NAN = float('nan')
+
+
+class CourseSnapshot(object):
+    """
+    課程の参加者と志望順位の列指向のスナップショット．参加者はpkの昇順，研究室はpkの昇順に並べる．
+    GPAは未入力をNaNとした倍精度の浮動小数点数で保持し，DBの値と同じ比較・集計結果になるようにする
+    """
+
+    def __init__(self, course_pk: int, version: int, rank_limit: int, lab_pks: 'Sequence[int]',
+                 lab_names: 'Sequence[str]', capacity: 'Sequence[int]'):
+        self.course_pk = course_pk
+        self.version = version
+        self.rank_limit = rank_limit
+        self.lab_pks = array('q', lab_pks)
+        # 研究室の名前はサマリーにのみ使う
+        self.lab_names = list(lab_names)
+        self.capacity = array('i', capacity)
+        self.user_pks = array('q')
+        self.gpa = array('d')
+        # 表示名が入力されていれば1
+        self.screen_name = array('b')
+        # 課程に提出した志望順位の行の数．志望順位の上限を超えた行も数える
+        self.rank_counts = array('h')
+        # 参加者×志望順位の研究室の番号を行優先で並べた行列
+        self.ranks = array('h')
+
+    @classmethod
+    def load(cls, course_pk: int, version: int = 0) -> 'CourseSnapshot':
+        """研究室と，参加者とその志望順位をそれぞれ1回のクエリで読み込む"""
+        rank_limit = get_config_cache(course_pk)['rank_limit']
+        labs = list(Lab.objects.filter(course_id=course_pk).order_by('pk').values_list('pk', 'name', 'capacity'))
+        snapshot = cls(course_pk, version, rank_limit, [lab_pk for lab_pk, _, _ in labs],
+                       [name for _, name, _ in labs], [capacity for _, _, capacity in labs])
+        lab_index = {lab_pk: i for i, lab_pk in enumerate(snapshot.lab_pks)}
+        # 志望順位を提出していない参加者も含めるため，課程の志望順位に絞った外部結合とする
+        rows = User.objects.filter(courses__pk=course_pk) \
+            .annotate(course_rank=FilteredRelation('rank', condition=Q(rank__course_id=course_pk))) \
+            .order_by('pk').values_list('pk', 'gpa', 'screen_name', 'course_rank__order', 'course_rank__lab_id')
+        for user_pk, gpa, screen_name, order, lab_pk in rows.iterator():
+            if not snapshot.user_pks or snapshot.user_pks[-1] != user_pk:
+                snapshot._append_user(user_pk, gpa, screen_name)
+            if order is None:
+                continue
+            snapshot.rank_counts[-1] += 1
+            if 0 <= order < rank_limit:
+                offset = (len(snapshot.user_pks) - 1) * rank_limit
+                snapshot.ranks[offset + order] = lab_index.get(lab_pk, NO_LAB)
+        return snapshot
+
+    def _append_user(self, user_pk: int, gpa: 'Optional[float]', screen_name: 'Optional[str]'):
+        self.user_pks.append(user_pk)
+        self.gpa.append(NAN if gpa is None else gpa)
+        self.screen_name.append(1 if screen_name else 0)
+        self.rank_counts.append(0)
+        self.ranks.extend([NO_RANK] * self.rank_limit)
+
+    def __len__(self) -> int:
+        return len(self.user_pks)
+
+    @property
+    def nbytes(self) -> int:
+        """列の合計のバイト数"""
+        columns = (self.lab_pks, self.capacity, self.user_pks, self.gpa, self.screen_name, self.rank_counts,
+                   self.ranks)
+        return sum(column.itemsize * len(column) for column in columns)
+
+    def labs(self) -> 'List[dict]':
+        """研究室の{'pk', 'name', 'capacity'}のリスト"""
+        return [
+            {'pk': lab_pk, 'name': name, 'capacity': capacity}
+            for lab_pk, name, capacity in zip(self.lab_pks, self.lab_names, self.capacity)
+        ]
+
+    def index(self, user_pk: int) -> int:
+        """参加者の行の番号．参加していなければ-1"""
+        i = bisect_left(self.user_pks, user_pk)
+        return i if i < len(self.user_pks) and self.user_pks[i] == user_pk else -1
+
+    def get_gpa(self, i: int) -> 'Optional[float]':
+        value = self.gpa[i]
+        return None if isnan(value) else value
+
+    def get_ranks(self, i: int) -> 'array':
+        """参加者の志望順に並べた研究室の番号"""
+        return self.ranks[i * self.rank_limit:(i + 1) * self.rank_limit]
+
+    def has_ranks(self, i: int) -> bool:
+        """志望順位の上限までに1つでも志望順位の行があるか"""
+        return any(lab != NO_RANK for lab in self.get_ranks(i))
+
+    def gpa_values(self) -> 'List[float]':
+        """入力済みのGPAのリスト"""
+        return [value for value in self.gpa if not isnan(value)]
+
+    def iter_submitted(self) -> 'Iterator[Tuple[int, Optional[float], array]]':
+        """志望順位のある参加者の(pk, GPA, 研究室の番号)を順に返す"""
+        for i, user_pk in enumerate(self.user_pks):
+            if self.has_ranks(i):
+                yield user_pk, self.get_gpa(i), self.get_ranks(i)
+
+    def rank_rows(self, show_gpa: bool) -> 'List[Tuple[int, int, Optional[float]]]':
+        """
+        研究室のある全ての志望順位
+        :param show_gpa: Trueの場合はGPA未入力の参加者を省く
+        :return: [(研究室のpk, 志望順位, GPA), ...]
+        """
+        rows = []
+        for _, gpa, labs in self.iter_submitted():
+            if show_gpa and gpa is None:
+                continue
+            rows.extend((self.lab_pks[lab], order, gpa) for order, lab in enumerate(labs) if lab >= 0)
+        return rows
+
+
+def _snapshot_key(course_pk: int, course_version: 'CourseVersion') -> str:
+    updated_at = course_version.updated_at.timestamp() if course_version.updated_at is not None else 0
+    return f'course-snapshot-{course_pk}-{course_version.version}-{updated_at}'
+
+
+def get_course_snapshot(course_pk: int) -> 'CourseSnapshot':
+    """課程のバージョンをキーに含めてキャッシュしたスナップショットを返す"""
+    course_version = get_course_version(course_pk)
+    return caching.get_or_compute(_snapshot_key(course_pk, course_version),
+                                  lambda: CourseSnapshot.load(course_pk, course_version.version))
+
+
+def get_cached_snapshot(course_pk: int) -> 'Optional[CourseSnapshot]':
+    """現在のバージョンのスナップショットがキャッシュされていれば返す．無ければ読み込まずにNoneを返す"""
+    return caching.get_value(_snapshot_key(course_pk, get_course_version(course_pk)))
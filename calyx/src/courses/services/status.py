@@ -3,6 +3,7 @@ from typing import TYPE_CHECKING
 from django.contrib.auth import get_user_model
 
 from .config import get_config_cache
+from .snapshot import get_cached_snapshot
 
 if TYPE_CHECKING:
     from users.models import User as AppUser
@@ -30,8 +31,18 @@ class Status(object):
 
     @classmethod
     def from_user_instance(cls, user, course_pk: int) -> 'Status':
+        """
+        参加の有無と提出した志望順位の数は，現在のバージョンの課程のスナップショットがキャッシュされていればそこから，
+        無ければユーザごとのクエリで求める．ステータスのために課程全体を読み込むことはしない．GPAと表示名はインスタンスから求める
+        """
         status = cls()
-        if not user.courses.filter(pk=course_pk).exists():
+        snapshot = get_cached_snapshot(course_pk)
+        if snapshot is not None:
+            i = snapshot.index(user.pk)
+            joined = i >= 0
+        else:
+            joined = user.courses.filter(pk=course_pk).exists()
+        if not joined:
             status._type = cls.PENDING
             return status.set_false_all()
         config = get_config_cache(course_pk)
@@ -41,7 +52,11 @@ class Status(object):
         if config['show_username']:
             if user.screen_name is None or user.screen_name == "":
                 status.screen_name = False
-        if config['rank_limit'] != user.rank_set.filter(course_id=course_pk).count():
+        if snapshot is not None:
+            rank_count = snapshot.rank_counts[i]
+        else:
+            rank_count = user.rank_set.filter(course_id=course_pk).count()
+        if config['rank_limit'] != rank_count:
             status.rank_submitted = False
         return status
 
@@ -0,0 +1,377 @@
+import time
+import uuid
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from fractions import Fraction
+from typing import TYPE_CHECKING
+
+from django.core.cache import cache
+
+from courses.models import Course, Lab, Rank
+from . import caching
+from .config import get_config_cache
+from .snapshot import CourseSnapshot
+from .summary import get_debounce_seconds, is_summary_stale, mark_summary_stale, save_summary, _rebuild_summary
+
+if TYPE_CHECKING:
+    from typing import Callable, List, Dict, Optional, Sequence, Set, Tuple
+
+# 差分更新中のロックの有効期限（秒）
+STORE_LOCK_TIMEOUT = 10
+# 他のリクエストが差分を適用中の場合にロックを待つ最大の時間（秒）
+STORE_LOCK_WAIT = 2
+
+
+class GPAMultiset(object):
+    """
+    ある研究室・志望順位に集まったGPAを昇順に保持する多重集合．
+    追加・削除は二分探索で位置を求め，平均値のために合計を厳密な分数で保持する．
+    """
+
+    def __init__(self):
+        self.values = []  # type: List[float]
+        self.total = Fraction(0)
+        # GPA未入力のユーザも含めた志望人数
+        self.count = 0
+
+    def add(self, gpa: 'Optional[float]'):
+        self.count += 1
+        if gpa is None:
+            return
+        insort(self.values, gpa)
+        self.total += Fraction(gpa)
+
+    def remove(self, gpa: 'Optional[float]'):
+        """GPAを1つ取り除く．含まれていない場合はKeyErrorをraiseする"""
+        if self.count <= 0:
+            raise KeyError(gpa)
+        if gpa is not None:
+            index = bisect_left(self.values, gpa)
+            if index >= len(self.values) or self.values[index] != gpa:
+                raise KeyError(gpa)
+            del self.values[index]
+            self.total -= Fraction(gpa)
+        self.count -= 1
+
+    def summarize(self, rank_limit: int, show_gpa: bool) -> 'Dict[str, float]':
+        """Summary._make_summaryと同じ形式のサマリーを保持している値から生成する"""
+        summary = dict()
+        if show_gpa:
+            values = self.values
+            length = len(values)
+            # 降順でrank_limit番目の値がボーダーライン
+            if length < rank_limit:
+                summary['border'] = values[0] if length > 0 else 0.0
+            else:
+                summary['border'] = values[length - rank_limit]
+            if length > 0:
+                # statistics.meanと同様に厳密な合計から丸める
+                summary['mean'] = float(self.total / length)
+                half = length // 2
+                if length % 2 == 1:
+                    summary['median'] = values[half]
+                else:
+                    summary['median'] = (values[half - 1] + values[half]) / 2
+                summary['max'] = values[-1]
+                summary['min'] = values[0]
+            else:
+                summary['mean'], summary['median'], summary['max'], summary['min'] = 0.0, 0.0, 0.0, 0.0
+            summary['count'] = length
+        else:
+            summary['count'] = self.count
+        return summary
+
+
+class SummaryStore(object):
+    """
+    課程のサマリーを差分更新するためのストア．
+    ユーザごとの提出内容と研究室・志望順位ごとのGPAの多重集合を保持し，
+    ある学生の志望やGPAが変わった際はその学生が関わる研究室のみを再集計する．
+    """
+
+    def __init__(self, config: 'dict'):
+        self.rank_limit = config.get('rank_limit')
+        self.show_gpa = config.get('show_gpa')
+        # lab_pk -> {'pk', 'name', 'capacity'}
+        self.labs = OrderedDict()  # type: Dict[int, dict]
+        # (lab_pk, order) -> 多重集合．orderがNoneのものは順位に関係ない全体の集合
+        self.multisets = dict()  # type: Dict[Tuple[int, Optional[int]], GPAMultiset]
+        # user_pk -> (GPA, 志望順に並べた研究室のpk)
+        self.users = dict()  # type: Dict[int, Tuple[Optional[float], Tuple[Optional[int], ...]]]
+        # lab_pk -> サマリー
+        self.summaries = dict()  # type: Dict[int, dict]
+        # ストアの内容に対応するサマリーのバージョン
+        self.version = 0
+        # キャッシュ上の研究室ごとのキーを作り直す度に変わる識別子
+        self.generation = uuid.uuid4().hex
+
+    @classmethod
+    def from_course(cls, course: 'Course') -> 'SummaryStore':
+        """課程のスナップショットを読み込んでストアを構築する．load_rank_rowsと同様にキャッシュは使わない"""
+        store = cls(get_config_cache(course.pk))
+        snapshot = CourseSnapshot.load(course.pk)
+        for lab in snapshot.labs():
+            store.add_lab(lab)
+        for user_pk, gpa, labs in snapshot.iter_submitted():
+            store._add_user(user_pk, gpa, tuple(snapshot.lab_pks[lab] if lab >= 0 else None for lab in labs))
+        for lab_pk in store.labs.keys():
+            store._summarize_lab(lab_pk)
+        return store
+
+    def add_lab(self, lab: 'dict'):
+        self.labs[lab['pk']] = dict(lab)
+        self.multisets[(lab['pk'], None)] = GPAMultiset()
+        for order in range(self.rank_limit):
+            self.multisets[(lab['pk'], order)] = GPAMultiset()
+
+    def _add_user(self, user_pk: int, gpa: 'Optional[float]', labs: 'Tuple[Optional[int], ...]'):
+        self.users[user_pk] = (gpa, labs)
+        for order, lab_pk in enumerate(labs):
+            if lab_pk not in self.labs:
+                continue
+            self.multisets[(lab_pk, order)].add(gpa)
+            self.multisets[(lab_pk, None)].add(gpa)
+
+    def update_user(self, user_pk: int, gpa: 'Optional[float]',
+                    labs: 'Optional[Sequence[Optional[int]]]' = None) -> 'Set[int]':
+        """
+        ユーザのGPAや志望を差し替える．GPAが変わらなければ志望が変わった順位のみを入れ替える．
+        :param user_pk: ユーザのプライマリキー
+        :param gpa: 現在のGPA
+        :param labs: 志望順に並べた研究室のpk．Noneの場合は以前の志望のまま
+        :return: 再集計した研究室のpkの集合
+        """
+        if gpa is not None:
+            gpa = float(gpa)
+        old_gpa, old_labs = self.users.get(user_pk, (None, (None,) * self.rank_limit))
+        if labs is None:
+            if user_pk not in self.users:
+                # 志望を提出していないユーザのGPAはサマリーに影響しない
+                return set()
+            labs = old_labs
+        labs = tuple(labs)[:self.rank_limit]
+        labs += (None,) * (self.rank_limit - len(labs))
+        touched = set()
+        for order, (old_lab_pk, lab_pk) in enumerate(zip(old_labs, labs)):
+            if old_lab_pk == lab_pk and old_gpa == gpa:
+                continue
+            if old_lab_pk in self.labs:
+                self.multisets[(old_lab_pk, order)].remove(old_gpa)
+                self.multisets[(old_lab_pk, None)].remove(old_gpa)
+                touched.add(old_lab_pk)
+            if lab_pk in self.labs:
+                self.multisets[(lab_pk, order)].add(gpa)
+                self.multisets[(lab_pk, None)].add(gpa)
+                touched.add(lab_pk)
+        self.users[user_pk] = (gpa, labs)
+        for lab_pk in touched:
+            self._summarize_lab(lab_pk)
+        return touched
+
+    def set_capacity(self, lab_pk: int, capacity: int) -> 'Set[int]':
+        if lab_pk not in self.labs:
+            return set()
+        self.labs[lab_pk]['capacity'] = capacity
+        self.summaries[lab_pk]['capacity'] = capacity
+        return {lab_pk}
+
+    def _summarize_lab(self, lab_pk: int):
+        summary_per_lab = dict(self.labs[lab_pk])
+        summary_per_lab['detail'] = [
+            self.multisets[(lab_pk, order)].summarize(self.rank_limit, self.show_gpa)
+            for order in range(self.rank_limit)
+        ]
+        summary_per_lab['abstract'] = self.multisets[(lab_pk, None)].summarize(self.rank_limit, self.show_gpa)
+        self.summaries[lab_pk] = summary_per_lab
+
+    def to_summary(self) -> 'List[dict]':
+        """get_summaryと同じ形式のサマリーを返す"""
+        return [self.summaries[lab_pk] for lab_pk in self.labs.keys()]
+
+    def save_to_cache(self, course_pk: int, lab_pks: 'Optional[Set[int]]' = None):
+        """
+        ストアをキャッシュに書き込む．差分の適用でストア全体を読み書きしないよう，研究室ごとに別のキーとする．
+        ユーザごとの提出内容はキャッシュせず，差分を適用する際に呼び出し元から受け取る
+        :param lab_pks: 書き込む研究室のpk．Noneの場合は全ての研究室
+        """
+        entries = {
+            _lab_key(course_pk, self.generation, lab_pk): (
+                self.labs[lab_pk],
+                [self.multisets[(lab_pk, order)] for order in list(range(self.rank_limit)) + [None]],
+                self.summaries[lab_pk],
+            )
+            for lab_pk in (self.labs.keys() if lab_pks is None else lab_pks)
+        }
+        cache.set_many(entries, caching.get_hard_ttl())
+        meta = {
+            'generation': self.generation,
+            'version': self.version,
+            'rank_limit': self.rank_limit,
+            'show_gpa': self.show_gpa,
+            'lab_pks': list(self.labs.keys()),
+        }
+        cache.set(_store_key(course_pk), meta, caching.get_hard_ttl())
+
+    @classmethod
+    def load_from_cache(cls, course_pk: int, lab_pks: 'Set[Optional[int]]') -> 'Optional[SummaryStore]':
+        """
+        指定された研究室のみを含むストアをキャッシュから読み出す．課程に無い研究室は無視する
+        :return: ストア．キャッシュに無い研究室があればNone
+        """
+        meta = cache.get(_store_key(course_pk), None)
+        if meta is None:
+            return None
+        store = cls({'rank_limit': meta['rank_limit'], 'show_gpa': meta['show_gpa']})
+        store.generation = meta['generation']
+        store.version = meta['version']
+        keys = {
+            _lab_key(course_pk, store.generation, lab_pk): lab_pk
+            for lab_pk in meta['lab_pks'] if lab_pk in lab_pks
+        }
+        entries = cache.get_many(keys.keys())
+        if len(entries) != len(keys):
+            return None
+        for key, lab_pk in keys.items():
+            lab, multisets, summary_per_lab = entries[key]
+            store.labs[lab_pk] = lab
+            for order, multiset in zip(list(range(store.rank_limit)) + [None], multisets):
+                store.multisets[(lab_pk, order)] = multiset
+            store.summaries[lab_pk] = summary_per_lab
+        return store
+
+
+def _store_key(course_pk: int) -> str:
+    return f"course-summary-store-{course_pk}"
+
+
+def _lab_key(course_pk: int, generation: str, lab_pk: int) -> str:
+    return f"course-summary-store-{course_pk}-{generation}-{lab_pk}"
+
+
+def load_user_labs(course_pk: int, user_pk: int) -> 'Optional[Tuple[Optional[int], ...]]':
+    """
+    ユーザが提出した志望順位を1回のクエリで読み込む．差分の適用前の状態として使う
+    :return: 志望順に並べた研究室のpk．志望順位を提出していなければNone
+    """
+    rank_limit = get_config_cache(course_pk)['rank_limit']
+    rows = Rank.objects.filter(course_id=course_pk, user_id=user_pk, order__lt=rank_limit) \
+        .values_list('order', 'lab_id')
+    labs = [None] * rank_limit
+    submitted = False
+    for order, lab_pk in rows:
+        labs[order] = lab_pk
+        submitted = True
+    return tuple(labs) if submitted else None
+
+
+def _acquire_lock(lock_key: str) -> bool:
+    """差分の適用のロックを取る．他のリクエストが持っている場合はSTORE_LOCK_WAITまで待つ"""
+    deadline = time.time() + STORE_LOCK_WAIT
+    while not cache.add(lock_key, True, STORE_LOCK_TIMEOUT):
+        if time.time() >= deadline:
+            return False
+        time.sleep(caching.POLL_INTERVAL)
+    return True
+
+
+def _apply_to_store(course_pk: int, lab_pks: 'Set[Optional[int]]',
+                    apply: 'Callable[[SummaryStore], Optional[Set[int]]]') -> None:
+    """
+    キャッシュ上のストアに差分を適用してサマリーのキャッシュとLabSummaryを更新する．
+    ストアは差分に関わる研究室のみを読み書きする．applyはストアに差分を適用して再集計した研究室のpkの集合を返し，
+    差分を適用できない場合はNoneを返す．その場合やストアが無い場合は全体を再集計する．
+    他のリクエストが差分を適用中の場合は少し待ち，それでもロックが取れなければ差分を捨てずにサマリーが古くなったことを
+    記録して，次の読み出しか書き込みで全体を再集計させる．
+    SUMMARY_DEBOUNCE_SECONDSが設定されている場合は差分を適用せず，古くなったことを記録するのみとする．
+    """
+    if get_debounce_seconds() > 0:
+        mark_summary_stale(course_pk)
+        return
+    summary_key = f"course-summary-{course_pk}"
+    lock_key = f"{_store_key(course_pk)}-lock"
+    if not _acquire_lock(lock_key):
+        mark_summary_stale(course_pk)
+        return
+    try:
+        store = None
+        if not is_summary_stale(course_pk, fresh=True):
+            store = SummaryStore.load_from_cache(course_pk, lab_pks)
+        version = caching.get_version(summary_key, fresh=True)
+        if caching.is_versioned() and store is not None and store.version != version:
+            # 他のワーカーが先にサマリーを更新していた場合，手元のストアは古くなっている
+            store = None
+        touched = None
+        if store is not None:
+            try:
+                touched = apply(store)
+            except KeyError:
+                # ストアに無いGPAを取り除こうとした．ストアが書き込みより新しい状態から作られている
+                touched = None
+        if touched is None:
+            # 現在のDBの状態から作り直すため，差分の適用は不要．課程の読み込みは1回とし，サマリーはストアから求める
+            stores = []
+
+            def make_summary(course: 'Course') -> 'List[dict]':
+                stores.append(SummaryStore.from_course(course))
+                return stores[0].to_summary()
+
+            summary = _rebuild_summary(Course.objects.get(pk=course_pk), make_summary)
+            store = stores[0]
+            store.version = caching.bump_version(summary_key)
+            store.save_to_cache(course_pk)
+            caching.set_value(summary_key, summary, store.version)
+            return
+        save_summary(course_pk, [store.summaries[lab_pk] for lab_pk in touched])
+        store.version = caching.bump_version(summary_key)
+        store.save_to_cache(course_pk, touched)
+        summary = caching.get_value(summary_key, None)
+        if summary is not None:
+            summary = [store.summaries.get(summary_per_lab['pk'], summary_per_lab) for summary_per_lab in summary]
+            caching.set_value(summary_key, summary, store.version)
+    finally:
+        cache.delete(lock_key)
+
+
+def update_summary_for_user(course: 'Course', user, labs: 'Optional[Sequence[Optional[int]]]' = None,
+                            previous: 'Optional[Tuple[Optional[float], Optional[Sequence[Optional[int]]]]]' = None):
+    """
+    あるユーザの志望またはGPAが変わったときにサマリーを差分更新する
+    :param course: 課程
+    :param user: 志望を提出した，またはGPAを変更したユーザ
+    :param labs: 志望順に並べた研究室のpk．GPAのみが変わった場合はNone
+    :param previous: 変更前の(GPA, 志望)．志望順位を提出していなかった場合の志望はNone．
+                     Noneの場合は変更前の状態が分からないため全体を再集計する
+    """
+    if previous is None:
+        _apply_to_store(course.pk, set(), lambda store: None)
+        return
+    previous_gpa, previous_labs = previous
+    if labs is None:
+        if previous_labs is None:
+            # 志望を提出していないユーザのGPAはサマリーに影響しない
+            return
+        labs = previous_labs
+
+    def apply(store: 'SummaryStore') -> 'Set[int]':
+        if previous_labs is not None:
+            store.users[user.pk] = (previous_gpa, tuple(previous_labs))
+        return store.update_user(user.pk, user.gpa, labs)
+
+    _apply_to_store(course.pk, set(labs) | set(previous_labs or ()), apply)
+
+
+def update_summary_for_capacity(lab: 'Lab'):
+    """研究室の許容人数が変わったときにサマリーを差分更新する"""
+    _apply_to_store(lab.course_id, {lab.pk}, lambda store: store.set_capacity(lab.pk, lab.capacity))
+
+
+def update_summary_for_capacities(course_pk: int, capacities: 'Dict[int, int]'):
+    """複数の研究室の許容人数をまとめて変えたときにサマリーを差分更新する"""
+
+    def apply(store: 'SummaryStore') -> 'Set[int]':
+        touched = set()
+        for lab_pk, capacity in capacities.items():
+            touched |= store.set_capacity(lab_pk, capacity)
+        return touched
+
+    _apply_to_store(course_pk, set(capacities.keys()), apply)
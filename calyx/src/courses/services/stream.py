@@ -0,0 +1,86 @@
+"""
+希望調査のサマリーの更新をServer-Sent Eventsとして配信する．
+イベントIDは課程のバージョンとし，変更の確認ではCacheVersionのみを読み，バージョンが変わったときだけサマリーを読み出す．
+SUMMARY_STREAM_MAX_SECONDSが0の場合は接続を保持せず，変更があれば現在のサマリーを1度だけ送って切断する．
+クライアント（EventSource）はretryで指定した間隔で自動的に再接続するため，ポーリングとして動作する．
+接続を保持する間はワーカーを1つ占有するため，0より大きくするのはgeventなどの非同期のワーカーで動かす場合に限ること．
+同期のワーカー（uwsgiの既定の設定）では0のままとする．
+"""
+import json
+import time
+from typing import TYPE_CHECKING
+
+from django.conf import settings
+
+from .summary import get_summary, is_summary_stale
+from .version import get_course_version
+
+if TYPE_CHECKING:
+    from typing import Iterator, List, Optional
+    from courses.models import Course
+
+
+def get_stream_max_seconds() -> int:
+    return getattr(settings, 'SUMMARY_STREAM_MAX_SECONDS', 0)
+
+
+def get_stream_interval() -> float:
+    return getattr(settings, 'SUMMARY_STREAM_INTERVAL', 2)
+
+
+def get_stream_retry() -> int:
+    return getattr(settings, 'SUMMARY_STREAM_RETRY_MS', 5000)
+
+
+def diff_summary(previous: 'List[dict]', current: 'List[dict]') -> dict:
+    """
+    2つのサマリーの差分を返す
+    :return: {'updated': 変更または追加された研究室のサマリー, 'removed': 削除された研究室のpk}
+    """
+    previous_labs = {summary_per_lab['pk']: summary_per_lab for summary_per_lab in previous}
+    current_pks = {summary_per_lab['pk'] for summary_per_lab in current}
+    return {
+        'updated': [
+            summary_per_lab for summary_per_lab in current
+            if previous_labs.get(summary_per_lab['pk'], None) != summary_per_lab
+        ],
+        'removed': [pk for pk in previous_labs.keys() if pk not in current_pks],
+    }
+
+
+def format_event(event: str, data, event_id: 'Optional[str]' = None) -> str:
+    lines = []
+    if event_id is not None:
+        lines.append(f'id: {event_id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+def stream_summary(course: 'Course', last_event_id: 'Optional[str]' = None) -> 'Iterator[str]':
+    """
+    課程のバージョンが変わる度にイベントを生成する．最初は全体を'summary'イベントとして，以降は差分を'diff'イベントとして送る．
+    再集計の間隔内で古いサマリーしか無い場合は，新しいバージョンのIDを付けて送らずに次の確認まで待つ
+    :param course: 課程
+    :param last_event_id: クライアントが最後に受け取ったイベントID．現在の課程のバージョンと同じであれば送らない
+    """
+    yield f'retry: {get_stream_retry()}\n\n'
+    interval = get_stream_interval()
+    deadline = time.monotonic() + get_stream_max_seconds()
+    previous = None
+    while True:
+        event_id = str(get_course_version(course.pk).version)
+        if event_id != last_event_id:
+            summary = get_summary(course)
+            if not is_summary_stale(course.pk, fresh=True):
+                if previous is None:
+                    yield format_event('summary', summary, event_id)
+                else:
+                    yield format_event('diff', diff_summary(previous, summary), event_id)
+                previous = summary
+                last_event_id = event_id
+        if time.monotonic() + interval > deadline:
+            return
+        time.sleep(interval)
+        # 切断されたクライアントを検出するためのコメント
+        yield ': keep-alive\n\n'
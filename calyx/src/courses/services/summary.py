@@ -1,15 +1,21 @@
+from collections import defaultdict, OrderedDict
 from typing import TYPE_CHECKING
 from itertools import chain
 from statistics import mean, median
 
+from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.core.cache import cache
+from django.db import transaction
+from django.utils import timezone
 
-from courses.models import Course, Lab
+from courses.models import Course, Lab, LabSummary
+from . import caching, kernels
+from .snapshot import CourseSnapshot
 from .status import get_config_cache
 
 if TYPE_CHECKING:
-    from typing import List, Dict
+    from typing import Callable, Iterable, List, Dict, Optional, Tuple
     from users.models import User as AppUser
 
 User = get_user_model()  # type: AppUser
@@ -17,17 +23,22 @@ User = get_user_model()  # type: AppUser
 
 class Summary(object):
 
-    def __init__(self, lab: 'Lab', config: 'dict'):
+    def __init__(self, lab: 'Lab', config: 'dict', gpa_set_all: 'Optional[Dict[int, List[float]]]' = None):
+        """
+        :param lab: 集計対象の研究室
+        :param config: 課程の設定のキャッシュ
+        :param gpa_set_all: 志望順位ごとのGPAのリスト．事前に読み込んでいればDBへのアクセスを省略する
+        """
         self.lab = lab
         self.rank_limit = config.get('rank_limit')
         self.show_gpa = config.get('show_gpa')
-        self.gpa_set_all = dict()
+        self.gpa_set_all = dict() if gpa_set_all is None else gpa_set_all
 
     def _make_summary(self, gpa_set: 'List[float]') -> 'Dict[str, int]':
         summary = dict()
         if self.show_gpa:
             # GPAの降順でソート
-            sorted(gpa_set, reverse=True)
+            gpa_set = sorted(gpa_set, reverse=True)
             # ボーダーラインの算出
             if len(gpa_set) < self.rank_limit:
                 summary['border'] = gpa_set[-1] if len(gpa_set) > 0 else 0.0
@@ -46,6 +57,8 @@ class Summary(object):
         return summary
 
     def _get_gpa_set(self, order: int) -> 'List[int]':
+        if order in self.gpa_set_all.keys():
+            return self.gpa_set_all[order]
         rank_set = self.lab.rank_set.filter(order=order).select_related('user').all()
         gpa_set = [rank.user.gpa for rank in rank_set]
         # GPA未入力のユーザを省く
@@ -71,9 +84,42 @@ class Summary(object):
         return self._make_summary(list(gpa_array))
 
 
+def load_rank_rows(course_pk: int, config: 'dict') -> 'List[Tuple[int, int, Optional[float]]]':
+    """
+    課程の全ての志望順位をスナップショットから取り出す．
+    再集計はシグナルから課程のバージョンを上げる前に呼ばれることがあるため，キャッシュを使わずに読み込む
+    :param course_pk: 課程のプライマリキー
+    :param config: 課程の設定のキャッシュ
+    :return: [(研究室のpk, 志望順位, GPA), ...]
+    """
+    # GPAを表示する場合はGPA未入力のユーザを省く
+    return CourseSnapshot.load(course_pk).rank_rows(config.get('show_gpa'))
+
+
+def load_gpa_sets(course_pk: int, config: 'dict') -> 'Dict[int, Dict[int, List[float]]]':
+    """
+    課程の全ての志望順位を1回のクエリで読み込み，研究室・志望順位ごとのGPAのリストに振り分ける
+    :param course_pk: 課程のプライマリキー
+    :param config: 課程の設定のキャッシュ
+    :return: {研究室のpk: {志望順位: [GPA, ...]}}
+    """
+    rank_limit = config.get('rank_limit')
+    gpa_sets = defaultdict(lambda: {i: [] for i in range(rank_limit)})
+    for lab_pk, order, gpa in load_rank_rows(course_pk, config):
+        gpa_sets[lab_pk][order].append(gpa)
+    return gpa_sets
+
+
 def make_summary_cache(instance: 'Course') -> 'List[dict]':
     """配属希望調査のサマリーをCourseのインスタンスから生成する"""
     config = get_config_cache(instance.pk)
+    if kernels.is_enabled():
+        # NumPyが使える場合は全ての研究室・志望順位をまとめて計算する
+        snapshot = CourseSnapshot.load(instance.pk)
+        labs = snapshot.labs()
+        rows = snapshot.rank_rows(config.get('show_gpa'))
+        return kernels.summarize_labs(labs, rows, config.get('rank_limit'), config.get('show_gpa'))
+    gpa_sets = load_gpa_sets(instance.pk, config)
     summary = []
     for lab in instance.labs.all():
         summary_per_lab = {
@@ -82,7 +128,7 @@ def make_summary_cache(instance: 'Course') -> 'List[dict]':
             'capacity': lab.capacity,
             'detail': list()
         }
-        gpa_metrics = Summary(lab, config)
+        gpa_metrics = Summary(lab, config, gpa_sets[lab.pk])
         # 志望順位ごとのサマリーを作成
         for i in range(config.get('rank_limit')):
             summary_per_lab['detail'].append(gpa_metrics.summarize(i))
@@ -92,18 +138,141 @@ def make_summary_cache(instance: 'Course') -> 'List[dict]':
     return summary
 
 
+def save_summary(course_pk: int, summary: 'Iterable[dict]', replace_all: bool = False) -> None:
+    """
+    サマリーをLabSummaryとして保存する．既存の行と比べて，値が変わった行のみを更新し，無い行のみを追加する
+    :param course_pk: 課程のプライマリキー
+    :param summary: 保存する研究室ごとのサマリー
+    :param replace_all: Trueの場合は課程の全てのLabSummaryを置き換える．Falseの場合は渡された研究室のもののみ
+    """
+    fields = ('count',) + LabSummary.stat_fields
+    values = dict()
+    for summary_per_lab in summary:
+        fragments = list(enumerate(summary_per_lab['detail'])) + [(None, summary_per_lab['abstract'])]
+        for order, fragment in fragments:
+            values[(summary_per_lab['pk'], order)] = {key: fragment.get(key, None) for key in fields}
+    now = timezone.now()
+    with transaction.atomic():
+        queryset = LabSummary.objects.filter(course_id=course_pk)
+        if not replace_all:
+            queryset = queryset.filter(lab_id__in={lab_pk for lab_pk, _ in values})
+        changed, removed = [], []
+        for row in queryset.select_for_update():
+            fragment = values.pop((row.lab_id, row.order), None)
+            if fragment is None:
+                removed.append(row.pk)
+            elif any(getattr(row, key) != value for key, value in fragment.items()):
+                for key, value in fragment.items():
+                    setattr(row, key, value)
+                # bulk_updateではauto_nowが更新されない
+                row.updated_at = now
+                changed.append(row)
+        if removed:
+            LabSummary.objects.filter(pk__in=removed).delete()
+        if changed:
+            LabSummary.objects.bulk_update(changed, fields + ('updated_at',))
+        LabSummary.objects.bulk_create([
+            LabSummary(course_id=course_pk, lab_id=lab_pk, order=order, **fragment)
+            for (lab_pk, order), fragment in values.items()
+        ])
+
+
+def load_summary(course_pk: int) -> 'Optional[List[dict]]':
+    """保存されたLabSummaryからサマリーを1回のクエリで読み出す．保存されていなければNoneを返す"""
+    rows = LabSummary.objects.filter(course_id=course_pk).select_related('lab').order_by('lab_id', 'order')
+    summary = OrderedDict()
+    for row in rows:
+        if row.lab_id not in summary:
+            summary[row.lab_id] = {
+                'pk': row.lab_id,
+                'name': row.lab.name,
+                'capacity': row.lab.capacity,
+                'detail': list(),
+            }
+        if row.order is None:
+            summary[row.lab_id]['abstract'] = row.to_fragment()
+        else:
+            summary[row.lab_id]['detail'].append(row.to_fragment())
+    if len(summary) == 0:
+        return None
+    return list(summary.values())
+
+
+def get_debounce_seconds() -> int:
+    """サマリーの再集計をまとめる間隔．0の場合は書き込みの度に再集計する"""
+    return getattr(settings, 'SUMMARY_DEBOUNCE_SECONDS', 0)
+
+
+def _stale_key(course_pk: int) -> str:
+    return f"course-summary-stale-{course_pk}"
+
+
+def mark_summary_stale(course_pk: int) -> None:
+    """
+    課程のサマリーが古くなったことをCacheVersionに記録する．
+    キャッシュと異なりワーカー間で共有されるため，どのワーカーの次の読み出しでも再集計される
+    """
+    caching.increment_counter(_stale_key(course_pk))
+
+
+def is_summary_stale(course_pk: int, fresh: bool = False) -> bool:
+    """課程のサマリーが古くなっているか．CACHE_VERSION_TTLの間はワーカー内に保持した値を使う"""
+    return caching.get_counter(_stale_key(course_pk), fresh) > 0
+
+
+def _rebuild_summary(course: 'Course',
+                     make_summary: 'Callable[[Course], List[dict]]' = make_summary_cache) -> 'List[dict]':
+    # 集計中の書き込みは次の再集計で反映されるよう，集計前の記録のみを消す
+    stale = caching.get_counter(_stale_key(course.pk), fresh=True)
+    summary = make_summary(course)
+    save_summary(course.pk, summary, replace_all=True)
+    caching.reset_counter(_stale_key(course.pk), stale)
+    # 差分更新用のストアは次の差分更新時に作り直す
+    cache.delete(f"course-summary-store-{course.pk}")
+    return summary
+
+
+def _load_or_rebuild_summary(course: 'Course') -> 'List[dict]':
+    """
+    保存されたサマリーがあればそれを使い，無ければ再集計する．
+    サマリーが古くなったことが記録されている場合，保存されたサマリーも古いため再集計する
+    """
+    summary = None
+    if not is_summary_stale(course.pk, fresh=True):
+        summary = load_summary(course.pk)
+    if summary is None:
+        summary = _rebuild_summary(course)
+    return summary
+
+
 def update_summary_cache(course: 'Course'):
     """指定された課程のキャッシュを更新する"""
     cache_key = f"course-summary-{course.pk}"
-    cached_summary = make_summary_cache(course)
-    cache.set(cache_key, cached_summary)
-    return cached_summary
+    return caching.publish(cache_key, _rebuild_summary(course))
+
+
+def invalidate_summary(course: 'Course') -> None:
+    """
+    書き込みによってサマリーが変わったことを通知する．
+    SUMMARY_DEBOUNCE_SECONDSが設定されている場合はフラグを立てるのみで，再集計はget_summaryに任せる．
+    """
+    if get_debounce_seconds() > 0:
+        mark_summary_stale(course.pk)
+    else:
+        update_summary_cache(course)
 
 
 def get_summary(course: 'Course'):
-    """課程ごとの希望調査のサマリーを取得する"""
+    """
+    課程ごとの希望調査のサマリーを取得する．
+    サマリーが古くなっている場合でも，再集計は課程ごとにSUMMARY_DEBOUNCE_SECONDSにつき1回までとし，
+    それ以外の呼び出しでは最後に集計が完了したサマリーを返す．
+    """
     cache_key = f"course-summary-{course.pk}"
-    cached_summary = cache.get(cache_key, None)
-    if cached_summary is None:
-        cached_summary = update_summary_cache(course)
-    return cached_summary
+    if is_summary_stale(course.pk):
+        debounce = get_debounce_seconds()
+        # 間隔内に既に誰かが再集計していればaddに失敗する
+        if debounce <= 0 or cache.add(f"course-summary-debounce-{course.pk}", True, debounce):
+            return update_summary_cache(course)
+    # キャッシュが無い，または古い場合も読み出すのは1つのリクエストのみ
+    return caching.get_or_compute(cache_key, lambda: _load_or_rebuild_summary(course))
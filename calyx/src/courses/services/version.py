@@ -0,0 +1,44 @@
+from collections import namedtuple
+from typing import TYPE_CHECKING
+
+from django.db.models import F
+from django.utils import timezone
+
+from courses.models import CacheVersion
+from . import caching
+
+if TYPE_CHECKING:
+    from typing import Optional
+
+CourseVersion = namedtuple('CourseVersion', ['version', 'updated_at'])
+
+
+def _load_course_version(cache_key: str) -> 'CourseVersion':
+    row = CacheVersion.objects.filter(key=cache_key).values_list('version', 'updated_at').first()
+    if row is None:
+        return CourseVersion(0, None)
+    return CourseVersion(*row)
+
+
+def get_course_version(course_pk: int) -> 'CourseVersion':
+    """
+    課程のデータのバージョンと最終更新日時を取得する．
+    志望順位，研究室，設定，参加者，参加者のGPAや表示名が変わる度に更新される．
+    """
+    cache_key = f"course-version-{course_pk}"
+    return caching.get_or_compute(cache_key, lambda: _load_course_version(cache_key))
+
+
+def bump_course_version(course_pk: 'Optional[int]') -> 'Optional[CourseVersion]':
+    """課程のデータが変わったときにバージョンを上げる"""
+    if course_pk is None:
+        return None
+    cache_key = f"course-version-{course_pk}"
+    # update()ではauto_nowが効かないため，更新日時も明示的に指定する
+    updated = CacheVersion.objects.filter(key=cache_key).update(version=F('version') + 1, updated_at=timezone.now())
+    if not updated:
+        CacheVersion.objects.get_or_create(key=cache_key)
+        CacheVersion.objects.filter(key=cache_key).update(version=F('version') + 1, updated_at=timezone.now())
+    course_version = _load_course_version(cache_key)
+    caching.set_value(cache_key, course_version, caching.get_version(cache_key, fresh=True))
+    return course_version
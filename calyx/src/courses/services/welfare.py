@@ -0,0 +1,202 @@
+"""
+志望の満足度を最大化する配属．GPAによる優先順位は使わず，研究室の許容人数の範囲で配属される人数を最大にし，
+その中で配属先の志望順位（0始まり）の合計を最小にする．
+ソース→ユーザ→研究室→シンクの最小費用流として，ポテンシャル付きのダイクストラ法で最短路の長さを求め，
+同じ長さの増加路をまとめて流す（primal-dual法）．費用は志望順位の小さな整数のため，フェーズの数は少ない．
+"""
+import heapq
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from typing import List, Sequence, Tuple
+
+INF = float('inf')
+
+
+def _build_edges(prefs: 'Sequence[Sequence[int]]') -> 'List[List[Tuple[int, int]]]':
+    """ユーザごとの(研究室の番号, 志望順位)のリスト．志望が無い箇所と重複した研究室は除く"""
+    edges = []
+    for row in prefs:
+        seen = set()
+        user_edges = []
+        for order, lab in enumerate(row):
+            if lab >= 0 and lab not in seen:
+                seen.add(lab)
+                user_edges.append((lab, order))
+        edges.append(user_edges)
+    return edges
+
+
+class _FlowNetwork(object):
+    """
+    二部グラフに特化した残余ネットワーク．ノードはユーザ（0〜n-1），研究室（n〜n+m-1），シンク（n+m）とし，
+    ソースは未配属のユーザへの辺としてのみ扱う
+    """
+
+    def __init__(self, prefs: 'Sequence[Sequence[int]]', capacity: 'Sequence[int]'):
+        self.n_users = len(prefs)
+        self.n_labs = len(capacity)
+        self.sink = self.n_users + self.n_labs
+        self.edges = _build_edges(prefs)
+        self.capacity = [max(value, 0) for value in capacity]
+        self.counts = [0] * self.n_labs
+        self.assigned = [-1] * self.n_users
+        self.costs = [0] * self.n_users
+        # 研究室に配属されたユーザ．挿入順を保つためdictを使う
+        self.holders = [dict() for _ in range(self.n_labs)]
+        self.potential = [0] * (self.sink + 1)
+
+    def move(self, user: int, lab: int, cost: int):
+        old = self.assigned[user]
+        if old >= 0:
+            self.counts[old] -= 1
+            del self.holders[old][user]
+        self.assigned[user] = lab
+        self.costs[user] = cost
+        self.counts[lab] += 1
+        self.holders[lab][user] = None
+
+    def assign_first_choices(self):
+        """
+        費用0の辺のみで初期解を作る．全ての辺の被約費用がポテンシャル0で非負のまま保たれる
+        """
+        for user, user_edges in enumerate(self.edges):
+            if user_edges and user_edges[0][1] == 0:
+                lab = user_edges[0][0]
+                if self.counts[lab] < self.capacity[lab]:
+                    self.move(user, lab, 0)
+
+    def shortest_paths(self) -> bool:
+        """
+        被約費用でダイクストラ法を行い，ポテンシャルを更新する．シンクに到達できなければFalse
+        シンクより遠いノードの距離はシンクの距離で打ち切る
+        """
+        n = self.n_users
+        h = self.potential
+        dist = [INF] * (self.sink + 1)
+        heap = []
+        for user in range(n):
+            if self.assigned[user] < 0 and self.edges[user]:
+                dist[user] = -h[user]
+                heap.append((dist[user], user))
+        heapq.heapify(heap)
+        while heap:
+            d, node = heapq.heappop(heap)
+            if d > dist[node]:
+                continue
+            if node == self.sink:
+                break
+            if node < n:
+                base = d + h[node]
+                current = self.assigned[node]
+                for lab, cost in self.edges[node]:
+                    if lab == current:
+                        continue
+                    nd = base + cost - h[n + lab]
+                    if nd < dist[n + lab]:
+                        dist[n + lab] = nd
+                        heapq.heappush(heap, (nd, n + lab))
+            else:
+                lab = node - n
+                base = d + h[node]
+                if self.counts[lab] < self.capacity[lab]:
+                    nd = base - h[self.sink]
+                    if nd < dist[self.sink]:
+                        dist[self.sink] = nd
+                        heapq.heappush(heap, (nd, self.sink))
+                for user in self.holders[lab]:
+                    nd = base - self.costs[user] - h[user]
+                    if nd < dist[user]:
+                        dist[user] = nd
+                        heapq.heappush(heap, (nd, user))
+        limit = dist[self.sink]
+        if limit == INF:
+            return False
+        for node, value in enumerate(dist):
+            h[node] += value if value < limit else limit
+        return True
+
+    def augment_admissible(self) -> int:
+        """
+        被約費用が0の辺のみをたどる増加路を，見つからなくなるまで深さ優先探索で流す
+        :return: 増やした流量
+        """
+        n = self.n_users
+        h = self.potential
+        dead_user = [False] * n
+        dead_lab = [False] * self.n_labs
+        on_path = [False] * self.n_labs
+        flow = 0
+        for start in range(n):
+            if self.assigned[start] >= 0 or dead_user[start] or h[start] != 0:
+                continue
+            # (ユーザ, 研究室の候補のイテレータ)と(研究室, ユーザの候補のイテレータ)を交互に積む
+            path = [(start, iter(self.edges[start]))]
+            found = False
+            while path and not found:
+                node, candidates = path[-1]
+                if len(path) % 2 == 1:
+                    user = node
+                    for lab, cost in candidates:
+                        if lab == self.assigned[user] or dead_lab[lab] or on_path[lab]:
+                            continue
+                        if cost + h[user] - h[n + lab] == 0:
+                            on_path[lab] = True
+                            if self.counts[lab] < self.capacity[lab] and h[n + lab] == h[self.sink]:
+                                path.append((lab, None))
+                                found = True
+                            else:
+                                path.append((lab, iter(list(self.holders[lab]))))
+                            break
+                    else:
+                        dead_user[user] = True
+                        path.pop()
+                else:
+                    lab = node
+                    for user in candidates:
+                        if dead_user[user] or self.assigned[user] != lab:
+                            continue
+                        if h[n + lab] - self.costs[user] - h[user] == 0:
+                            path.append((user, iter(self.edges[user])))
+                            break
+                    else:
+                        dead_lab[lab] = True
+                        on_path[lab] = False
+                        path.pop()
+            if not found:
+                continue
+            # 後ろから順に，各ユーザを次の研究室に移す
+            for i in range(len(path) - 2, -1, -2):
+                user, lab = path[i][0], path[i + 1][0]
+                on_path[lab] = False
+                cost = next(order for candidate, order in self.edges[user] if candidate == lab)
+                self.move(user, lab, cost)
+            flow += 1
+        return flow
+
+
+def min_cost_assignment(prefs: 'Sequence[Sequence[int]]', capacity: 'Sequence[int]') -> 'List[int]':
+    """
+    配属される人数を最大にし，その中で志望順位の合計を最小にする配属を求める
+    :param prefs: ユーザ×志望順位の研究室の番号（志望が無ければ-1）
+    :param capacity: 研究室ごとの許容人数
+    :return: ユーザごとの配属先の研究室の番号．配属されなければ-1
+    """
+    network = _FlowNetwork(prefs, capacity)
+    network.assign_first_choices()
+    while network.shortest_paths():
+        if not network.augment_admissible():
+            break
+    return network.assigned
+
+
+def rank_profile(prefs: 'Sequence[Sequence[int]]', assigned: 'Sequence[int]') -> 'List[int]':
+    """
+    配属の結果を志望順位ごとに数える
+    :return: 第1志望から順に配属された人数と，最後に配属されなかった人数
+    """
+    width = max((len(row) for row in prefs), default=0)
+    profile = [0] * (width + 1)
+    for row, lab in zip(prefs, assigned):
+        profile[list(row).index(lab) if lab >= 0 else width] += 1
+    return profile
@@ -6,7 +6,10 @@ from django.db import models
 from django.dispatch import receiver
 
 from courses.models import Course, Config, Rank, Lab
-from courses.services import set_config_from_instance, update_summary_cache
+from courses.services import (
+    set_config_from_instance, invalidate_summary, update_summary_for_user, update_summary_for_capacity,
+    bump_course_version, update_assignment_for_user, update_assignment_for_capacity, load_user_labs
+)
 
 if TYPE_CHECKING:
     from users.models import User as AppUser
@@ -39,30 +42,7 @@ def change_admin_group_name(sender, instance: 'Course', **kwargs):
 def update_rank_summary_when_capacity_changed(sender, instance: 'Lab', **kwargs):
     update_fields = kwargs.get("update_fields", None)
     if update_fields is not None and "capacity" in update_fields:
-        update_summary_cache(instance.course)
-
-
-@receiver(models.signals.pre_delete, sender=Lab)
-def move_up_ranks(sender, instance: 'Lab', **kwargs):
-    """
-    研究室が削除されたときに自動で志望順位を繰り上げる
-    :param sender: Modelクラス
-    :param instance: そのインスタンス
-    :param kwargs:
-    :return:
-    """
-    ranks = Rank.objects.filter(lab=instance).all()
-    users = [rank.user for rank in ranks]
-    for rank_to_del, user in zip(ranks, users):
-        rank_filter = {'course': rank_to_del.course, 'order__gt': rank_to_del.order, 'user': user}
-        for rank in Rank.objects.filter(**rank_filter).order_by('order').all():
-            # 消す対象より下の志望順位の研究室を順に繰り上げる
-            rank_to_del.lab_id = rank.lab_id
-            rank_to_del.save()
-            rank_to_del = rank
-        # 最後の志望の研究室はNULLにする
-        rank_to_del.lab = None
-        rank_to_del.save()
+        update_summary_for_capacity(instance)
 
 
 @receiver(models.signals.post_save, sender=Config)
@@ -76,7 +56,15 @@ def set_config_cache(sender, instance: 'Config', **kwargs):
     """
     if not kwargs.get("raw", False):
         set_config_from_instance(instance)
-        update_summary_cache(instance.course)
+        invalidate_summary(instance.course)
+
+
+@receiver(models.signals.pre_save, sender=User)
+def remember_previous_gpa(sender, instance: 'AppUser', **kwargs):
+    """サマリーの差分更新のために変更前のGPAを記録する"""
+    update_fields = kwargs.get('update_fields', None)
+    if instance.pk is not None and update_fields is not None and 'gpa' in update_fields:
+        instance._previous_gpa = User.objects.filter(pk=instance.pk).values_list('gpa', flat=True).first()
 
 
 @receiver(models.signals.post_save, sender=User)
@@ -85,6 +73,67 @@ def update_rank_summary_based_on_user_attr(sender, instance: 'AppUser', **kwargs
     if not created:
         update_fields = kwargs.get('update_fields', None)
         if update_fields is not None and 'gpa' in update_fields:
+            previous_gpa = instance.__dict__.pop('_previous_gpa', None)
             courses = instance.courses.all()
             for course in courses:
-                update_summary_cache(course)
+                previous = (previous_gpa, load_user_labs(course.pk, instance.pk))
+                update_summary_for_user(course, instance, previous=previous)
+
+
+@receiver([models.signals.post_save, models.signals.post_delete], sender=Rank)
+@receiver([models.signals.post_save, models.signals.post_delete], sender=Lab)
+@receiver(models.signals.post_save, sender=Config)
+def bump_version_of_course(sender, instance, **kwargs):
+    """
+    志望順位，研究室，設定が変わったときに課程のバージョンを上げる
+    :param sender: Modelクラス
+    :param instance: 課程に属するインスタンス
+    :param kwargs:
+    :return:
+    """
+    if not kwargs.get('raw', False):
+        bump_course_version(instance.course_id)
+
+
+@receiver(models.signals.m2m_changed, sender=Course.users.through)
+def bump_version_when_members_changed(sender, instance, action: str, reverse: bool, pk_set, **kwargs):
+    """課程への参加・脱退があったときに課程のバージョンを上げる"""
+    if action not in ['post_add', 'post_remove', 'post_clear']:
+        return
+    if not reverse:
+        bump_course_version(instance.pk)
+        return
+    # user.courses側から変更された場合，instanceはユーザ
+    course_pks = pk_set if pk_set else []
+    for course_pk in course_pks:
+        bump_course_version(course_pk)
+
+
+@receiver(models.signals.post_save, sender=User)
+def bump_version_based_on_user_attr(sender, instance: 'AppUser', **kwargs):
+    """ユーザのGPAや表示名が変わったときに，参加している課程のバージョンを上げる"""
+    update_fields = kwargs.get('update_fields', None)
+    if kwargs.get('created', False) or update_fields is None:
+        return
+    if 'gpa' in update_fields or 'screen_name' in update_fields:
+        for course_pk in instance.courses.values_list('pk', flat=True):
+            bump_course_version(course_pk)
+
+
+# 以下は課程のバージョンを上げた後に呼び出す必要があるため，バージョンを上げるレシーバより後に登録する
+@receiver(models.signals.post_save, sender=Lab)
+def update_assignment_when_capacity_changed(sender, instance: 'Lab', **kwargs):
+    update_fields = kwargs.get("update_fields", None)
+    if update_fields is not None and "capacity" in update_fields:
+        update_assignment_for_capacity(instance)
+
+
+@receiver(models.signals.post_save, sender=User)
+def update_assignment_based_on_user_attr(sender, instance: 'AppUser', **kwargs):
+    """GPAや表示名が変わったときに配属の予測を差分更新する．表示名のみの場合も状態のバージョンを進める"""
+    update_fields = kwargs.get('update_fields', None)
+    if kwargs.get('created', False) or update_fields is None:
+        return
+    if 'gpa' in update_fields or 'screen_name' in update_fields:
+        for course in instance.courses.all():
+            update_assignment_for_user(course, instance)
@@ -1,7 +1,8 @@
-from django.db import IntegrityError
+from django.db import IntegrityError, transaction
 from django.test import TestCase
 
-from courses.models import Course, Lab, Rank
+from courses.errors import RankVersionConflictError
+from courses.models import Course, Lab, Rank, RankChange, RankSetVersion
 from courses.tests.base import DatasetMixin
 from users.models import User
 
@@ -35,6 +36,20 @@ class RankModelTest(DatasetMixin, TestCase):
                 # 同一課程，同一研究室，同一ユーザで異なる志望順位
                 Rank.objects.create(lab=lab, course=self.course, user=self.users[0], order=999)
 
+    def test_replace_ranks(self):
+        """志望順位をまとめて差し替える"""
+        user = self.users[0]
+        lab_pks = [lab.pk for lab in self.labs]
+        # 既存の行が無いのでSELECTとINSERTのみ（SAVEPOINTとRELEASEを含む）
+        with self.assertNumQueries(4):
+            Rank.objects.replace_ranks(self.course, user, lab_pks)
+        # 既存の行はまとめて更新する
+        with self.assertNumQueries(4):
+            ranks = Rank.objects.replace_ranks(self.course, user, lab_pks[::-1])
+        self.assertEqual(lab_pks[::-1], [rank.lab_id for rank in ranks])
+        actual = Rank.objects.filter(course=self.course, user=user).order_by('order').values_list('lab_id', flat=True)
+        self.assertEqual(lab_pks[::-1], list(actual))
+
     def test_move_up_ranks(self):
         """研究室を削除して志望順位を繰り上げる"""
         ranks = list()
@@ -48,3 +63,57 @@ class RankModelTest(DatasetMixin, TestCase):
         ranks = Rank.objects.filter(course=self.course, user=self.users[0]).order_by('order').all()
         actual = [{'order': rank.order, 'lab': rank.lab_id} for rank in ranks]
         self.assertEqual(expected, actual)
+
+    def test_move_up_ranks_bulk(self):
+        """複数の研究室をまとめて削除して志望順位を繰り上げる"""
+        for user in self.users:
+            for i, lab in enumerate(self.labs):
+                Rank.objects.create(lab=lab, course=self.course, user=user, order=i)
+        deleted, remaining = self.labs[::2], self.labs[1::2]
+        expected = [lab.pk for lab in remaining] + [None] * len(deleted)
+        # 志望者の数に関わらずSELECT，UPDATEと変更履歴のINSERTのみ（SAVEPOINTとRELEASEを含む）
+        with transaction.atomic():
+            with self.assertNumQueries(5):
+                Rank.objects.move_up_ranks([lab.pk for lab in deleted])
+            transaction.set_rollback(True)
+        Lab.objects.filter(pk__in=[lab.pk for lab in deleted]).delete()
+        for user in self.users:
+            with self.subTest(user=user):
+                actual = Rank.objects.filter(course=self.course, user=user).order_by('order') \
+                    .values_list('lab_id', flat=True)
+                self.assertEqual(expected, list(actual))
+                change = RankChange.objects.get(course=self.course, user=user)
+                self.assertEqual(RankChange.SOURCE_LAB_DELETED, change.source)
+                self.assertEqual(expected, change.lab_pks)
+
+    def test_rank_change_is_append_only(self):
+        """変更履歴は更新できない"""
+        change = RankChange.objects.create(course=self.course, user=self.users[0],
+                                           labs=RankChange.encode_labs([self.labs[0].pk, None]))
+        self.assertEqual([self.labs[0].pk, None], change.lab_pks)
+        with self.assertRaises(TypeError):
+            change.save()
+        with self.assertRaises(TypeError):
+            RankChange.objects.filter(pk=change.pk).update(labs='')
+        with self.assertRaises(TypeError):
+            RankChange.objects.bulk_update([change], ['labs'])
+        with self.assertRaises(TypeError):
+            RankChange.objects.filter(pk=change.pk).delete()
+        with self.assertRaises(TypeError):
+            change.delete()
+        self.assertTrue(RankChange.objects.filter(pk=change.pk).exists())
+        # 課程を削除した場合は履歴もまとめて削除する
+        self.course.delete()
+        self.assertFalse(RankChange.objects.filter(pk=change.pk).exists())
+
+    def test_bump_rank_set_version(self):
+        """期待したバージョンでなければ競合とする"""
+        user = self.users[0]
+        self.assertEqual(0, RankSetVersion.objects.get_version(self.course, user))
+        self.assertEqual(1, RankSetVersion.objects.bump(self.course, user, 0))
+        self.assertEqual(2, RankSetVersion.objects.bump(self.course, user))
+        with self.assertRaises(RankVersionConflictError) as cm:
+            RankSetVersion.objects.bump(self.course, user, 1)
+        self.assertEqual(2, cm.exception.version)
+        # 他のユーザのバージョンには影響しない
+        self.assertEqual(1, RankSetVersion.objects.bump(self.course, self.users[1], 0))
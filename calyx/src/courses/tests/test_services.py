@@ -1,7 +1,44 @@
-from django.test import TestCase
+import base64
+import json
+import pickle
+from datetime import timedelta
+from io import StringIO
+from itertools import chain, product
+from random import Random
+from unittest import skipUnless
+from unittest.mock import MagicMock, patch
+
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.db.models import F
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import ValidationError
 from .base import DatasetMixin
-from courses.services import Summary
-from courses.models import Course, User, Lab, Rank
+from courses.services import (
+    Summary, SummaryStore, get_config_cache, get_summary, update_summary_cache, update_summary_for_user,
+    bump_course_version, get_course_version, load_user_labs, update_summary_for_capacity
+)
+from courses.services import caching, kernels
+from courses.services.applicants import ApplicantQuery
+from courses.services import advice, assignment, capacity, matching, probability, welfare
+from courses.services.freeze import freeze_course, unfreeze_course, get_frozen, get_frozen_payload
+from courses.services.changelog import RankChangeBuffer, append_rank_change, flush_rank_changes, get_rank_changes
+from courses.services.history import take_snapshot, get_lab_history
+from courses.services.snapshot import CourseSnapshot, NO_RANK, get_cached_snapshot, get_course_snapshot
+from courses.services.status import Status
+from courses.services.store import GPAMultiset
+from courses.services.idempotency import begin_request, complete_request, load_response, purge_expired_keys
+from courses.services.imports import import_ranks
+from courses.services.stream import diff_summary, stream_summary
+from courses.services.version import CourseVersion
+from courses.services.summary import make_summary_cache, load_summary, save_summary, is_summary_stale
+from courses.models import (
+    Course, User, Lab, Rank, CacheVersion, LabSummary, LabSummarySnapshot, IdempotencyKey, RankSetVersion,
+    RankChange
+)
 
 
 class SummaryTest(DatasetMixin, TestCase):
@@ -28,7 +65,8 @@ class SummaryTest(DatasetMixin, TestCase):
     def test_summary_gpa(self):
         """志望順位ごとのサマリーを生成する"""
         expected_zero = {'border': 0.0, 'mean': 0.0, 'median': 0.0, 'max': 0.0, 'min': 0.0, 'count': 0}
-        expected = {'border': 3.0, 'mean': 2.0, 'median': 2.0, 'max': 3.0, 'min': 1.0, 'count': 3}
+        # 志望者が3人，rank_limitが3なので3番目に高いGPAがボーダーになる
+        expected = {'border': 1.0, 'mean': 2.0, 'median': 2.0, 'max': 3.0, 'min': 1.0, 'count': 3}
         config = {'rank_limit': 3, 'show_gpa': True}
         self.assert_summary(config, expected, expected_zero)
 
@@ -39,6 +77,31 @@ class SummaryTest(DatasetMixin, TestCase):
         config = {'rank_limit': 3, 'show_gpa': False}
         self.assert_summary(config, expected, expected_zero)
 
+    def test_make_summary_cache(self):
+        """課程全体のサマリーを研究室ごとに集計した結果と一致する"""
+        for course in self.courses:
+            config = get_config_cache(course.pk)
+            expected = []
+            for lab in course.labs.all():
+                metrics = Summary(lab, config)
+                expected.append({
+                    'pk': lab.pk,
+                    'name': lab.name,
+                    'capacity': lab.capacity,
+                    'detail': [metrics.summarize(i) for i in range(config['rank_limit'])],
+                    'abstract': metrics.summarize_all(),
+                })
+            with self.subTest(course=course):
+                self.assertEqual(expected, make_summary_cache(course))
+
+    def test_make_summary_cache_queries(self):
+        """研究室の数に関わらず一定回数のクエリでサマリーを生成する"""
+        course = self.courses[0]
+        get_config_cache(course.pk)
+        # 志望順位と研究室でそれぞれ1回
+        with self.assertNumQueries(2):
+            make_summary_cache(course)
+
     def assert_summary(self, config, expected, expected_zero):
         for course in self.courses:
             labs = course.labs.all()
@@ -52,3 +115,1165 @@ class SummaryTest(DatasetMixin, TestCase):
                             self.assertEqual(expected_zero, metrics.summarize(k))
                 with self.subTest(course=course, lab=lab, order=None):
                     self.assertEqual(expected, metrics.summarize_all())
+
+
+class SummaryStoreTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(SummaryStoreTest, self).setUp()
+        cache.clear()
+        course_data = self.course_data_set[0]
+        self.course = Course.objects.create_course(**course_data)
+        self.update_config(self.course.config, {'show_gpa': True})
+        self.users = [
+            User.objects.create_user(**user_data, gpa=i + 1.5, is_active=True)
+            for i, user_data in enumerate(self.user_data_set)
+        ]
+        self.labs = self.create_labs(self.course)
+        for user in self.users:
+            self.course.join(user, course_data['pin_code'])
+        for i, user in enumerate(self.users):
+            self.submit_ranks(self.labs[i:] + self.labs[:i], user)
+
+    def assert_consistent(self, store: 'SummaryStore'):
+        self.assertEqual(make_summary_cache(self.course), store.to_summary())
+
+    def test_from_course(self):
+        """DBから構築したストアのサマリーが全体を再集計した結果と一致する"""
+        for pattern in self.config_patterns:
+            self.update_config(self.course.config, pattern)
+            with self.subTest(pattern=pattern):
+                self.assert_consistent(SummaryStore.from_course(self.course))
+
+    def test_update_user(self):
+        """志望やGPAの差分を適用した結果が全体を再集計した結果と一致する"""
+        store = SummaryStore.from_course(self.course)
+        user = self.users[0]
+        # 志望の変更
+        ranks = self.submit_ranks(self.labs[::-1], user)
+        touched = store.update_user(user.pk, user.gpa, [rank.lab_id for rank in ranks])
+        self.assertEqual({self.labs[0].pk, self.labs[2].pk}, touched)
+        self.assert_consistent(store)
+        # GPAの変更
+        user.gpa = 4.0
+        user.save(update_fields=['gpa'])
+        store.update_user(user.pk, user.gpa)
+        self.assert_consistent(store)
+        # GPAの削除
+        user.gpa = None
+        user.save(update_fields=['gpa'])
+        store.update_user(user.pk, user.gpa)
+        self.assert_consistent(store)
+        # 変化が無い場合は再集計しない
+        self.assertEqual(set(), store.update_user(user.pk, None))
+
+    def test_set_capacity(self):
+        """許容人数の変更がサマリーに反映される"""
+        store = SummaryStore.from_course(self.course)
+        lab = self.labs[0]
+        lab.capacity = 10
+        lab.save()
+        store.set_capacity(lab.pk, lab.capacity)
+        self.assert_consistent(store)
+
+    def test_update_summary_cache_by_signal(self):
+        """GPAや許容人数の変更がキャッシュされたサマリーに反映される"""
+        get_summary(self.course)
+        user = self.users[1]
+        user.gpa = 0.5
+        user.save(update_fields=['gpa'])
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+        lab = self.labs[1]
+        lab.capacity = 1
+        lab.save(update_fields=['capacity'])
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+        self.assertIsNotNone(cache.get(f'course-summary-store-{self.course.pk}'))
+
+    @override_settings(SUMMARY_DEBOUNCE_SECONDS=60)
+    def test_debounce(self):
+        """書き込みはフラグを立てるのみで，再集計は間隔ごとに1回だけ行われる"""
+        user = self.users[1]
+        get_summary(self.course)
+        user.gpa = 0.5
+        user.save(update_fields=['gpa'])
+        self.assertTrue(is_summary_stale(self.course.pk))
+        # 間隔内の最初の読み出しで再集計される
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+        previous = get_summary(self.course)
+        user.gpa = 3.5
+        user.save(update_fields=['gpa'])
+        # 間隔内では最後に完了したサマリーを返す
+        self.assertEqual(previous, get_summary(self.course))
+        self.assertNotEqual(make_summary_cache(self.course), get_summary(self.course))
+        # 間隔が過ぎれば再集計される
+        cache.delete(f'course-summary-debounce-{self.course.pk}')
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+        self.assertFalse(is_summary_stale(self.course.pk))
+
+
+    def test_apply_delta_per_lab(self):
+        """差分の適用ではユーザの志望に含まれる研究室のキーのみを読み，再集計した研究室のキーのみを書き込む"""
+        # ストアが無ければ最初の差分で作られる
+        update_summary_for_capacity(self.labs[0])
+        self.assertIsNotNone(cache.get(f'course-summary-store-{self.course.pk}'))
+        user = self.users[0]
+        previous = (user.gpa, load_user_labs(self.course.pk, user.pk))
+        self.submit_ranks(self.labs[1:2] + self.labs[:1] + self.labs[2:], user)
+        with patch.object(cache, 'set_many', wraps=cache.set_many) as set_many:
+            update_summary_for_user(self.course, user, [self.labs[1].pk, self.labs[0].pk, self.labs[2].pk],
+                                    previous)
+        self.assertEqual(2, len(set_many.call_args[0][0]))
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+        # 変更前の状態が分からない場合は全体を再集計する
+        update_summary_for_user(self.course, user, [lab.pk for lab in self.labs])
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+
+    def test_rebuild_store_loads_course_once(self):
+        """ストアが無い場合は課程を1回だけ読み込み，ストアとサマリーを作る"""
+        with patch.object(CourseSnapshot, 'load', wraps=CourseSnapshot.load) as load:
+            update_summary_for_capacity(self.labs[0])
+        self.assertEqual(1, load.call_count)
+        self.assertIsNotNone(cache.get(f'course-summary-store-{self.course.pk}'))
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+        self.assertEqual(make_summary_cache(self.course), load_summary(self.course.pk))
+
+    def test_lock_lost(self):
+        """ロックが取れない場合は差分を捨てずに古くなったことを記録し，次の読み出しで再集計する"""
+        get_summary(self.course)
+        cache.set(f'course-summary-store-{self.course.pk}-lock', True)
+        user = self.users[1]
+        user.gpa = 0.5
+        with patch('courses.services.store.STORE_LOCK_WAIT', 0):
+            user.save(update_fields=['gpa'])
+        self.assertTrue(is_summary_stale(self.course.pk, fresh=True))
+        cache.delete(f'course-summary-store-{self.course.pk}-lock')
+        expected = make_summary_cache(self.course)
+        self.assertEqual(expected, get_summary(self.course))
+        self.assertEqual(expected, load_summary(self.course.pk))
+        self.assertFalse(is_summary_stale(self.course.pk, fresh=True))
+
+    def test_persisted_summary(self):
+        """志望の差分更新がLabSummaryにも反映され，キャッシュが無くても1回のクエリで読み出せる"""
+        update_summary_cache(self.course)
+        user = self.users[0]
+        previous = (user.gpa, load_user_labs(self.course.pk, user.pk))
+        ranks = self.submit_ranks(self.labs[::-1], user)
+        update_summary_for_user(self.course, user, [rank.lab_id for rank in ranks], previous)
+        expected = make_summary_cache(self.course)
+        with self.assertNumQueries(1):
+            self.assertEqual(expected, load_summary(self.course.pk))
+        self.assertEqual(len(self.labs) * 4, LabSummary.objects.filter(course=self.course).count())
+        cache.clear()
+        self.assertEqual(expected, get_summary(self.course))
+
+    def test_save_summary_upsert(self):
+        """値が変わった行のみを更新し，変わらない行はそのまま残す"""
+        update_summary_cache(self.course)
+        before = {(row.lab_id, row.order): (row.pk, row.updated_at) for row in LabSummary.objects.all()}
+        self.submit_ranks(self.labs[::-1], self.users[0])
+        summary = make_summary_cache(self.course)
+        save_summary(self.course.pk, summary, replace_all=True)
+        after = {(row.lab_id, row.order): (row.pk, row.updated_at) for row in LabSummary.objects.all()}
+        self.assertEqual(before.keys(), after.keys())
+        self.assertTrue(all(before[key][0] == after[key][0] for key in before))
+        changed = {key for key in before if before[key][1] != after[key][1]}
+        self.assertTrue(0 < len(changed) < len(before))
+        self.assertEqual(summary, load_summary(self.course.pk))
+        # 渡されなかった研究室の行は置き換える場合のみ削除する
+        save_summary(self.course.pk, summary[:1])
+        self.assertEqual(len(before), LabSummary.objects.count())
+        save_summary(self.course.pk, summary[:1], replace_all=True)
+        self.assertEqual(4, LabSummary.objects.count())
+
+    @override_settings(SUMMARY_DEBOUNCE_SECONDS=60)
+    def test_stale_rows_are_not_served(self):
+        """古くなったことが記録されている間は，キャッシュが無くても保存されたサマリーを返さない"""
+        update_summary_cache(self.course)
+        user = self.users[0]
+        ranks = self.submit_ranks(self.labs[::-1], user)
+        update_summary_for_user(self.course, user, [rank.lab_id for rank in ranks])
+        # 再集計済みの間隔内でキャッシュが消えた
+        cache.clear()
+        cache.add(f"course-summary-debounce-{self.course.pk}", True, 60)
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+        self.assertEqual(make_summary_cache(self.course), load_summary(self.course.pk))
+
+    def test_rebuild_command(self):
+        """管理コマンドでLabSummaryを作り直す"""
+        LabSummary.objects.all().delete()
+        call_command('rebuild_summaries', self.course.pk, stdout=StringIO())
+        self.assertEqual(make_summary_cache(self.course), load_summary(self.course.pk))
+
+@skipUnless(kernels.is_available(), 'NumPy is not installed')
+class SummaryKernelTest(TestCase):
+
+    labs = [{'pk': 1, 'name': 'Lab A', 'capacity': 2}, {'pk': 2, 'name': 'Lab B', 'capacity': 3}]
+
+    def test_border_is_sorted(self):
+        """並び順に関わらず降順でrank_limit番目のGPAをボーダーとする"""
+        rows = [(1, 0, 2.0), (1, 0, 3.5), (1, 0, 1.0), (1, 0, 4.0), (1, 1, 2.5)]
+        summary = kernels.summarize_labs(self.labs, rows, 3, True)
+        self.assertEqual(
+            {'border': 2.0, 'mean': 2.625, 'median': 2.75, 'max': 4.0, 'min': 1.0, 'count': 4},
+            summary[0]['detail'][0]
+        )
+        # 人数がrank_limitに満たない場合は最も低いGPA
+        self.assertEqual(2.5, summary[0]['detail'][1]['border'])
+        self.assertEqual(
+            {'border': 0.0, 'mean': 0.0, 'median': 0.0, 'max': 0.0, 'min': 0.0, 'count': 0},
+            summary[1]['abstract']
+        )
+        self.assertEqual(5, summary[0]['abstract']['count'])
+        self.assertEqual(2.5, summary[0]['abstract']['border'])
+
+    def test_same_as_python(self):
+        """純Pythonの実装と同じ結果を返す"""
+        rows = [(lab['pk'], (i * 7) % 3, round((i * 37 % 41) / 10, 2)) for i, lab in enumerate(self.labs * 20)]
+        config = {'rank_limit': 3, 'show_gpa': True}
+        for show_gpa in [True, False]:
+            config['show_gpa'] = show_gpa
+            gpa_sets = {lab['pk']: {order: [] for order in range(3)} for lab in self.labs}
+            for lab_pk, order, gpa in rows:
+                gpa_sets[lab_pk][order].append(gpa)
+            summary = kernels.summarize_labs(self.labs, rows, 3, show_gpa)
+            for lab, summary_per_lab in zip(self.labs, summary):
+                metrics = Summary(None, config, gpa_sets[lab['pk']])
+                for order in range(3):
+                    with self.subTest(show_gpa=show_gpa, lab=lab['pk'], order=order):
+                        self.assert_fragment_equal(metrics.summarize(order), summary_per_lab['detail'][order])
+                with self.subTest(show_gpa=show_gpa, lab=lab['pk'], order=None):
+                    self.assert_fragment_equal(metrics.summarize_all(), summary_per_lab['abstract'])
+
+    def test_exactly_same_as_python_and_delta(self):
+        """平均値を含め，純Pythonの実装と差分更新の多重集合とビット単位で一致する"""
+        random = Random(0)
+        for case in range(300):
+            rank_limit = random.randint(1, 4)
+            config = {'rank_limit': rank_limit, 'show_gpa': True}
+            rows = [
+                (random.choice(self.labs)['pk'], random.randrange(rank_limit),
+                 random.choice([round(random.uniform(0, 4.3), 2), random.uniform(0, 4.3)]))
+                for _ in range(random.randint(0, 40))
+            ]
+            summary = kernels.summarize_labs(self.labs, rows, rank_limit, True)
+            for lab, summary_per_lab in zip(self.labs, summary):
+                gpa_set = {order: [gpa for lab_pk, row_order, gpa in rows if lab_pk == lab['pk'] and row_order == order]
+                           for order in range(rank_limit)}
+                metrics = Summary(None, config, gpa_set)
+                fragments = [(order, metrics.summarize(order), summary_per_lab['detail'][order])
+                             for order in range(rank_limit)]
+                fragments.append((None, metrics.summarize_all(), summary_per_lab['abstract']))
+                for order, expected, actual in fragments:
+                    multiset = GPAMultiset()
+                    values = list(chain.from_iterable(gpa_set.values())) if order is None else gpa_set[order]
+                    for gpa in values:
+                        multiset.add(gpa)
+                    with self.subTest(case=case, lab=lab['pk'], order=order):
+                        self.assertEqual(expected, actual)
+                        self.assertEqual(multiset.summarize(rank_limit, True), actual)
+
+    def assert_fragment_equal(self, expected, actual):
+        self.assertEqual(expected.keys(), actual.keys())
+        for key in expected.keys():
+            self.assertAlmostEqual(expected[key], actual[key])
+
+
+class CachingTest(TestCase):
+
+    key = 'caching-test'
+
+    def setUp(self):
+        cache.clear()
+        self.compute = MagicMock(return_value='new')
+
+    def test_fresh(self):
+        """ソフトTTL内であれば再計算しない"""
+        caching.set_value(self.key, 'old')
+        self.assertEqual('old', caching.get_or_compute(self.key, self.compute))
+        self.compute.assert_not_called()
+
+    @override_settings(CACHE_SOFT_TTL=0)
+    def test_stale(self):
+        """ソフトTTLを過ぎていれば再計算し，他が再計算中であれば古い値を返す"""
+        caching.set_value(self.key, 'old')
+        cache.add(f'{self.key}-lock', True)
+        self.assertEqual('old', caching.get_or_compute(self.key, self.compute))
+        self.compute.assert_not_called()
+        cache.delete(f'{self.key}-lock')
+        self.assertEqual('new', caching.get_or_compute(self.key, self.compute))
+        self.compute.assert_called_once_with()
+        self.assertIsNone(cache.get(f'{self.key}-lock'))
+
+    @override_settings(CACHE_LOCK_TIMEOUT=0)
+    def test_missing_while_locked(self):
+        """値が無く他が再計算中の場合，待っても値ができなければ自分で計算する"""
+        cache.add(f'{self.key}-lock', True, 60)
+        self.assertEqual('new', caching.get_or_compute(self.key, self.compute))
+        self.assertEqual('new', caching.get_value(self.key))
+
+    @override_settings(CACHE_VERSION_CHECK=True, CACHE_VERSION_TTL=0)
+    def test_version_changed_by_other_worker(self):
+        """他のワーカーがバージョンを上げた場合，手元のキャッシュは使わずに再計算する"""
+        caching.publish(self.key, 'old')
+        self.assertEqual('old', caching.get_or_compute(self.key, self.compute))
+        # 他のワーカーによる更新
+        CacheVersion.objects.filter(key=self.key).update(version=F('version') + 1)
+        self.assertEqual('new', caching.get_or_compute(self.key, self.compute))
+        self.compute.assert_called_once_with()
+        self.assertEqual('new', caching.get_or_compute(self.key, self.compute))
+        self.compute.assert_called_once_with()
+
+
+
+class SummaryStreamTest(TestCase):
+
+    def test_diff_summary(self):
+        """変更された研究室と削除された研究室のみを差分とする"""
+        previous = [{'pk': 1, 'count': 1}, {'pk': 2, 'count': 2}, {'pk': 3, 'count': 3}]
+        current = [{'pk': 1, 'count': 1}, {'pk': 2, 'count': 5}, {'pk': 4, 'count': 0}]
+        self.assertEqual(
+            {'updated': [{'pk': 2, 'count': 5}, {'pk': 4, 'count': 0}], 'removed': [3]},
+            diff_summary(previous, current)
+        )
+
+    @override_settings(SUMMARY_STREAM_MAX_SECONDS=1, SUMMARY_STREAM_INTERVAL=0.3)
+    def test_stream_summary(self):
+        """接続を保持している間に課程のバージョンが変わったときのみサマリーを読み出し，差分を送る"""
+        course = Course(pk=1)
+        versions = [CourseVersion(1, None), CourseVersion(1, None), CourseVersion(2, None), CourseVersion(3, None)]
+        summaries = [[{'pk': 1, 'count': 1}], [{'pk': 1, 'count': 2}], [{'pk': 1, 'count': 3}]]
+        with patch('courses.services.stream.get_course_version', side_effect=versions), \
+                patch('courses.services.stream.is_summary_stale', side_effect=[False, False, True]), \
+                patch('courses.services.stream.get_summary', side_effect=summaries) as get_summary:
+            events = [event for event in stream_summary(course) if not event.startswith(':')]
+        self.assertEqual(3, get_summary.call_count)
+        self.assertEqual(3, len(events))
+        self.assertIn('id: 1\nevent: summary', events[1])
+        self.assertIn('id: 2\nevent: diff', events[2])
+        self.assertIn('"count": 2', events[2])
+
+
+class CourseSnapshotTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(CourseSnapshotTest, self).setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.course = Course.objects.create_course(**self.course_data_set[0])
+        self.labs = self.create_labs(self.course)
+        self.users = [User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set]
+        for user, gpa in zip(self.users, [2.0, None, 4.0]):
+            self.course.join(user, self.course_data_set[0]['pin_code'])
+            User.objects.filter(pk=user.pk).update(gpa=gpa, screen_name='hoge' if gpa else None)
+        # 2人目は志望順位を提出していない
+        self.submit_ranks(self.labs, self.users[0])
+        self.submit_ranks(self.labs[::-1], self.users[2])
+
+    def test_load(self):
+        """研究室と，参加者とその志望順位をそれぞれ1回のクエリで読み込む"""
+        get_config_cache(self.course.pk)
+        with self.assertNumQueries(2):
+            snapshot = CourseSnapshot.load(self.course.pk)
+        self.assertEqual(sorted(user.pk for user in self.users), list(snapshot.user_pks))
+        self.assertEqual([lab.pk for lab in self.labs], list(snapshot.lab_pks))
+        self.assertEqual([2.0, None, 4.0], [snapshot.get_gpa(snapshot.index(user.pk)) for user in self.users])
+        self.assertEqual([1, 0, 1], [snapshot.screen_name[snapshot.index(user.pk)] for user in self.users])
+        self.assertEqual([3, 0, 3], [snapshot.rank_counts[snapshot.index(user.pk)] for user in self.users])
+        self.assertEqual([NO_RANK] * 3, list(snapshot.get_ranks(snapshot.index(self.users[1].pk))))
+        self.assertEqual([2, 1, 0], list(snapshot.get_ranks(snapshot.index(self.users[2].pk))))
+        self.assertEqual(-1, snapshot.index(9999))
+        # 配属の入力には志望順位を提出したユーザのみを含める
+        data = assignment.load_assignment_input(self.course)
+        self.assertEqual([self.users[0].pk, self.users[2].pk], data.user_pks)
+        self.assertEqual([[0, 1, 2], [2, 1, 0]], data.prefs)
+
+    def test_get_course_snapshot(self):
+        """課程のバージョンが変わるまでキャッシュしたスナップショットを共有する"""
+        snapshot = get_course_snapshot(self.course.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(snapshot.version, get_course_snapshot(self.course.pk).version)
+        self.users[1].gpa = 3.0
+        self.users[1].save(update_fields=['gpa'])
+        snapshot = get_course_snapshot(self.course.pk)
+        self.assertEqual(get_course_version(self.course.pk).version, snapshot.version)
+        self.assertEqual(3.0, snapshot.get_gpa(snapshot.index(self.users[1].pk)))
+
+    def test_snapshot_is_not_reused_after_rollback(self):
+        """取り消されたトランザクションで作ったスナップショットは，同じバージョンになっても使わない"""
+        with self.assertRaises(ValueError), transaction.atomic():
+            User.objects.filter(pk=self.users[1].pk).update(gpa=1.0)
+            bump_course_version(self.course.pk)
+            snapshot = get_course_snapshot(self.course.pk)
+            self.assertEqual(1.0, snapshot.get_gpa(snapshot.index(self.users[1].pk)))
+            raise ValueError
+        self.users[1].gpa = 3.0
+        self.users[1].save(update_fields=['gpa'])
+        snapshot = get_course_snapshot(self.course.pk)
+        self.assertEqual(3.0, snapshot.get_gpa(snapshot.index(self.users[1].pk)))
+
+    def test_status_does_not_load_snapshot(self):
+        """ステータスはキャッシュされたスナップショットが無ければユーザごとのクエリで求め，課程全体は読み込まない"""
+        get_config_cache(self.course.pk)
+        get_course_version(self.course.pk)
+        self.assertIsNone(get_cached_snapshot(self.course.pk))
+        with self.assertNumQueries(4):
+            statuses = [Status.from_user_instance(user, self.course.pk).type_str for user in self.users[:2]]
+        self.assertIsNone(get_cached_snapshot(self.course.pk))
+        get_course_snapshot(self.course.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(statuses, [Status.from_user_instance(user, self.course.pk).type_str
+                                        for user in self.users[:2]])
+        outsider = User.objects.create_user(username='outsider', password='hogefuga')
+        self.assertEqual(Status.PENDING, Status.from_user_instance(outsider, self.course.pk).type_str)
+
+    def test_nbytes(self):
+        """数千人の課程でも数百KBに収まる"""
+        rank_limit, n_users = 5, 5000
+        snapshot = CourseSnapshot(self.course.pk, 0, rank_limit, range(50), ['lab'] * 50, [10] * 50)
+        for user_pk in range(n_users):
+            snapshot._append_user(user_pk, 3.0, 'hoge')
+        self.assertLess(snapshot.nbytes, 300 * 1024)
+        self.assertLess(len(pickle.dumps(snapshot)), 400 * 1024)
+
+
+class SummaryHistoryTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(SummaryHistoryTest, self).setUp()
+        cache.clear()
+        course_data = self.course_data_set[0]
+        self.course = Course.objects.create_course(**course_data)
+        self.update_config(self.course.config, {'show_gpa': True})
+        self.users = [
+            User.objects.create_user(**user_data, gpa=i + 1.5, is_active=True)
+            for i, user_data in enumerate(self.user_data_set)
+        ]
+        self.labs = self.create_labs(self.course)
+        for user in self.users:
+            self.course.join(user, course_data['pin_code'])
+        self.now = timezone.now()
+
+    def take_snapshots(self, count: int) -> 'list':
+        """志望順位を1人ずつ提出しながらスナップショットを取り，各時点のサマリーを返す"""
+        summaries = []
+        for i, user in enumerate(self.users[:count]):
+            self.submit_ranks(self.labs[i:] + self.labs[:i], user)
+            update_summary_cache(self.course)
+            take_snapshot(self.course, self.now + timedelta(minutes=i))
+            summaries.append(get_summary(self.course))
+        return summaries
+
+    def test_take_snapshot(self):
+        """変わった研究室のみを差分として保存する"""
+        self.take_snapshots(1)
+        self.assertEqual(len(self.labs), LabSummarySnapshot.objects.filter(is_keyframe=True).count())
+        self.assertEqual(0, take_snapshot(self.course, self.now + timedelta(minutes=1)))
+        self.users[0].gpa = 3.5
+        self.users[0].save(update_fields=['gpa'])
+        # 1人目は上位rank_limit件の研究室のみを志望している
+        self.assertEqual(self.course.config.rank_limit, take_snapshot(self.course, self.now + timedelta(minutes=2)))
+        self.assertFalse(LabSummarySnapshot.objects.filter(taken_at=self.now + timedelta(minutes=2),
+                                                           is_keyframe=True).exists())
+
+    @override_settings(SUMMARY_HISTORY_KEYFRAME_INTERVAL=2)
+    def test_get_lab_history(self):
+        """キーフレームと差分から各時点のサマリーを復元する"""
+        summaries = self.take_snapshots(len(self.users))
+        self.assertTrue(LabSummarySnapshot.objects.filter(is_keyframe=False).exists())
+        for index, lab in enumerate(self.labs):
+            expected = [
+                {'taken_at': self.now + timedelta(minutes=i), 'summary': summary[index]}
+                for i, summary in enumerate(summaries)
+            ]
+            # 変わらなかった時点は保存されない
+            expected = [item for i, item in enumerate(expected)
+                        if i == 0 or item['summary'] != expected[i - 1]['summary']]
+            with self.subTest(lab=lab):
+                self.assertEqual(expected, get_lab_history(lab))
+                since, until = self.now + timedelta(minutes=1), self.now + timedelta(minutes=2)
+                in_range = [item for item in expected if item['taken_at'] <= since][-1:] + \
+                    [item for item in expected if since < item['taken_at'] <= until]
+                self.assertEqual(in_range, get_lab_history(lab, since=since, until=until))
+
+    def test_get_lab_history_hides_gpa(self):
+        """GPAを表示しない設定に変えた後は，GPAを表示していた間の履歴からもGPAの統計量を除く"""
+        self.take_snapshots(2)
+        self.update_config(self.course.config, {'show_gpa': False})
+        history = get_lab_history(self.labs[0])
+        self.assertEqual(2, len(history))
+        for item in history:
+            fragments = item['summary']['detail'] + [item['summary']['abstract']]
+            self.assertTrue(all(set(fragment.keys()) == {'count'} for fragment in fragments))
+
+
+class ApplicantQueryTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(ApplicantQueryTest, self).setUp()
+        course_data = self.course_data_set[0]
+        self.course = Course.objects.create_course(**course_data)
+        self.users = [
+            User.objects.create_user(**user_data, gpa=i + 1.5, is_active=True)
+            for i, user_data in enumerate(self.user_data_set)
+        ]
+        self.labs = self.create_labs(self.course)
+        for i, user in enumerate(self.users):
+            self.course.join(user, course_data['pin_code'])
+            self.submit_ranks(self.labs[i:] + self.labs[:i], user)
+        self.rank_limit = self.course.config.rank_limit
+
+    def test_paginate(self):
+        """全ての志望順位の志望者を1回のクエリで読み込む"""
+        ranks = Rank.objects.filter(lab=self.labs[0])
+        with self.assertNumQueries(1):
+            ranks_per_order, cursors = ApplicantQuery().paginate(ranks, self.rank_limit)
+            # ユーザも同じクエリで読み込む
+            users = [[rank.user.pk for rank in page] for page in ranks_per_order]
+        for order, page in enumerate(users):
+            expected = ranks.filter(order=order).order_by('pk').values_list('user_id', flat=True)
+            self.assertEqual(list(expected), page)
+        self.assertEqual([None] * self.rank_limit, cursors)
+
+    def test_paginate_by_union(self):
+        """MySQLなどでは志望順位ごとのLIMIT付きのSELECTをUNION ALLでまとめた1回のクエリで読み込む"""
+        ranks = Rank.objects.filter(course=self.course)
+        query = ApplicantQuery(sort='gpa', limit=1)
+        expected = query.paginate(ranks, self.rank_limit)
+
+        def run_as_subqueries(execute, sql, params, many, context):
+            # SQLiteは括弧で囲んだ複合文に対応しないため，各SELECTをサブクエリとして実行する
+            if ' UNION ALL ' in sql:
+                sql = ' UNION ALL '.join(f'SELECT * FROM {part}' for part in sql.split(' UNION ALL '))
+            return execute(sql, params, many, context)
+
+        features = connection.features
+        with patch.object(features, 'supports_slicing_ordering_in_compound', True), \
+                connection.execute_wrapper(run_as_subqueries), CaptureQueriesContext(connection) as queries:
+            actual = query.paginate(ranks, self.rank_limit)
+        self.assertEqual(1, len(queries))
+        sql = queries[0]['sql']
+        self.assertEqual(self.rank_limit - 1, sql.count(' UNION ALL '))
+        self.assertEqual(self.rank_limit, sql.count('LIMIT 2'))
+        self.assertEqual([[rank.pk for rank in page] for page in expected[0]],
+                         [[rank.pk for rank in page] for page in actual[0]])
+        self.assertEqual(expected[1], actual[1])
+        self.assertTrue(all(actual[1]))
+
+    def test_paginate_by_gpa(self):
+        """GPAの降順にカーソルで次のページを読み込む"""
+        ranks = Rank.objects.filter(course=self.course, order=0)
+        expected = [user.pk for user in sorted(self.users, key=lambda user: -user.gpa)]
+        actual, cursor = [], None
+        for _ in expected:
+            query = ApplicantQuery(sort='gpa', order=0, cursor=cursor, limit=1)
+            ranks_per_order, cursors = query.paginate(ranks, self.rank_limit)
+            actual += [rank.user_id for rank in ranks_per_order[0]]
+            cursor = cursors[0]
+        self.assertEqual(expected, actual)
+        self.assertIsNone(cursor)
+        with self.assertRaises(ValidationError):
+            ApplicantQuery(sort='gpa', cursor='invalid')
+
+    def test_invalid_cursor(self):
+        """カーソルの全ての要素の型を検証する"""
+        def encode(key):
+            return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+        ApplicantQuery(sort='gpa', cursor=encode([3.5, 1]))
+        ApplicantQuery(sort='gpa', cursor=encode([None, 1]))
+        ApplicantQuery(cursor=encode([1]))
+        for sort, key in [('gpa', ['3.5', 1]), ('gpa', [{}, 1]), ('gpa', [True, 1]), ('gpa', [3.5, '1']),
+                          ('gpa', [3.5, 1.0]), ('gpa', [1]), ('default', [True]), ('default', [None]),
+                          ('default', {'pk': 1})]:
+            with self.subTest(sort=sort, key=key), self.assertRaises(ValidationError):
+                ApplicantQuery(sort=sort, cursor=encode(key))
+        with self.assertRaises(ValidationError):
+            ApplicantQuery(sort='gpa', cursor=base64.urlsafe_b64encode(b'[NaN, 1]').decode())
+
+    def test_paginate_limit_per_order(self):
+        """志望順位を指定しない場合も，志望順位ごとにlimit+1人までをSQLで絞り込む"""
+        # 志望順位ごとに3人
+        ranks = Rank.objects.filter(course=self.course)
+        for sort in ('default', 'gpa'):
+            with self.subTest(sort=sort):
+                query = ApplicantQuery(sort=sort, limit=1)
+                with self.assertNumQueries(1):
+                    ranks_per_order, cursors = query.paginate(ranks, self.rank_limit)
+                selected = query._first_pages(ranks.filter(order__lt=self.rank_limit).select_related('user')
+                                              .order_by('order', *query._ordering()), self.rank_limit)
+                self.assertEqual([2] * self.rank_limit,
+                                 [len([rank for rank in selected if rank.order == order])
+                                  for order in range(self.rank_limit)])
+                for order, page in enumerate(ranks_per_order):
+                    expected = ApplicantQuery(sort=sort, order=order, limit=1).paginate(ranks, self.rank_limit)
+                    self.assertEqual(expected[0][order], page)
+                    self.assertEqual(expected[1][order], cursors[order])
+
+
+class IdempotencyTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(IdempotencyTest, self).setUp()
+        self.user = User.objects.create_user(**self.user_data_set[0], is_active=True)
+
+    def test_replay(self):
+        """処理が終わったリクエストのレスポンスを返す"""
+        record, created = begin_request(self.user, 'key', 'fingerprint')
+        self.assertTrue(created)
+        record, created = begin_request(self.user, 'key', 'fingerprint')
+        self.assertFalse(created)
+        # 処理中
+        self.assertIsNone(load_response(record))
+        complete_request(record, 201, '{"pk":1}', {'Location': '/'})
+        record, created = begin_request(self.user, 'key', 'fingerprint')
+        self.assertEqual((201, '{"pk":1}', {'Location': '/'}), load_response(record))
+
+    @override_settings(IDEMPOTENCY_MAX_KEYS_PER_USER=2, IDEMPOTENCY_MAX_RESPONSE_BYTES=100)
+    def test_bounded(self):
+        """ユーザごとのキーの数，有効期限，レスポンスの大きさで保存する量を制限する"""
+        for i in range(3):
+            begin_request(self.user, f'key-{i}', 'fingerprint')
+        self.assertEqual(['key-1', 'key-2'], sorted(IdempotencyKey.objects.values_list('key', flat=True)))
+        # 大きすぎるレスポンスは保存しない
+        record, _ = begin_request(self.user, 'key-2', 'fingerprint')
+        complete_request(record, 201, 'x' * 100, {})
+        self.assertFalse(IdempotencyKey.objects.filter(key='key-2').exists())
+        # 有効期限を過ぎたキーは引き継ぎ，他のキーはコマンドで削除する
+        begin_request(self.user, 'key-3', 'fingerprint')
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(days=1))
+        _, created = begin_request(self.user, 'key-1', 'fingerprint')
+        self.assertTrue(created)
+        self.assertEqual(2, IdempotencyKey.objects.count())
+        self.assertEqual(1, purge_expired_keys())
+        self.assertEqual(['key-1'], list(IdempotencyKey.objects.values_list('key', flat=True)))
+
+    @override_settings(IDEMPOTENCY_LEASE=30)
+    def test_lease(self):
+        """処理中のままリースを過ぎたキーは再送されたリクエストが引き継ぐ"""
+        begin_request(self.user, 'key', 'fingerprint')
+        record, created = begin_request(self.user, 'key', 'fingerprint')
+        self.assertFalse(created)
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(seconds=31))
+        record, created = begin_request(self.user, 'key', 'fingerprint')
+        self.assertTrue(created)
+        self.assertIsNone(load_response(record))
+        # 引き継いだリクエストの処理中は409を返す
+        _, created = begin_request(self.user, 'key', 'fingerprint')
+        self.assertFalse(created)
+        # 処理が終わったキーはリースを過ぎても引き継がない
+        complete_request(record, 201, '{}', {})
+        IdempotencyKey.objects.update(created_at=timezone.now() - timedelta(seconds=31))
+        record, created = begin_request(self.user, 'key', 'fingerprint')
+        self.assertFalse(created)
+        self.assertEqual(201, load_response(record)[0])
+
+
+class RankImportTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(RankImportTest, self).setUp()
+        cache.clear()
+        course_data = self.course_data_set[0]
+        self.course = Course.objects.create_course(**course_data)
+        self.users = [User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set]
+        self.labs = self.create_labs(self.course)
+        for user in self.users:
+            self.course.join(user, course_data['pin_code'])
+
+    def make_lines(self) -> 'list':
+        lines = ['username,order,lab\n']
+        for i, user in enumerate(self.users):
+            for order, lab in enumerate(self.labs[i:] + self.labs[:i]):
+                lines.append(f'{user.username},{order + 1},{lab.name}\n')
+        return lines
+
+    @override_settings(IMPORT_CHUNK_SIZE=2)
+    def test_import_ranks(self):
+        """CSVの志望順位をまとめて登録し，サマリーを作り直す"""
+        get_summary(self.course)
+        # 既存の志望順位は上書きする
+        self.submit_ranks(self.labs, self.users[1])
+        result = import_ranks(self.course, self.make_lines())
+        self.assertEqual([], result.errors)
+        self.assertEqual(len(self.users) * len(self.labs), result.imported)
+        for i, user in enumerate(self.users):
+            with self.subTest(user=user):
+                actual = Rank.objects.filter(course=self.course, user=user).order_by('order') \
+                    .values_list('lab_id', flat=True)
+                self.assertEqual([lab.pk for lab in self.labs[i:] + self.labs[:i]], list(actual))
+                self.assertEqual(1, RankSetVersion.objects.get_version(self.course, user))
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+        # 変更履歴はユーザごとに1件ずつ
+        self.assertEqual(len(self.users), RankChange.objects.filter(source=RankChange.SOURCE_IMPORT).count())
+
+    def test_import_ranks_with_errors(self):
+        """誤りがあれば何も登録しない"""
+        lines = self.make_lines()
+        lines[1] = 'unknown,1,Lab A\n'
+        lines.append(f'{self.users[0].username},4,{self.labs[0].name}\n')
+        lines.append(f'{self.users[0].username},1,Lab Z\n')
+        result = import_ranks(self.course, lines)
+        self.assertEqual(0, result.imported)
+        self.assertEqual([0, 2, len(lines) - 1, len(lines)], sorted(error['line'] for error in result.errors))
+        self.assertFalse(Rank.objects.filter(course=self.course).exists())
+        # 検証のみ
+        result = import_ranks(self.course, self.make_lines(), dry_run=True)
+        self.assertEqual([], result.errors)
+        self.assertFalse(Rank.objects.filter(course=self.course).exists())
+        self.assertFalse(RankChange.objects.exists())
+
+
+class RankChangeTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(RankChangeTest, self).setUp()
+        self.course = Course.objects.create_course(**self.course_data_set[0])
+        self.users = [User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set]
+        self.labs = self.create_labs(self.course)
+        self.addCleanup(flush_rank_changes)
+
+    @override_settings(RANK_CHANGE_BUFFER_SIZE=2)
+    def test_rank_change_buffer(self):
+        """バッファが一杯になるか，with文を抜ける際にまとめて追記する"""
+        lab_pks = [lab.pk for lab in self.labs]
+        with RankChangeBuffer(self.course.pk, RankChange.SOURCE_IMPORT) as buffer:
+            with self.assertNumQueries(0):
+                buffer.add(self.users[0].pk, lab_pks)
+            with self.assertNumQueries(1):
+                buffer.add(self.users[1].pk, lab_pks)
+            buffer.add(self.users[2].pk, lab_pks[::-1])
+        self.assertEqual(3, buffer.written)
+        # 例外の場合は破棄する
+        with self.assertRaises(ValueError):
+            with RankChangeBuffer(self.course.pk) as buffer:
+                buffer.add(self.users[0].pk, lab_pks)
+                raise ValueError
+        self.assertEqual(3, RankChange.objects.count())
+
+    @override_settings(RANK_CHANGE_BUFFER_SIZE=2, RANK_CHANGE_FLUSH_SECONDS=60)
+    def test_append_rank_change_batches(self):
+        """提出ごとの変更はキューにためて，まとめて1回で追記する"""
+        lab_pks = [lab.pk for lab in self.labs]
+        with self.assertNumQueries(0):
+            append_rank_change(self.course.pk, self.users[0].pk, lab_pks)
+        self.assertEqual(0, RankChange.objects.count())
+        with self.assertNumQueries(1):
+            append_rank_change(self.course.pk, self.users[1].pk, lab_pks[::-1])
+        self.assertEqual(2, RankChange.objects.count())
+        append_rank_change(self.course.pk, self.users[2].pk, lab_pks)
+        self.assertEqual(1, flush_rank_changes())
+        self.assertEqual(0, flush_rank_changes())
+        self.assertEqual(3, RankChange.objects.count())
+
+    @override_settings(RANK_CHANGE_BUFFER_SIZE=100, RANK_CHANGE_FLUSH_SECONDS=0)
+    def test_append_rank_change_flushes_old_entries(self):
+        """最も古い変更が一定時間たっていれば件数に満たなくても追記する"""
+        append_rank_change(self.course.pk, self.users[0].pk, [self.labs[0].pk])
+        self.assertEqual(1, RankChange.objects.count())
+
+    def test_get_rank_changes(self):
+        """課程とユーザを指定して新しい順に取得する"""
+        for i in range(3):
+            for user in self.users[:2]:
+                append_rank_change(self.course.pk, user.pk, [self.labs[i].pk])
+        changes, before = get_rank_changes(self.course, user_pk=self.users[0].pk, limit=2)
+        self.assertEqual([[self.labs[2].pk], [self.labs[1].pk]], [change.lab_pks for change in changes])
+        changes, before = get_rank_changes(self.course, user_pk=self.users[0].pk, before=before, limit=2)
+        self.assertEqual([[self.labs[0].pk]], [change.lab_pks for change in changes])
+        self.assertIsNone(before)
+        changes, _ = get_rank_changes(self.course)
+        self.assertEqual(6, len(changes))
+
+
+class FreezeTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(FreezeTest, self).setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        course_data = self.course_data_set[0]
+        self.course = Course.objects.create_course(**course_data)
+        self.users = [User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set]
+        self.labs = self.create_labs(self.course)
+        for user in self.users:
+            self.course.join(user, course_data['pin_code'])
+        self.course.register_as_admin(self.users[0])
+
+    def test_freeze_course(self):
+        """凍結時のレスポンスと閲覧できるユーザを保存する"""
+        self.submit_ranks(self.labs, self.users[1])
+        self.assertIsNone(get_frozen(self.course.pk))
+        freeze_course(self.course)
+        frozen = get_frozen(self.course.pk)
+        self.assertEqual({self.users[0].pk}, frozen['admins'])
+        self.assertEqual({user.pk for user in self.users}, frozen['course_readers'])
+        self.assertEqual({self.users[1].pk}, frozen['rank_readers'])
+        self.assertEqual(get_summary(self.course), get_frozen_payload(frozen, 'summary'))
+        self.assertIsNone(get_frozen_payload(frozen, 'lab-0'))
+        self.assertTrue(unfreeze_course(self.course))
+        self.assertIsNone(get_frozen(self.course.pk))
+        self.assertFalse(unfreeze_course(self.course))
+
+
+class AssignmentTest(DatasetMixin, TestCase):
+
+    # 研究室0，1，2の許容人数はそれぞれ1人
+    prefs = [[0, 1, 2], [0, 2, 1], [0, 1, 2], [1, 0, 2]]
+    gpa = [3.0, 3.5, None, 2.0]
+    capacity = [1, 1, 1]
+
+    def test_serial_dictatorship(self):
+        """GPAの高い順に空きのある研究室に配属し，GPA未入力のユーザは最後とする"""
+        assigned = assignment.serial_dictatorship(self.prefs, self.gpa, self.capacity)
+        self.assertEqual([1, 0, -1, 2], assigned)
+        self.assertEqual([3.5, 3.0, 2.0], assignment.lab_cutoffs(assigned, self.gpa, self.capacity))
+        self.assertEqual([None, None, None], assignment.lab_cutoffs(assigned, self.gpa, [2, 2, 2]))
+
+    def test_deferred_acceptance(self):
+        """全ての研究室が同じGPA順で受け入れる場合はシリアルディクテイターシップと一致する"""
+        random = Random(0)
+        n_users, n_labs = 300, 20
+        prefs = [random.sample(range(n_labs), 3) + [-1] for _ in range(n_users)]
+        gpa = [random.choice([None, 1.0, 2.0, 2.5, 3.0, 4.0]) for _ in range(n_users)]
+        capacity = [random.randint(0, 12) for _ in range(n_labs)]
+        expected = assignment.serial_dictatorship(prefs, gpa, capacity)
+        for backend in ('auto', 'python'):
+            with self.subTest(backend=backend), self.settings(SUMMARY_BACKEND=backend):
+                self.assertEqual(expected, assignment.deferred_acceptance(prefs, gpa, capacity))
+
+    @skipUnless(kernels.is_available(), 'NumPy is not installed')
+    def test_deferred_acceptance_with_scores(self):
+        """研究室ごとの優先順位で受け入れる"""
+        import numpy as np
+        # 研究室1はユーザ3を最も優先する
+        scores = np.array([[1, 0, 3, 2], [3, 2, 1, 0], [0, 1, 2, 3]])
+        assigned = assignment.deferred_acceptance(self.prefs, self.gpa, self.capacity, scores)
+        self.assertEqual([2, 0, -1, 1], assigned)
+
+    def test_get_assignment(self):
+        """課程の志望順位から配属を予測する"""
+        cache.clear()
+        course = Course.objects.create_course(**self.course_data_set[0])
+        labs = self.create_labs(course)
+        users = [User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set]
+        for user, gpa in zip(users, [2.0, 3.0, 4.0]):
+            course.join(user, self.course_data_set[0]['pin_code'])
+            User.objects.filter(pk=user.pk).update(gpa=gpa)
+            self.submit_ranks(labs, user)
+        # 研究室Aの許容人数は2人
+        expected = {users[0].pk: labs[1].pk, users[1].pk: labs[0].pk, users[2].pk: labs[0].pk}
+        for mechanism in (assignment.MECHANISM_SERIAL_DICTATORSHIP, assignment.MECHANISM_DEFERRED_ACCEPTANCE):
+            with self.subTest(mechanism=mechanism):
+                result = assignment.get_assignment(course, mechanism)
+                self.assertEqual(expected, result['users'])
+                self.assertEqual({'pk': labs[0].pk, 'capacity': 2, 'count': 2, 'cutoff': 3.0}, result['labs'][0])
+                self.assertEqual(None, result['labs'][1]['cutoff'])
+        # 満足度の最大化ではGPAを使わないため，ボーダーは無い
+        result = assignment.get_assignment(course, assignment.MECHANISM_WELFARE)
+        self.assertEqual({'pk': labs[0].pk, 'capacity': 2, 'count': 2, 'cutoff': None}, result['labs'][0])
+        self.assertEqual({'pk': labs[1].pk, 'capacity': 4, 'count': 1, 'cutoff': None}, result['labs'][1])
+
+
+class WelfareTest(TestCase):
+
+    def brute_force(self, prefs, capacity):
+        """全ての配属を列挙して(配属されない人数, 志望順位の合計)の最小値を求める"""
+        best = None
+        for assigned in product(*[[-1] + [lab for lab in row if lab >= 0] for row in prefs]):
+            if any(assigned.count(lab) > capacity[lab] for lab in range(len(capacity))):
+                continue
+            key = (assigned.count(-1), sum(prefs[i].index(lab) for i, lab in enumerate(assigned) if lab >= 0))
+            best = key if best is None or key < best else best
+        return best
+
+    def test_min_cost_assignment(self):
+        """GPAの優先順位で取り残されるユーザも，他のユーザを第2志望に移して配属する"""
+        prefs = [[0, 1], [0, -1]]
+        self.assertEqual([0, -1], assignment.serial_dictatorship(prefs, [4.0, 3.0], [1, 1]))
+        self.assertEqual([1, 0], welfare.min_cost_assignment(prefs, [1, 1]))
+        self.assertEqual([1, 1, 0], welfare.rank_profile(prefs, [1, 0]))
+
+    def test_optimality(self):
+        """小さな入力で全ての配属を列挙した最適値と一致する"""
+        random = Random(0)
+        for _ in range(200):
+            n_labs = random.randint(1, 4)
+            prefs = [random.sample(range(n_labs), min(3, n_labs)) for _ in range(random.randint(1, 6))]
+            for row in prefs:
+                if random.random() < 0.3:
+                    row[-1] = -1
+            capacity = [random.randint(0, 2) for _ in range(n_labs)]
+            assigned = welfare.min_cost_assignment(prefs, capacity)
+            with self.subTest(prefs=prefs, capacity=capacity):
+                self.assertTrue(all(assigned.count(lab) <= capacity[lab] for lab in range(n_labs)))
+                key = (assigned.count(-1), sum(prefs[i].index(lab) for i, lab in enumerate(assigned) if lab >= 0))
+                self.assertEqual(self.brute_force(prefs, capacity), key)
+
+    def test_benchmark_command(self):
+        """生成したデータで各方式の実行時間と志望順位ごとの人数を出力する"""
+        out = StringIO()
+        call_command('benchmark_assignment', users=50, labs=5, repeat=1, stdout=out)
+        for mechanism in assignment.MECHANISMS:
+            self.assertIn(mechanism, out.getvalue())
+
+
+class AdviceTest(DatasetMixin, TestCase):
+
+    def test_availability_masks(self):
+        """研究室に空きがあるのは，その研究室だけを志望した場合に配属される場合に限る"""
+        random = Random(0)
+        n_users, n_labs = 60, 6
+        prefs = [random.sample(range(n_labs), 3) for _ in range(n_users)]
+        gpa = [random.choice([1.0, 2.0, 2.5, 3.0, 4.0]) for _ in range(n_users)]
+        capacity = [random.randint(0, 12) for _ in range(n_labs)]
+        user_pks = list(range(1, n_users + 1))
+        snapshot = {
+            'input': assignment.AssignmentInput(user_pks, list(range(n_labs)), prefs, gpa, capacity),
+            'gpa_pool': gpa, 'members': frozenset(user_pks),
+        }
+        for i in range(0, n_users, 7):
+            masks, trials = advice.availability_masks(snapshot, user_pks[i], gpa[i], 10)
+            # 不確かな値が無ければ1回で十分
+            self.assertEqual(1, trials)
+            for lab in range(n_labs):
+                alone = prefs[:i] + [[lab, -1, -1]] + prefs[i + 1:]
+                with self.subTest(user=i, lab=lab):
+                    assigned = assignment.serial_dictatorship(alone, gpa, capacity)
+                    self.assertEqual(assigned[i] == lab, bool(masks[lab]))
+        # 未提出のユーザがいれば抽出して試行を繰り返す
+        snapshot['members'] = frozenset(user_pks + [n_users + 1, n_users + 2])
+        _, trials = advice.availability_masks(snapshot, user_pks[0], gpa[0], 10)
+        self.assertEqual(10, trials)
+        with self.settings(ADVISE_WORK_LIMIT=4):
+            self.assertEqual(2, advice.availability_masks(snapshot, user_pks[0], gpa[0], 10)[1])
+
+    def test_search_lists(self):
+        """希望する順を保ったまま，配属される試行の数が多い組から返す"""
+        masks = [0b0011, 0b1100, 0b0111, 0b0001]
+        self.assertEqual([(4, [0, 1]), (4, [1, 2])], advice.search_lists(masks, [0, 1, 2, 3], 2, 2))
+        # 配属される試行を増やさない研究室は加えない
+        self.assertEqual([(3, [2]), (1, [3])], advice.search_lists(masks, [2, 3], 2, 5))
+        self.assertEqual([], advice.search_lists(masks, [0, 1], 0, 5))
+
+    def test_pad_list(self):
+        """候補を先に，配属される試行が多く増える研究室から加え，同数なら希望する順とする"""
+        masks = [0b0001, 0b0110, 0b0011, 0b1000, 0b1111]
+        self.assertEqual([0, 1, 3, 2], advice.pad_list(masks, [0], [0, 3, 1, 2], 4))
+        # 候補に無い研究室は候補の後
+        self.assertEqual([0, 2, 4], advice.pad_list(masks, [0], [0, 2], 3))
+        # 研究室が足りなければ全ての研究室まで
+        self.assertEqual([0, 2, 4, 1, 3], advice.pad_list(masks, [0], [0, 2], 10))
+
+    def test_advise_ranks(self):
+        """志望順位を書き込まずに，配属される確率の高い組を返す"""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        course = Course.objects.create_course(**self.course_data_set[0])
+        labs = self.create_labs(course)
+        users = [User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set]
+        for user, gpa in zip(users, [2.0, 3.0, 4.0]):
+            course.join(user, self.course_data_set[0]['pin_code'])
+            User.objects.filter(pk=user.pk).update(gpa=gpa)
+            user.refresh_from_db()
+            self.submit_ranks(labs, user)
+        version = bump_course_version(course.pk).version
+        ranks = list(Rank.objects.filter(course=course).values_list('pk', 'lab_id'))
+        # 研究室Aの許容人数は2人で，GPAの高い2人で埋まる
+        result = advice.advise_ranks(course, users[0], limit=2)
+        self.assertEqual(version, result['version'])
+        self.assertEqual(
+            [{'labs': [labs[1].pk, labs[0].pk, labs[2].pk], 'probability': 1.0, 'probabilities': [1.0, 0.0, 0.0],
+              'padded': 2},
+             {'labs': [labs[2].pk, labs[0].pk, labs[1].pk], 'probability': 1.0, 'probabilities': [1.0, 0.0, 0.0],
+              'padded': 2}],
+            result['lists']
+        )
+        # 候補に無い研究室は候補の後に加える
+        result = advice.advise_ranks(course, users[2], lab_pks=[labs[2].pk, labs[0].pk])
+        self.assertEqual([labs[2].pk, labs[0].pk, labs[1].pk], result['lists'][0]['labs'])
+        self.assertEqual(ranks, list(Rank.objects.filter(course=course).values_list('pk', 'lab_id')))
+        self.assertEqual(version, get_course_version(course.pk).version)
+
+
+class MatchingTest(DatasetMixin, TestCase):
+
+    def test_random_updates(self):
+        """志望，GPA，許容人数の変更を差分で適用した結果が全体を配属し直した結果と一致する"""
+        random = Random(0)
+        n_users, n_labs = 200, 15
+        prefs = [random.sample(range(n_labs), 3) for _ in range(n_users)]
+        gpa = [random.choice([None, 1.0, 2.0, 2.5, 3.0, 4.0]) for _ in range(n_users)]
+        capacity = [random.randint(0, 15) for _ in range(n_labs)]
+        user_pks = list(range(1, n_users + 1))
+        lab_pks = list(range(101, 101 + n_labs))
+        state = matching.AssignmentState.from_input(
+            assignment.AssignmentInput(user_pks, lab_pks, prefs, gpa, capacity)
+        )
+        previous = state.assigned_labs()
+        for step in range(300):
+            i = random.randrange(n_users)
+            operation = random.random()
+            if operation < 0.5:
+                prefs[i] = random.sample(range(n_labs), 3)
+                moved = state.update_user(user_pks[i], gpa[i], [lab_pks[lab] for lab in prefs[i]])
+            elif operation < 0.8:
+                gpa[i] = random.choice([None, 1.0, 2.0, 2.5, 3.0, 4.0])
+                moved = state.update_user(user_pks[i], gpa[i])
+            else:
+                lab = random.randrange(n_labs)
+                capacity[lab] = random.randint(0, 15)
+                moved = state.set_capacity(lab_pks[lab], capacity[lab])
+            expected = assignment.simulate_assignment(
+                assignment.AssignmentInput(user_pks, lab_pks, prefs, gpa, capacity)
+            )
+            with self.subTest(step=step):
+                self.assertEqual(expected, state.to_result(assignment.MECHANISM_SERIAL_DICTATORSHIP))
+                # 戻り値は配属先が変わったユーザの数
+                self.assertEqual(sum(1 for k, v in previous.items() if expected['users'][k] != v), moved)
+            previous = expected['users']
+        # 配属に影響しない変更では誰も移動しない
+        self.assertEqual(0, state.update_user(user_pks[0], gpa[0]))
+
+    def test_update_assignment_for_user(self):
+        """バージョンを上げた後に差分を適用し，状態のバージョンを課程に追従させる"""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        course = Course.objects.create_course(**self.course_data_set[0])
+        labs = self.create_labs(course)
+        users = [User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set]
+        for user, gpa in zip(users, [2.0, 3.0, 4.0]):
+            course.join(user, self.course_data_set[0]['pin_code'])
+            User.objects.filter(pk=user.pk).update(gpa=gpa)
+            self.submit_ranks(labs, user)
+        bump_course_version(course.pk)
+        state = matching.get_assignment_state(course)
+
+        # 志望の変更．ビューと同様にシグナルを飛ばさずに書き込む
+        for i, lab in enumerate(labs[::-1]):
+            Rank.objects.filter(course=course, user=users[2], order=i).update(lab=lab)
+        bump_course_version(course.pk)
+        self.assertIsNotNone(matching.update_assignment_for_user(course, users[2], [lab.pk for lab in labs[::-1]]))
+        self.assertEqual(state.version + 1, matching.get_assignment_state(course).version)
+        # GPAと許容人数の変更はシグナルから適用される
+        users[0].gpa = 3.5
+        users[0].save(update_fields=['gpa'])
+        labs[0].capacity = 1
+        labs[0].save(update_fields=['capacity'])
+        with self.assertNumQueries(0):
+            state = matching.get_assignment_state(course)
+        expected = assignment.simulate_assignment(assignment.load_assignment_input(course))
+        self.assertEqual(expected, state.to_result(expected['mechanism']))
+        # 取りこぼした変更があれば状態を破棄する
+        bump_course_version(course.pk)
+        bump_course_version(course.pk)
+        self.assertIsNone(matching.update_assignment_for_user(course, users[1]))
+        self.assertIsNone(cache.get(f'course-assignment-state-{course.pk}'))
+
+
+class CapacityTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(CapacityTest, self).setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.course = Course.objects.create_course(**self.course_data_set[0])
+        self.labs = self.create_labs(self.course)
+        self.users = [User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set]
+        for user, gpa in zip(self.users, [2.0, 3.0, 4.0]):
+            self.course.join(user, self.course_data_set[0]['pin_code'])
+            User.objects.filter(pk=user.pk).update(gpa=gpa)
+            self.submit_ranks(self.labs, user)
+        bump_course_version(self.course.pk)
+
+    def test_project_capacities(self):
+        """DBと課程のバージョンを変えずに，許容人数を変更した場合の配属を試算する"""
+        version = get_course_version(self.course.pk).version
+        capacities = {self.labs[0].pk: 1, self.labs[1].pk: 0}
+        data = assignment.load_assignment_input(self.course)
+        for mechanism in assignment.MECHANISMS:
+            with self.subTest(mechanism=mechanism):
+                result = capacity.project_capacities(self.course, capacities, mechanism)
+                expected = assignment.simulate_assignment(
+                    data._replace(capacity=[capacities.get(lab.pk, lab.capacity) for lab in self.labs]), mechanism
+                )
+                self.assertEqual([lab['count'] for lab in expected['labs']],
+                                 [lab['count'] for lab in result['labs']])
+                self.assertEqual(2, result['labs'][0]['current_capacity'])
+                self.assertEqual(1, result['labs'][0]['capacity'])
+                moved = {move['user'] for move in result['moved']}
+                self.assertEqual({k for k, v in expected['users'].items()
+                                  if assignment.get_assignment(self.course, mechanism)['users'][k] != v}, moved)
+        self.assertEqual(version, get_course_version(self.course.pk).version)
+        self.assertEqual(2, Lab.objects.get(pk=self.labs[0].pk).capacity)
+        # 試算しても配属の状態のキャッシュは変わらない
+        self.assertEqual(2, matching.get_assignment_state(self.course).to_result(
+            assignment.MECHANISM_SERIAL_DICTATORSHIP)['labs'][0]['capacity'])
+
+    def test_commit_capacities(self):
+        """許容人数をまとめて更新し，課程のバージョンを1度だけ上げて配属の状態を追従させる"""
+        state = matching.get_assignment_state(self.course)
+        get_summary(self.course)
+        capacities = {self.labs[0].pk: 1, self.labs[2].pk: 5}
+        labs = capacity.commit_capacities(self.course, capacities)
+        self.assertEqual([1, self.labs[1].capacity, 5], [lab.capacity for lab in labs])
+        self.assertEqual(state.version + 1, get_course_version(self.course.pk).version)
+        with self.assertNumQueries(0):
+            state = matching.get_assignment_state(self.course)
+        expected = assignment.simulate_assignment(assignment.load_assignment_input(self.course))
+        self.assertEqual(expected, state.to_result(expected['mechanism']))
+        self.assertEqual(make_summary_cache(self.course), get_summary(self.course))
+
+
+class ProbabilityTest(DatasetMixin, TestCase):
+
+    def setUp(self):
+        super(ProbabilityTest, self).setUp()
+        cache.clear()
+        course_data = self.course_data_set[0]
+        self.course = Course.objects.create_course(**course_data)
+        self.labs = self.create_labs(self.course)
+        self.users = [User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set]
+        for user in self.users:
+            self.course.join(user, course_data['pin_code'])
+
+    def test_run_trials(self):
+        """GPA未入力のユーザと未提出のユーザを観測された値から抽出する"""
+        prefs = [[0, 1], [0, 1]]
+        # GPAが確定していれば結果は変わらない
+        counts = probability.run_trials(prefs, [4.0, 3.0], [1, 1], [], [], 0, 10, 0)
+        self.assertEqual([10, 0, 0, 10], counts)
+        # 2人目のGPAは1.0または5.0のいずれか
+        counts = probability.run_trials(prefs, [4.0, None], [1, 1], [1.0, 5.0], [], 0, 100, 0)
+        self.assertEqual(100, counts[0] + counts[1])
+        self.assertTrue(0 < counts[0] < 100)
+        # 未提出の1人に第1志望を取られることがある
+        counts = probability.run_trials([[0, -1]], [3.0], [1, 1], [1.0, 5.0], [[0, 1]], 1, 100, 0)
+        self.assertTrue(0 < counts[0] < 100)
+
+    def test_estimate_probabilities(self):
+        """プロセスプールの有無に関わらず，提出済みのユーザの研究室ごとの配属確率を推定する"""
+        User.objects.filter(pk=self.users[0].pk).update(gpa=4.0)
+        User.objects.filter(pk=self.users[1].pk).update(gpa=2.0)
+        for user in self.users[:2]:
+            self.submit_ranks(self.labs, user)
+        for workers in (0, 2):
+            with self.subTest(workers=workers), self.settings(PROBABILITY_WORKERS=workers):
+                table = probability.estimate_probabilities(self.course, trials=20)
+                self.assertEqual(20, table['trials'])
+                # 研究室Aの許容人数は2人
+                self.assertEqual({self.labs[0].pk: 1.0}, table['users'][self.users[0].pk])
+                self.assertEqual(1.0, sum(table['users'][self.users[1].pk].values()))
+                self.assertNotIn(self.users[2].pk, table['users'])
+
+    def test_get_probabilities(self):
+        """DBに保存された結果のみを返し，課程のバージョンが変わっていればstaleとする"""
+        self.submit_ranks(self.labs, self.users[0])
+        self.assertIsNone(probability.get_probabilities(self.course))
+        with self.settings(PROBABILITY_WORKERS=0):
+            table = probability.estimate_probabilities(self.course, trials=5)
+        # 他のワーカーのキャッシュに関わらずDBから読み出す
+        cache.clear()
+        loaded = probability.get_probabilities(self.course)
+        self.assertEqual(dict(table, stale=False), loaded)
+        bump_course_version(self.course.pk)
+        self.assertTrue(probability.get_probabilities(self.course)['stale'])
@@ -75,3 +75,22 @@ class ConfigViewTest(DatasetMixin, JWTAuthMixin, APITestCase):
         resp = self.client.post(f'/courses/{course.pk}/config/', data=expected, format='json')
         with self.subTest(logged_in=True, is_member=True, is_admin=False):
             self.assertEqual(403, resp.status_code)
+
+    def test_get_config_not_modified(self):
+        """GET /courses/<course_pk>/config/ with If-None-Match"""
+        course_data = self.course_data_set[0]
+        course = Course.objects.create_course(**course_data)
+        course.join(self.user, course_data['pin_code'])
+        resp = self.client.get(f'/courses/{course.pk}/config/')
+        self.assertEqual(200, resp.status_code)
+        self.assertNotIn('Last-Modified', resp)
+        resp = self.client.get(f'/courses/{course.pk}/config/', HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(304, resp.status_code)
+        # If-Modified-Sinceでは304にならない
+        resp = self.client.get(f'/courses/{course.pk}/config/', HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+        self.assertEqual(200, resp.status_code)
+        # 設定が変われば新しい設定を返す
+        self.update_config(course.config, {'show_gpa': True})
+        resp = self.client.get(f'/courses/{course.pk}/config/', HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.data['show_gpa'])
@@ -1,7 +1,8 @@
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from rest_framework.test import APITestCase
 
-from courses.models import Course
+from courses.models import Course, Config, Lab
 from courses.tests.base import DatasetMixin, JWTAuthMixin
 
 User = get_user_model()
@@ -195,6 +196,44 @@ class CourseViewSetsTest(DatasetMixin, JWTAuthMixin, APITestCase):
             self.assertEqual(200, resp.status_code)
             self.assertEqual(expected_json, self.to_dict(resp.data))
 
+    def test_freeze(self):
+        """POST/GET/DELETE /courses/<pk>/freeze/"""
+        cache.clear()
+        # 凍結の状態は課程のpkごとにキャッシュされるため，他のテストに残さない
+        self.addCleanup(cache.clear)
+        course_data = self.course_data_set[0]
+        course = Course.objects.create_course(**course_data)
+        course.join(self.user, course_data['pin_code'])
+        resp = self.client.post(f'/courses/{course.pk}/freeze/')
+        self.assertEqual(403, resp.status_code)
+        course.register_as_admin(self.user)
+        resp = self.client.post(f'/courses/{course.pk}/freeze/')
+        self.assertEqual(201, resp.status_code)
+        resp = self.client.get(f'/courses/{course.pk}/freeze/')
+        self.assertIsNotNone(resp.data['frozen_at'])
+        # 凍結中は凍結時のレスポンスを返す
+        expected = self.to_dict(self.client.get(f'/courses/{course.pk}/').data)
+        self.assertTrue(expected['is_admin'])
+        Config.objects.filter(course=course).update(rank_limit=5)
+        # 認証によるユーザの読み込みのみ
+        with self.assertNumQueries(1):
+            resp = self.client.get(f'/courses/{course.pk}/')
+        self.assertEqual(expected, self.to_dict(resp.data))
+        self.assertEqual(3, resp.data['config']['rank_limit'])
+        # 変更は受け付けない
+        resp = self.client.post(f'/courses/{course.pk}/config/', data=self.default_config, format='json')
+        self.assertEqual(409, resp.status_code)
+        resp = self.client.post(f'/courses/{course.pk}/labs/', data=self.lab_data_set, format='json')
+        self.assertEqual(409, resp.status_code)
+        self.assertFalse(Lab.objects.filter(course=course).exists())
+        # 凍結の解除
+        resp = self.client.delete(f'/courses/{course.pk}/freeze/')
+        self.assertEqual(204, resp.status_code)
+        resp = self.client.delete(f'/courses/{course.pk}/freeze/')
+        self.assertEqual(404, resp.status_code)
+        resp = self.client.get(f'/courses/{course.pk}/')
+        self.assertEqual(5, resp.data['config']['rank_limit'])
+
 
 class PINCodeUpdateViewTest(DatasetMixin, JWTAuthMixin, APITestCase):
 
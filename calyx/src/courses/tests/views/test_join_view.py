@@ -42,6 +42,27 @@ class JoinViewTest(DatasetMixin, JWTAuthMixin, APITestCase):
         with self.subTest(status=400, expected=None):
             self.assertEqual(400, resp.status_code)
 
+    def test_join_idempotent(self):
+        """POST /courses/<pk>/join/ with Idempotency-Key"""
+        course_data = self.course_data_set[0]
+        course = Course.objects.create_course(**course_data)
+        payload = {'pin_code': course_data['pin_code']}
+        resp = self.client.post(f'/courses/{course.pk}/join/', data=payload, format='json', HTTP_IDEMPOTENCY_KEY='a')
+        self.assertEqual(201, resp.status_code)
+        # 再送されたリクエストには最初のレスポンスを返す
+        replayed = self.client.post(f'/courses/{course.pk}/join/', data=payload, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='a')
+        self.assertEqual(201, replayed.status_code)
+        self.assertEqual('true', replayed['Idempotent-Replayed'])
+        self.assertEqual(self.to_dict(resp.data), self.to_dict(replayed.data))
+        # 同じキーで異なるリクエスト
+        resp = self.client.post(f'/courses/{course.pk}/join/', data={'pin_code': '0000'}, format='json',
+                                HTTP_IDEMPOTENCY_KEY='a')
+        self.assertEqual(422, resp.status_code)
+        # キーが無ければ通常通り処理する
+        resp = self.client.post(f'/courses/{course.pk}/join/', data=payload, format='json')
+        self.assertEqual(400, resp.status_code)
+
     def test_join_with_invalid_pin_code(self):
         """POST /couses/<pk>/join/"""
         course_data = self.course_data_set[0]
@@ -1,7 +1,9 @@
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
 from rest_framework.test import APITestCase
 
 from courses.models import Course, Lab
+from courses.services import take_snapshot
 from courses.tests.base import DatasetMixin, JWTAuthMixin
 
 User = get_user_model()
@@ -50,7 +52,8 @@ class LabViewTest(DatasetMixin, JWTAuthMixin, APITestCase):
                     "pk": lab.pk,
                     "name": lab.name,
                     "capacity": lab.capacity,
-                    'rank_set': [[], [], []]
+                    'rank_set': [[], [], []],
+                    'rank_set_next': [None, None, None]
                 }
                 expected['rank_set'][rank.order] = [{
                     'pk': self.user.pk,
@@ -83,6 +86,7 @@ class LabViewTest(DatasetMixin, JWTAuthMixin, APITestCase):
         resp = self.client.put(f'/courses/{course.pk}/labs/{lab.pk}/', data=self.lab_data_set[1], format='json')
         self.lab_data_set[1]['pk'] = lab.pk
         self.lab_data_set[1]['rank_set'] = [[], [], []]
+        self.lab_data_set[1]['rank_set_next'] = [None, None, None]
         with self.subTest(status=200, expected=self.lab_data_set[1]):
             self.assertEqual(200, resp.status_code)
             self.assertEqual(self.lab_data_set[1], self.to_dict(resp.data))
@@ -101,6 +105,124 @@ class LabViewTest(DatasetMixin, JWTAuthMixin, APITestCase):
         with self.assertRaises(Lab.DoesNotExist):
             Lab.objects.get(pk=lab.pk)
 
+    def test_retrieve_lab_page(self):
+        """GET /courses/<course_pk>/labs/<lab_pk>/?sort=gpa&order=<order>&limit=<limit>&cursor=<cursor>"""
+        course, pin_code = self.courses[0], self.pin_codes[0]
+        self.update_config(course.config, {'show_gpa': True})
+        labs = self.create_labs(course)
+        users = [self.user] + [
+            User.objects.create_user(**user_data, is_active=True) for user_data in self.user_data_set[1:]
+        ]
+        for i, user in enumerate(users):
+            user.gpa = i + 1.5
+            user.screen_name = user.username
+            user.save()
+            course.join(user, pin_code)
+            self.submit_ranks(labs, user)
+        url = f'/courses/{course.pk}/labs/{labs[0].pk}/'
+        # ページを指定しなければ全ての志望順位の最初のページを返す
+        resp = self.client.get(url, format='json')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([user.pk for user in users], [user['pk'] for user in resp.data['rank_set'][0]])
+        # GPAの降順で1人ずつ読み込む
+        actual, cursor = [], ''
+        for _ in users:
+            resp = self.client.get(f'{url}?sort=gpa&order=0&limit=1&cursor={cursor}', format='json')
+            self.assertEqual(200, resp.status_code)
+            actual += [user['pk'] for user in resp.data['rank_set'][0]]
+            cursor = resp.data['rank_set_next'][0]
+        self.assertIsNone(cursor)
+        self.assertEqual([user.pk for user in users[::-1]], actual)
+        # 不正なカーソル
+        resp = self.client.get(f'{url}?order=0&cursor=invalid', format='json')
+        self.assertEqual(400, resp.status_code)
+        # GPAを表示しない課程ではGPAで並べ替えられない
+        self.update_config(course.config, {'show_gpa': False})
+        resp = self.client.get(f'{url}?sort=gpa', format='json')
+        self.assertEqual(400, resp.status_code)
+
+    def test_get_lab_history(self):
+        """GET /courses/<course_pk>/labs/<lab_pk>/history/"""
+        cache.clear()
+        course, pin_code = self.courses[0], self.pin_codes[0]
+        course.join(self.user, pin_code)
+        labs = self.create_labs(course)
+        self.submit_ranks(labs, self.user)
+        take_snapshot(course)
+        resp = self.client.get(f'/courses/{course.pk}/labs/{labs[0].pk}/history/', format='json')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(1, len(resp.data))
+        self.assertEqual(labs[0].pk, resp.data[0]['summary']['pk'])
+        resp = self.client.get(f'/courses/{course.pk}/labs/{labs[0].pk}/history/?since=2000-01-01T00:00:00',
+                               format='json')
+        self.assertEqual(200, resp.status_code)
+        resp = self.client.get(f'/courses/{course.pk}/labs/{labs[0].pk}/history/?since=yesterday', format='json')
+        self.assertEqual(400, resp.status_code)
+
+    def test_capacity_what_if(self):
+        """POST /courses/<course_pk>/labs/capacity/what-if/"""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        course, pin_code = self.courses[0], self.pin_codes[0]
+        course.join(self.user, pin_code)
+        course.register_as_admin(self.user)
+        labs = self.create_labs(course)
+        self.submit_ranks(labs, self.user)
+        url = f'/courses/{course.pk}/labs/capacity/what-if/'
+        resp = self.client.post(url, data=[{'lab': labs[0].pk, 'capacity': 0}], format='json')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('serial_dictatorship', resp.data['mechanism'])
+        self.assertEqual(0, resp.data['labs'][0]['capacity'])
+        self.assertEqual(labs[0].capacity, resp.data['labs'][0]['current_capacity'])
+        self.assertEqual([{'user': self.user.pk, 'from': labs[0].pk, 'to': labs[1].pk}], resp.data['moved'])
+        # 許容人数は変更されない
+        self.assertEqual(labs[0].capacity, Lab.objects.get(pk=labs[0].pk).capacity)
+        resp = self.client.post(f'{url}?mechanism=welfare', data=[{'lab': labs[0].pk, 'capacity': 0}], format='json')
+        self.assertEqual(200, resp.status_code)
+        resp = self.client.post(f'{url}?mechanism=lottery', data=[{'lab': labs[0].pk, 'capacity': 0}], format='json')
+        self.assertEqual(400, resp.status_code)
+
+    def test_update_capacities(self):
+        """PUT /courses/<course_pk>/labs/capacity/"""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        course, pin_code = self.courses[0], self.pin_codes[0]
+        course.join(self.user, pin_code)
+        course.register_as_admin(self.user)
+        labs = self.create_labs(course)
+        data = [{'lab': labs[0].pk, 'capacity': 5}, {'lab': labs[2].pk, 'capacity': 0}]
+        resp = self.client.put(f'/courses/{course.pk}/labs/capacity/', data=data, format='json')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([5, labs[1].capacity, 0], [lab['capacity'] for lab in resp.data])
+        self.assertEqual(5, Lab.objects.get(pk=labs[0].pk).capacity)
+        # 重複した研究室，他の課程の研究室，負の許容人数
+        other = self.create_labs(self.courses[1])
+        for data in ([{'lab': labs[0].pk, 'capacity': 1}, {'lab': labs[0].pk, 'capacity': 2}],
+                     [{'lab': other[0].pk, 'capacity': 1}],
+                     [{'lab': labs[0].pk, 'capacity': -1}]):
+            with self.subTest(data=data):
+                resp = self.client.put(f'/courses/{course.pk}/labs/capacity/', data=data, format='json')
+                self.assertEqual(400, resp.status_code)
+        self.assertEqual(5, Lab.objects.get(pk=labs[0].pk).capacity)
+
+    def test_update_capacities_permission(self):
+        course = self.courses[0]
+        lab = Lab.objects.create(**self.lab_data_set[0], course=course)
+        data = [{'lab': lab.pk, 'capacity': 1}]
+        for url in (f'/courses/{course.pk}/labs/capacity/what-if/', f'/courses/{course.pk}/labs/capacity/'):
+            method = self.client.post if url.endswith('what-if/') else self.client.put
+            # メンバーでない
+            resp = method(url, data=data, format='json')
+            with self.subTest(url=url, is_member=False, is_admin=False):
+                self.assertEqual(403, resp.status_code)
+        # 管理者で無い
+        course.join(self.user, self.pin_codes[0])
+        for url in (f'/courses/{course.pk}/labs/capacity/what-if/', f'/courses/{course.pk}/labs/capacity/'):
+            method = self.client.post if url.endswith('what-if/') else self.client.put
+            resp = method(url, data=data, format='json')
+            with self.subTest(url=url, is_member=True, is_admin=False):
+                self.assertEqual(403, resp.status_code)
+
     def test_get_lab_permission(self):
         course = self.courses[0]
         Lab.objects.create(**self.lab_data_set[0], course=course)
@@ -1,9 +1,14 @@
 import itertools
+import json
+from unittest.mock import patch
 
 from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
 from rest_framework.test import APITestCase
 
-from courses.models import Course, Lab, Rank
+from courses.models import Course, Lab, Rank, RankChange
+from courses.services import get_summary, freeze_course, estimate_probabilities, flush_rank_changes
 from courses.tests.base import DatasetMixin, JWTAuthMixin
 
 User = get_user_model()
@@ -19,6 +24,8 @@ class RankViewTest(DatasetMixin, JWTAuthMixin, APITestCase):
         self.pin_code = self.course_data['pin_code']
         self.course = Course.objects.create_course(**self.course_data)
         self.labs = [Lab.objects.create(**lab, course=self.course) for lab in self.lab_data_set]
+        # キューにたまった変更履歴はテストのトランザクション内で書き込み，他のテストに持ち越さない
+        self.addCleanup(flush_rank_changes)
 
     def test_create_rank(self):
         """POST /courses/<course_pk>/ranks/"""
@@ -45,6 +52,18 @@ class RankViewTest(DatasetMixin, JWTAuthMixin, APITestCase):
         with self.subTest(data=expected):
             resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=expected, format='json')
             self.assertEqual(400, resp.status_code)
+        # 同じ研究室を複数指定
+        with self.subTest(data='duplicate'):
+            duplicated = [{'lab': self.labs[0].pk}] * len(self.labs)
+            resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=duplicated, format='json')
+            self.assertEqual(400, resp.status_code)
+        # 他の課程の研究室
+        with self.subTest(data='other course'):
+            other_course = Course.objects.create_course(**self.course_data_set[1])
+            other_labs = [Lab.objects.create(**lab, course=other_course) for lab in self.lab_data_set]
+            resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=[{'lab': lab.pk} for lab in other_labs],
+                                    format='json')
+            self.assertEqual(400, resp.status_code)
         # 存在しない課程
         with self.subTest(course=9999):
             resp = self.client.post(f'/courses/9999/ranks/', data=expected, format='json')
@@ -129,3 +148,263 @@ class RankViewTest(DatasetMixin, JWTAuthMixin, APITestCase):
             # メンバーでない
             resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/')
             self.assertEqual(403, resp.status_code)
+
+    def test_get_rank_summary_not_modified(self):
+        """GET /courses/<course_pk>/ranks/summary/ with If-None-Match"""
+        self.course.join(self.user, self.pin_code)
+        self.submit_ranks(self.labs, self.user)
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/')
+        self.assertEqual(200, resp.status_code)
+        etag = resp['ETag']
+        with self.subTest(modified=False):
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(304, resp.status_code)
+            self.assertEqual(etag, resp['ETag'])
+        # 他のURLや他のユーザのETagでは304にならない
+        with self.subTest(modified=False, path='ranks'):
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(200, resp.status_code)
+        with self.subTest(modified=False, user='other'):
+            other = User.objects.create_user(**self.user_data_set[1], is_active=True)
+            self._set_credentials(other)
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(403, resp.status_code)
+            self._set_credentials()
+        # 同じETagでも権限を失っていれば304にならない
+        with self.subTest(modified=False, is_member=False):
+            with patch('courses.permissions.IsCourseMember.has_object_permission', return_value=False):
+                resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(403, resp.status_code)
+        # 志望順位が変われば新しいサマリーを返す
+        with self.subTest(modified=True):
+            data = [{'lab': lab.pk} for lab in self.labs[::-1]]
+            resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=data, format='json')
+            self.assertEqual(201, resp.status_code)
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/', HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(200, resp.status_code)
+            self.assertNotEqual(etag, resp['ETag'])
+
+    def test_get_rank_summary_stale(self):
+        """GET /courses/<course_pk>/ranks/summary/ で古いサマリーを返す間はETagを付けない"""
+        cache.clear()
+        self.course.join(self.user, self.pin_code)
+        self.submit_ranks(self.labs, self.user)
+        with self.settings(SUMMARY_DEBOUNCE_SECONDS=60):
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/')
+            self.assertIn('ETag', resp)
+            old = resp.data
+            data = [{'lab': lab.pk} for lab in self.labs[::-1]]
+            self.client.post(f'/courses/{self.course.pk}/ranks/', data=data, format='json')
+            # 再集計の間隔内
+            cache.add(f"course-summary-debounce-{self.course.pk}", True, 60)
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/')
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual(old, resp.data)
+            self.assertNotIn('ETag', resp)
+            self.assertEqual('no-cache', resp['Cache-Control'])
+            # 間隔が過ぎれば再集計してETagを付ける
+            cache.delete(f"course-summary-debounce-{self.course.pk}")
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/')
+            self.assertNotEqual(old, resp.data)
+            self.assertIn('ETag', resp)
+
+    def test_get_rank_summary_stream(self):
+        """GET /courses/<course_pk>/ranks/summary/stream/"""
+        self.course.join(self.user, self.pin_code)
+        self.submit_ranks(self.labs, self.user)
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/stream/')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('text/event-stream', resp['Content-Type'])
+        events = b''.join(resp.streaming_content).decode().strip().split('\n\n')
+        self.assertEqual(2, len(events))
+        self.assertTrue(events[0].startswith('retry: '))
+        event_id, event, data = events[1].split('\n')
+        self.assertEqual('event: summary', event)
+        self.assertEqual(get_summary(self.course), json.loads(data[len('data: '):]))
+        # 最後に受け取ったサマリーから変わっていなければ送らない
+        last_event_id = event_id[len('id: '):]
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/stream/', HTTP_LAST_EVENT_ID=last_event_id)
+        events = b''.join(resp.streaming_content).decode().strip().split('\n\n')
+        self.assertEqual(1, len(events))
+        # メンバーでない
+        with self.subTest(logged_in=True, is_member=False):
+            self.course.leave(self.user)
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/stream/')
+            self.assertEqual(403, resp.status_code)
+
+    def test_create_rank_conflict(self):
+        """POST /courses/<course_pk>/ranks/ with X-Rank-Set-Version"""
+        self.course.join(self.user, self.pin_code)
+        data = [{'lab': lab.pk} for lab in self.labs]
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/')
+        self.assertEqual('0', resp['X-Rank-Set-Version'])
+        resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=data, format='json',
+                                HTTP_X_RANK_SET_VERSION='0')
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual('1', resp['X-Rank-Set-Version'])
+        # 他のタブで提出された後の古いバージョンでの提出は競合とする
+        resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=data[::-1], format='json',
+                                HTTP_X_RANK_SET_VERSION='0')
+        self.assertEqual(409, resp.status_code)
+        self.assertEqual('1', resp['X-Rank-Set-Version'])
+        actual = Rank.objects.filter(course=self.course, user=self.user).order_by('order').values_list('lab_id')
+        self.assertEqual([(lab.pk,) for lab in self.labs], list(actual))
+        # バージョンを指定しない場合はそのまま提出できる
+        resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=data[::-1], format='json')
+        self.assertEqual(201, resp.status_code)
+        self.assertEqual('2', resp['X-Rank-Set-Version'])
+        with self.settings(RANK_SET_VERSION_REQUIRED=True):
+            resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=data, format='json')
+            self.assertEqual(428, resp.status_code)
+
+    def test_create_rank_idempotent(self):
+        """POST /courses/<course_pk>/ranks/ with Idempotency-Key"""
+        self.course.join(self.user, self.pin_code)
+        data = [{'lab': lab.pk} for lab in self.labs]
+        for _ in range(2):
+            resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=data, format='json',
+                                    HTTP_IDEMPOTENCY_KEY='submit-1')
+            self.assertEqual(201, resp.status_code)
+            # 再送では志望順位を書き込まないため，バージョンは上がらない
+            self.assertEqual('1', resp['X-Rank-Set-Version'])
+        self.assertEqual('true', resp['Idempotent-Replayed'])
+
+    def test_import_ranks(self):
+        """POST /courses/<course_pk>/ranks/import/"""
+        self.course.join(self.user, self.pin_code)
+        lines = ''.join(f'{self.user.username},{order + 1},{lab.name}\n' for order, lab in enumerate(self.labs))
+        # 管理者でない
+        upload = SimpleUploadedFile('ranks.csv', lines.encode())
+        resp = self.client.post(f'/courses/{self.course.pk}/ranks/import/', data={'file': upload}, format='multipart')
+        self.assertEqual(403, resp.status_code)
+        self.course.register_as_admin(self.user)
+        upload = SimpleUploadedFile('ranks.csv', lines.encode())
+        resp = self.client.post(f'/courses/{self.course.pk}/ranks/import/', data={'file': upload}, format='multipart')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({'imported': len(self.labs), 'users': 1, 'errors': []}, self.to_dict(resp.data))
+        # 誤りのあるCSV
+        upload = SimpleUploadedFile('ranks.csv', lines.replace(self.labs[0].name, 'Lab Z').encode())
+        resp = self.client.post(f'/courses/{self.course.pk}/ranks/import/', data={'file': upload}, format='multipart')
+        self.assertEqual(400, resp.status_code)
+
+    def test_get_rank_changes(self):
+        """GET /courses/<course_pk>/ranks/changes/"""
+        self.course.join(self.user, self.pin_code)
+        lab_pks = [lab.pk for lab in self.labs]
+        for data in (lab_pks, lab_pks[::-1]):
+            resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=[{'lab': pk} for pk in data],
+                                    format='json')
+            self.assertEqual(201, resp.status_code)
+        # 管理者でない
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/changes/')
+        self.assertEqual(403, resp.status_code)
+        self.course.register_as_admin(self.user)
+        with self.settings(RANK_CHANGE_PAGE_SIZE=1):
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/changes/', data={'user': self.user.pk})
+            self.assertEqual(200, resp.status_code)
+            self.assertEqual(1, len(resp.data['results']))
+            self.assertEqual(lab_pks[::-1], resp.data['results'][0]['labs'])
+            self.assertEqual(self.user.pk, resp.data['results'][0]['actor'])
+            # 次のページ
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/changes/',
+                                   data={'user': self.user.pk, 'before': resp.data['next']})
+            self.assertEqual(lab_pks, resp.data['results'][0]['labs'])
+            self.assertIsNone(resp.data['next'])
+        # 期間の指定
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/changes/', data={'since': '2999-01-01T00:00:00'})
+        self.assertEqual([], resp.data['results'])
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/changes/', data={'user': 'me'})
+        self.assertEqual(400, resp.status_code)
+        self.assertEqual(2, RankChange.objects.filter(course=self.course).count())
+
+    def test_frozen_course(self):
+        """凍結された課程では提出できず，サマリーは凍結時のものを返す"""
+        cache.clear()
+        # 凍結の状態は課程のpkごとにキャッシュされるため，他のテストに残さない
+        self.addCleanup(cache.clear)
+        self.course.join(self.user, self.pin_code)
+        self.submit_ranks(self.labs, self.user)
+        freeze_course(self.course)
+        data = [{'lab': lab.pk} for lab in self.labs[::-1]]
+        resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=data, format='json')
+        self.assertEqual(409, resp.status_code)
+        # 凍結時のサマリーを返す
+        expected = get_summary(self.course)
+        Rank.objects.filter(course=self.course).delete()
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(expected, self.to_dict(resp.data))
+        resp = self.client.get(f'/courses/{self.course.pk}/labs/{self.labs[0].pk}/')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([[self.user.pk], [], []],
+                         [[user['pk'] for user in users] for users in resp.data['rank_set']])
+        # 凍結時に閲覧できなかったユーザは通常通り権限を確認する
+        other = User.objects.create_user(**self.user_data_set[1], is_active=True)
+        self.course.join(other, self.pin_code)
+        self._set_credentials(other)
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/summary/')
+        self.assertEqual(403, resp.status_code)
+
+    def test_get_assignment(self):
+        """GET /courses/<course_pk>/ranks/assignment/"""
+        cache.clear()
+        self.course.join(self.user, self.pin_code)
+        self.submit_ranks(self.labs, self.user)
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/assignment/')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(self.labs[0].pk, resp.data['lab'])
+        self.assertEqual([1, 0, 0], [lab['count'] for lab in resp.data['labs']])
+        self.assertNotIn('users', resp.data)
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/assignment/', data={'mechanism': 'boston'})
+        self.assertEqual(400, resp.status_code)
+        # 管理者には全てのユーザの配属先を返す
+        self.course.register_as_admin(self.user)
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/assignment/',
+                               data={'mechanism': 'deferred_acceptance'})
+        self.assertEqual([{'user': self.user.pk, 'lab': self.labs[0].pk}], resp.data['users'])
+
+    def test_get_probability(self):
+        """GET /courses/<course_pk>/ranks/probability/"""
+        cache.clear()
+        self.course.join(self.user, self.pin_code)
+        self.submit_ranks(self.labs, self.user)
+        # 推定はリクエストの処理中には行わない
+        with patch('courses.services.probability.run_trials') as run_trials:
+            resp = self.client.get(f'/courses/{self.course.pk}/ranks/probability/')
+            self.assertEqual(202, resp.status_code)
+            run_trials.assert_not_called()
+        with self.settings(PROBABILITY_WORKERS=0):
+            estimate_probabilities(self.course, trials=5)
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/probability/')
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([{'pk': self.labs[0].pk, 'probability': 1.0}], resp.data['labs'])
+        self.assertFalse(resp.data['stale'])
+
+    def test_get_advise(self):
+        """GET /courses/<course_pk>/ranks/advise/"""
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.course.join(self.user, self.pin_code)
+        self.submit_ranks(self.labs, self.user)
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/advise/', data={'limit': 1})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([{'labs': [lab.pk for lab in self.labs], 'probability': 1.0,
+                           'probabilities': [1.0, 0.0, 0.0], 'padded': 2}],
+                         resp.data['lists'])
+        labs = f'{self.labs[2].pk},{self.labs[1].pk}'
+        resp = self.client.get(f'/courses/{self.course.pk}/ranks/advise/', data={'labs': labs})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([[self.labs[2].pk, self.labs[1].pk, self.labs[0].pk],
+                          [self.labs[1].pk, self.labs[2].pk, self.labs[0].pk]],
+                         [item['labs'] for item in resp.data['lists']])
+        # 組はそのまま提出できる
+        data = [{'lab': lab_pk} for lab_pk in resp.data['lists'][0]['labs']]
+        resp = self.client.post(f'/courses/{self.course.pk}/ranks/', data=data, format='json')
+        self.assertEqual(201, resp.status_code)
+        self.submit_ranks(self.labs, self.user)
+        # 志望順位は変わらない
+        self.assertEqual(self.labs[0].pk, Rank.objects.get(course=self.course, user=self.user, order=0).lab_id)
+        for data in ({'labs': 'a,b'}, {'labs': '0'}, {'limit': 0}):
+            with self.subTest(data=data):
+                resp = self.client.get(f'/courses/{self.course.pk}/ranks/advise/', data=data)
+                self.assertEqual(400, resp.status_code)
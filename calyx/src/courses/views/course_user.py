@@ -12,12 +12,12 @@ from courses.permissions import (
 from courses.serializers import (
     ReadOnlyCourseSerializer, JoinSerializer, UserSerializer, CourseStatusSerializer
 )
-from .mixins import CourseNestedMixin
+from .mixins import CourseNestedMixin, CourseConditionalMixin, IdempotencyMixin
 
 User = get_user_model()
 
 
-class JoinAPIView(CourseNestedMixin, mixins.CreateModelMixin, viewsets.GenericViewSet):
+class JoinAPIView(IdempotencyMixin, CourseNestedMixin, mixins.CreateModelMixin, viewsets.GenericViewSet):
     """
     課程に参加するAPIビュー
 
@@ -121,7 +121,7 @@ class CourseAdminView(CourseNestedMixin,
         return Response(serializer.data)
 
 
-class RequirementStatusView(CourseNestedMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
+class RequirementStatusView(CourseConditionalMixin, CourseNestedMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
     """
     課程の設定と照らし合わせてそのユーザが要求を満たしているかどうかをチェックするビュー
 
@@ -2,7 +2,7 @@ from django.contrib.auth import get_user_model
 from django.db import transaction
 from django.db.models import Prefetch
 from drf_yasg.utils import swagger_auto_schema
-from rest_framework import viewsets, permissions, mixins, status
+from rest_framework import viewsets, permissions, mixins, status, decorators, exceptions
 from rest_framework.response import Response
 
 from courses.models import Course, Year, Config
@@ -13,12 +13,15 @@ from courses.serializers import (
     ReadOnlyCourseSerializer, CourseUpdateSerializer, CourseCreateSerializer,
     CourseWithoutUserSerializer, YearSerializer, ConfigSerializer, PINCodeUpdateSerializer
 )
-from .mixins import CourseNestedMixin
+from courses.services import freeze_course, unfreeze_course, get_frozen
+from courses.services.freeze import PAYLOAD_COURSE
+from .mixins import CourseNestedMixin, CourseConditionalMixin, FrozenCourseMixin
 
 User = get_user_model()
 
 
-class CourseViewSet(mixins.RetrieveModelMixin,
+class CourseViewSet(FrozenCourseMixin,
+                    mixins.RetrieveModelMixin,
                     mixins.CreateModelMixin,
                     mixins.DestroyModelMixin,
                     mixins.ListModelMixin,
@@ -36,17 +39,37 @@ class CourseViewSet(mixins.RetrieveModelMixin,
         指定した課程を削除する
     partial_update:
         指定した課程のパラメータ（全てでなくて良い）を指定して更新する
+    freeze:
+        課程を凍結し，志望順位，研究室，設定の変更を受け付けないようにする
     """
 
     queryset = Course.objects.prefetch_related(
         Prefetch('users', User.objects.prefetch_related('groups', 'courses').all()),
     ).select_related('year').all()
     serializer_class = ReadOnlyCourseSerializer
+    # 課程の削除は凍結中も受け付ける
+    frozen_write_actions = ('update', 'partial_update')
+
+    def get_frozen_course_pk(self):
+        pk = self.kwargs.get('pk', None)
+        if pk is None or not str(pk).isdigit():
+            return None
+        return int(pk)
+
+    def get_frozen_payload_key(self):
+        if self.action == 'retrieve':
+            return PAYLOAD_COURSE, 'course_readers'
+        return None
+
+    def make_frozen_response(self, request, frozen, payload):
+        # is_adminのみリクエストしたユーザによって異なる
+        payload = dict(payload, is_admin=request.user.pk in frozen['admins'])
+        return Response(payload)
 
     def get_permissions(self):
         if self.action == 'list' or self.action == 'create':
             self.permission_classes = [permissions.IsAuthenticated]
-        elif self.action == 'retrieve':
+        elif self.action == 'retrieve' or (self.action == 'freeze' and self.request.method == 'GET'):
             self.permission_classes = [(IsCourseMember & GPARequirement & ScreenNameRequirement) | IsAdmin]
         else:
             self.permission_classes = [(IsCourseMember & IsCourseAdmin) | IsAdmin]
@@ -85,6 +108,30 @@ class CourseViewSet(mixins.RetrieveModelMixin,
             course.register_as_admin(self.request.user)
         return course
 
+    @swagger_auto_schema(methods=['GET', 'POST', 'DELETE'], responses={
+        200: "凍結日時（frozen_at）．凍結されていなければnull",
+        201: "凍結しました",
+        204: "凍結を解除しました",
+        403: "課程の管理者ではありません",
+        404: "存在しない課程，または凍結されていない課程です"
+    })
+    @decorators.action(['GET', 'POST', 'DELETE'], detail=True)
+    def freeze(self, request, *args, **kwargs):
+        """
+        課程の凍結の状態を取得，凍結，解除する．凍結時にサマリー，研究室の詳細，課程の詳細を生成し，
+        凍結中はそれを返す．凍結中に変わったGPAや表示名は反映されない
+        """
+        course = self.get_object()
+        if request.method == 'POST':
+            frozen = freeze_course(course)
+            return Response({'frozen_at': frozen.frozen_at}, status=status.HTTP_201_CREATED)
+        if request.method == 'DELETE':
+            if not unfreeze_course(course):
+                raise exceptions.NotFound('課程は凍結されていません．')
+            return Response(status=status.HTTP_204_NO_CONTENT)
+        frozen = get_frozen(course.pk)
+        return Response({'frozen_at': frozen['frozen_at'] if frozen is not None else None})
+
 
 class CoursePINCodeViewSet(CourseNestedMixin, viewsets.GenericViewSet):
     """
@@ -128,7 +175,9 @@ class YearViewSet(mixins.ListModelMixin, viewsets.GenericViewSet):
     permission_classes = [permissions.IsAuthenticated]
 
 
-class CourseConfigViewSet(CourseNestedMixin,
+class CourseConfigViewSet(CourseConditionalMixin,
+                          FrozenCourseMixin,
+                          CourseNestedMixin,
                           mixins.ListModelMixin,
                           mixins.CreateModelMixin,
                           viewsets.GenericViewSet):
@@ -142,6 +191,7 @@ class CourseConfigViewSet(CourseNestedMixin,
 
     queryset = Config.objects.select_related('course').all()
     serializer_class = ConfigSerializer
+    frozen_write_actions = ('create',)
 
     def get_permissions(self):
         if self.action == 'list':
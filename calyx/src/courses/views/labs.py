@@ -1,7 +1,10 @@
+from typing import TYPE_CHECKING
+
 from django.contrib.auth import get_user_model
 from django.db.models import signals
+from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from rest_framework import viewsets, status, exceptions
+from rest_framework import viewsets, status, exceptions, decorators
 from rest_framework.response import Response
 
 from courses.models import Lab
@@ -9,33 +12,54 @@ from courses.permissions import (
     IsAdmin, IsCourseMember, IsCourseAdmin, GPARequirement, ScreenNameRequirement, RankSubmitted
 )
 from courses.serializers import (
-    LabSerializer, LabAbstractSerializer
+    LabSerializer, LabAbstractSerializer, LabCapacitySerializer, RankSummarySnapshotSerializer
+)
+from courses.services import (
+    invalidate_summary, bump_course_version, get_lab_history, get_config_cache, ApplicantQuery,
+    project_capacities, commit_capacities
 )
-from courses.services import update_summary_cache
+from courses.services.assignment import MECHANISMS, MECHANISM_SERIAL_DICTATORSHIP
+from courses.services.applicants import SORT_DEFAULT, SORT_GPA
+from courses.services.freeze import lab_payload_key
 from courses.signals import update_rank_summary_when_capacity_changed
 from courses.utils import disable_signal
-from .mixins import CourseNestedMixin, NestedViewSetMixin
+from .mixins import (
+    CourseNestedMixin, NestedViewSetMixin, CourseConditionalMixin, IdempotencyMixin, PeriodMixin, FrozenCourseMixin
+)
 from .schemas import base_responses
 
+if TYPE_CHECKING:
+    from typing import Dict
+
 User = get_user_model()
 
 
-class LabViewSet(NestedViewSetMixin, CourseNestedMixin, viewsets.ModelViewSet):
+class LabViewSet(IdempotencyMixin, CourseConditionalMixin, FrozenCourseMixin, PeriodMixin, NestedViewSetMixin,
+                 CourseNestedMixin, viewsets.ModelViewSet):
     """
     研究室を操作するView．
     """
 
     queryset = Lab.objects.select_related('course').all()
+    frozen_write_actions = ('create', 'update', 'partial_update', 'destroy', 'capacity')
 
     def get_serializer_class(self):
         if self.action == 'list' or self.action == 'create':
             return LabAbstractSerializer
+        if self.action == 'what_if' or self.action == 'capacity':
+            return LabCapacitySerializer
         return LabSerializer
 
+    def get_frozen_payload_key(self):
+        # 並び順やページを指定した場合は凍結時のレスポンスと異なるため，通常通り処理する
+        if self.action == 'retrieve' and not self.request.query_params and str(self.kwargs.get('pk', '')).isdigit():
+            return lab_payload_key(int(self.kwargs['pk'])), 'rank_readers'
+        return None
+
     def get_permissions(self):
         if self.action == "list":
             self.permission_classes = [IsCourseMember | IsAdmin]
-        elif self.action == "retrieve":
+        elif self.action == "retrieve" or self.action == "history":
             self.permission_classes = [(IsCourseMember & GPARequirement &
                                         ScreenNameRequirement & RankSubmitted) | IsAdmin]
         else:
@@ -52,6 +76,23 @@ class LabViewSet(NestedViewSetMixin, CourseNestedMixin, viewsets.ModelViewSet):
         self.course = self.get_course()
         return super(LabViewSet, self).list(request, *args, **kwargs)
 
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('sort', openapi.IN_QUERY, description="志望者の並び順．'default'または'gpa'",
+                              type=openapi.TYPE_STRING),
+            openapi.Parameter('order', openapi.IN_QUERY, description='ページを指定する志望順位', type=openapi.TYPE_INTEGER),
+            openapi.Parameter('cursor', openapi.IN_QUERY, description='rank_set_nextで返された次のページのカーソル',
+                              type=openapi.TYPE_STRING),
+            openapi.Parameter('limit', openapi.IN_QUERY, description='志望順位ごとの最大の人数', type=openapi.TYPE_INTEGER),
+        ],
+        responses={
+            200: LabSerializer(),
+            **base_responses
+        }
+    )
+    def retrieve(self, request, *args, **kwargs):
+        return super(LabViewSet, self).retrieve(request, *args, **kwargs)
+
     def get_object(self):
         pk = self.kwargs.pop('pk')
         course_pk = self.kwargs.get('course_pk', None)
@@ -63,12 +104,34 @@ class LabViewSet(NestedViewSetMixin, CourseNestedMixin, viewsets.ModelViewSet):
         self.course = obj.course
         return obj
 
+    def perform_destroy(self, instance):
+        # 志望順位の繰り上げはLab.deleteで行われるので，最後にまとめてサマリーを更新する
+        instance.delete()
+        invalidate_summary(instance.course)
+
     def get_serializer_context(self):
         context = super(LabViewSet, self).get_serializer_context()
         if hasattr(self, 'course'):
             context['course'] = self.course
+        if self.action == 'retrieve':
+            context['applicant_query'] = self.get_applicant_query()
         return context
 
+    def get_applicant_query(self) -> 'ApplicantQuery':
+        """クエリパラメータから志望者の並び順とページを決める"""
+        params = self.request.query_params
+        sort = params.get('sort', SORT_DEFAULT)
+        if sort == SORT_GPA and not get_config_cache(self.course.pk)['show_gpa']:
+            raise exceptions.ValidationError({'sort': 'この課程ではGPAで並べ替えることはできません．'})
+        try:
+            order = int(params['order']) if 'order' in params else None
+            limit = int(params['limit']) if 'limit' in params else None
+            if limit is not None and limit < 1:
+                raise ValueError
+            return ApplicantQuery(sort=sort, order=order, cursor=params.get('cursor', None), limit=limit)
+        except ValueError:
+            raise exceptions.ValidationError('並び順またはページの指定が正しくありません．')
+
     @swagger_auto_schema(
         request_body=LabAbstractSerializer(many=True),
         responses={
@@ -84,6 +147,68 @@ class LabViewSet(NestedViewSetMixin, CourseNestedMixin, viewsets.ModelViewSet):
             serializer.is_valid(raise_exception=True)
             serializer.save()
         # 最後にまとめてキャッシュを更新
-        update_summary_cache(self.course)
+        invalidate_summary(self.course)
+        bump_course_version(self.course.pk)
         headers = self.get_success_headers(serializer.data)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('since', openapi.IN_QUERY, description='期間の開始（ISO 8601）', type=openapi.TYPE_STRING),
+            openapi.Parameter('until', openapi.IN_QUERY, description='期間の終了（ISO 8601）', type=openapi.TYPE_STRING),
+        ],
+        responses={
+            200: RankSummarySnapshotSerializer(many=True),
+            **base_responses
+        }
+    )
+    @decorators.action(['GET'], detail=True)
+    def history(self, request, *args, **kwargs):
+        """研究室のサマリーの履歴を取得する"""
+        lab = self.get_object()
+        serializer = RankSummarySnapshotSerializer(get_lab_history(lab, **self.get_period(request)), many=True)
+        return Response(serializer.data)
+
+    def get_capacities(self, request) -> 'Dict[int, int]':
+        self.course = self.get_course()
+        serializer = self.get_serializer(data=request.data, many=True)
+        serializer.is_valid(raise_exception=True)
+        return serializer.to_capacities()
+
+    @swagger_auto_schema(
+        request_body=LabCapacitySerializer(many=True),
+        manual_parameters=[
+            openapi.Parameter('mechanism', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description="配属の方式．'serial_dictatorship'（既定），'deferred_acceptance'または'welfare'"),
+        ],
+        responses={
+            200: "研究室ごとの試算した配属人数とボーダー（cutoff），現在の値（current_*），配属先が変わるユーザ（moved）",
+            **base_responses
+        }
+    )
+    @decorators.action(['POST'], detail=False, url_path='capacity/what-if')
+    def what_if(self, request, *args, **kwargs):
+        """
+        研究室の許容人数を変更した場合の配属を試算する．許容人数は変更されない
+        """
+        mechanism = request.query_params.get('mechanism', MECHANISM_SERIAL_DICTATORSHIP)
+        if mechanism not in MECHANISMS:
+            raise exceptions.ValidationError({'mechanism': f'{", ".join(MECHANISMS)}のいずれかを指定してください．'})
+        capacities = self.get_capacities(request)
+        return Response(project_capacities(self.course, capacities, mechanism))
+
+    @swagger_auto_schema(
+        request_body=LabCapacitySerializer(many=True),
+        responses={
+            200: LabAbstractSerializer(many=True),
+            **base_responses
+        }
+    )
+    @decorators.action(['PUT'], detail=False, url_path='capacity')
+    def capacity(self, request, *args, **kwargs):
+        """
+        複数の研究室の許容人数をまとめて変更する
+        """
+        capacities = self.get_capacities(request)
+        labs = commit_capacities(self.course, capacities)
+        return Response(LabAbstractSerializer(labs, many=True).data)
@@ -1,6 +1,22 @@
-from rest_framework import exceptions
+import hashlib
+import json
+from typing import TYPE_CHECKING
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from rest_framework import exceptions, status
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
 
 from courses.models import Course
+from courses.services import get_course_version
+from courses.services.freeze import get_frozen, get_frozen_payload
+from courses.services.idempotency import (
+    make_fingerprint, begin_request, complete_request, discard_request, load_response
+)
+
+if TYPE_CHECKING:
+    from typing import Optional, Tuple
 
 
 class NestedViewSetMixin(object):
@@ -40,3 +56,234 @@ class CourseNestedMixin(object):
             raise exceptions.NotFound("指定された課程は存在しません")
         self.check_object_permissions(self.request, self.course)
         return self.course
+
+
+class PeriodMixin(object):
+
+    def get_period(self, request) -> dict:
+        """クエリパラメータのsince，untilを読み込む．タイムゾーンを省略した場合は現在のタイムゾーンとする"""
+        period = dict()
+        for key in ('since', 'until'):
+            value = request.query_params.get(key, None)
+            if value is None:
+                continue
+            try:
+                period[key] = parse_datetime(value)
+            except ValueError:
+                # 形式は正しいが存在しない日時
+                period[key] = None
+            if period[key] is None:
+                raise exceptions.ValidationError({key: '日時の形式が正しくありません．'})
+            if timezone.is_naive(period[key]):
+                period[key] = timezone.make_aware(period[key])
+        return period
+
+
+class NotModified(exceptions.APIException):
+    status_code = status.HTTP_304_NOT_MODIFIED
+    default_detail = ''
+
+
+class CourseConditionalMixin(object):
+    """
+    課程のバージョンからETagを生成し，If-None-Matchが一致すれば304を返すMixin．
+    ETagにはURLとユーザを含めるため，304を返すのは同じユーザが以前200を受け取った場合に限られる．
+    その後に権限を失っている場合もあるため，304を返す前にも権限を確認し，シリアライザの処理のみを省く．
+    Last-Modifiedは1秒単位で同じ秒の更新を区別できないため使わない．
+    レスポンスの内容が課程のバージョンより古い場合，actionでstale_bodyをTrueにするとETagを付けずに返す．
+    """
+
+    conditional_actions = ('list', 'retrieve')
+
+    course_version = None
+    # 古い内容のレスポンスに新しいバージョンのETagを付けると，その後の更新まで304が返り続ける
+    stale_body = False
+
+    def _is_conditional(self, request) -> bool:
+        if request.method not in ('GET', 'HEAD') or self.action not in self.conditional_actions:
+            return False
+        course_pk = self.kwargs.get('course_pk', None)
+        return course_pk is not None and str(course_pk).isdigit()
+
+    def get_etag(self, request) -> str:
+        source = f'{request.get_full_path()}:{request.user.pk}:{self.course_version.version}'
+        return '"{}"'.format(hashlib.md5(source.encode()).hexdigest())
+
+    def _is_not_modified(self, request, etag: str) -> bool:
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH', None)
+        if if_none_match is None:
+            return False
+        return etag in [tag.strip() for tag in if_none_match.split(',')] or if_none_match.strip() == '*'
+
+    def initial(self, request, *args, **kwargs):
+        self.stale_body = False
+        if self._is_conditional(request):
+            self.perform_authentication(request)
+            if request.user and request.user.is_authenticated:
+                self.course_version = get_course_version(int(self.kwargs['course_pk']))
+                if self._is_not_modified(request, self.get_etag(request)):
+                    # 権限が無ければ403を返す．get_courseは課程に対する権限を確認する
+                    self.check_permissions(request)
+                    self.get_course()
+                    raise NotModified()
+        super(CourseConditionalMixin, self).initial(request, *args, **kwargs)
+
+    def _set_validators(self, request, response):
+        response['ETag'] = self.get_etag(request)
+        return response
+
+    def handle_exception(self, exc):
+        if isinstance(exc, NotModified):
+            return self._set_validators(self.request, Response(status=status.HTTP_304_NOT_MODIFIED))
+        return super(CourseConditionalMixin, self).handle_exception(exc)
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(CourseConditionalMixin, self).finalize_response(request, response, *args, **kwargs)
+        if self.course_version is not None and response.status_code == status.HTTP_200_OK:
+            if self.stale_body:
+                response['Cache-Control'] = 'no-cache'
+            else:
+                response = self._set_validators(request, response)
+        return response
+
+
+class Conflict(exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = '同じIdempotency-Keyのリクエストを処理中です．'
+
+
+class UnprocessableEntity(exceptions.APIException):
+    status_code = status.HTTP_422_UNPROCESSABLE_ENTITY
+    default_detail = '同じIdempotency-Keyが異なるリクエストに使われています．'
+
+
+class IdempotentReplay(exceptions.APIException):
+    """保存したレスポンスを返すための例外"""
+
+    def __init__(self, response: 'Response'):
+        super(IdempotentReplay, self).__init__()
+        self.response = response
+
+
+class IdempotencyMixin(object):
+    """
+    Idempotency-Keyヘッダを付けて再送されたリクエストに，最初のリクエストのレスポンスをそのまま返すMixin．
+    最初のリクエストを処理中の場合は409，同じキーで異なるリクエストが送られた場合は422を返す．
+    5xxのレスポンスや例外は保存せず，再送されたリクエストを改めて処理する．
+    """
+
+    idempotent_actions = ('create',)
+    # 再送時にも返すヘッダ
+    idempotent_headers = ('Location',)
+
+    idempotency_record = None
+
+    def initial(self, request, *args, **kwargs):
+        super(IdempotencyMixin, self).initial(request, *args, **kwargs)
+        self.idempotency_record = None
+        key = request.META.get('HTTP_IDEMPOTENCY_KEY', None)
+        if key is None or self.action not in self.idempotent_actions or not request.user.is_authenticated:
+            return
+        if not key or len(key) > 255:
+            raise exceptions.ValidationError({'Idempotency-Key': '1文字以上255文字以下で指定してください．'})
+        fingerprint = make_fingerprint(request.method, request.get_full_path(), request.body)
+        record, created = begin_request(request.user, key, fingerprint)
+        if created:
+            self.idempotency_record = record
+            return
+        if record.fingerprint != fingerprint:
+            raise UnprocessableEntity()
+        stored = load_response(record)
+        if stored is None:
+            raise Conflict()
+        status_code, data, headers = stored
+        response = Response(json.loads(data), status=status_code, headers=headers)
+        response['Idempotent-Replayed'] = 'true'
+        raise IdempotentReplay(response)
+
+    def _discard_idempotency_record(self):
+        if self.idempotency_record is not None:
+            discard_request(self.idempotency_record)
+            self.idempotency_record = None
+
+    def handle_exception(self, exc):
+        if isinstance(exc, IdempotentReplay):
+            return exc.response
+        try:
+            return super(IdempotencyMixin, self).handle_exception(exc)
+        except Exception:
+            self._discard_idempotency_record()
+            raise
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        response = super(IdempotencyMixin, self).finalize_response(request, response, *args, **kwargs)
+        if self.idempotency_record is None:
+            return response
+        if response.status_code >= 500 or not hasattr(response, 'data'):
+            self._discard_idempotency_record()
+            return response
+        headers = {name: response[name] for name in self.idempotent_headers if response.has_header(name)}
+        complete_request(self.idempotency_record, response.status_code, json.dumps(response.data, cls=JSONEncoder),
+                         headers)
+        self.idempotency_record = None
+        return response
+
+
+class CourseFrozen(exceptions.APIException):
+    status_code = status.HTTP_409_CONFLICT
+    default_detail = '課程は凍結されているため変更できません．'
+
+
+class FrozenPayloadResponse(exceptions.APIException):
+    """凍結時に生成したレスポンスを返すための例外"""
+
+    def __init__(self, response: 'Response'):
+        super(FrozenPayloadResponse, self).__init__()
+        self.response = response
+
+
+class FrozenCourseMixin(object):
+    """
+    凍結された課程への変更を409で拒否し，読み出しには凍結時に生成したレスポンスを返すMixin．
+    凍結時に閲覧できたユーザには，権限の確認や課程の読み込みを行わずに応答する．
+    それ以外のユーザやクエリパラメータを伴う読み出しは通常通り処理する
+    """
+
+    frozen_write_actions = ('create', 'update', 'partial_update', 'destroy')
+
+    def get_frozen_course_pk(self) -> 'Optional[int]':
+        course_pk = self.kwargs.get('course_pk', None)
+        if course_pk is None or not str(course_pk).isdigit():
+            return None
+        return int(course_pk)
+
+    def get_frozen_payload_key(self) -> 'Optional[Tuple[str, str]]':
+        """
+        凍結時に生成したレスポンスを返すアクションであれば，(レスポンスのキー, 閲覧できるユーザのキー)を返す
+        """
+        return None
+
+    def make_frozen_response(self, request, frozen: dict, payload) -> 'Response':
+        return Response(payload)
+
+    def initial(self, request, *args, **kwargs):
+        course_pk = self.get_frozen_course_pk()
+        frozen = get_frozen(course_pk) if course_pk is not None else None
+        if frozen is not None:
+            if self.action in self.frozen_write_actions:
+                self.perform_authentication(request)
+                raise CourseFrozen()
+            keys = self.get_frozen_payload_key()
+            if keys is not None:
+                self.perform_authentication(request)
+                user = request.user
+                if user and user.is_authenticated and (user.is_staff or user.pk in frozen[keys[1]]):
+                    payload = get_frozen_payload(frozen, keys[0])
+                    if payload is not None:
+                        raise FrozenPayloadResponse(self.make_frozen_response(request, frozen, payload))
+        super(FrozenCourseMixin, self).initial(request, *args, **kwargs)
+
+    def handle_exception(self, exc):
+        if isinstance(exc, FrozenPayloadResponse):
+            return exc.response
+        return super(FrozenCourseMixin, self).handle_exception(exc)
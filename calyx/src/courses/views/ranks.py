@@ -1,22 +1,55 @@
+import io
+from typing import TYPE_CHECKING
+
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.http import StreamingHttpResponse
+from drf_yasg import openapi
 from drf_yasg.utils import swagger_auto_schema
-from rest_framework import viewsets, mixins, status, decorators
+from rest_framework import viewsets, mixins, status, decorators, exceptions, parsers
 from rest_framework.response import Response
 
-from courses.models import Rank, Lab
+from courses.errors import RankVersionConflictError
+from courses.models import Rank, Lab, RankSetVersion
 from courses.permissions import (
-    IsCourseMember, IsAdmin, GPARequirement, ScreenNameRequirement, RankSubmitted
+    IsCourseMember, IsCourseAdmin, IsAdmin, GPARequirement, ScreenNameRequirement, RankSubmitted
 )
 from courses.serializers import (
-    LabSerializer, LabAbstractSerializer, RankSerializer, RankSummaryPerLabSerializer
+    LabSerializer, LabAbstractSerializer, RankSerializer, RankSummaryPerLabSerializer, RankChangeSerializer
+)
+from courses.services.freeze import PAYLOAD_SUMMARY
+from courses.services import (
+    get_summary, update_summary_for_user, stream_summary, bump_course_version, import_ranks,
+    append_rank_change, get_rank_changes, get_assignment, get_config_cache, get_probabilities,
+    update_assignment_for_user, advise_ranks, load_user_labs, is_summary_stale
 )
-from courses.services import get_summary, update_summary_cache
-from .mixins import NestedViewSetMixin, CourseNestedMixin
+from courses.services.assignment import MECHANISMS, MECHANISM_SERIAL_DICTATORSHIP
+from .mixins import (
+    NestedViewSetMixin, CourseNestedMixin, CourseConditionalMixin, IdempotencyMixin, PeriodMixin, FrozenCourseMixin
+)
+
+if TYPE_CHECKING:
+    from typing import Optional
 
 User = get_user_model()
 
+# 志望順位の組のバージョンを受け渡すヘッダ
+RANK_SET_VERSION_HEADER = 'X-Rank-Set-Version'
+# 志望順位の組の助言で返す最大の組の数
+ADVISE_MAX_LISTS = 20
+
+
+class PreconditionRequired(exceptions.APIException):
+    status_code = 428
+    default_detail = f'{RANK_SET_VERSION_HEADER}ヘッダで志望順位のバージョンを指定してください．'
+
 
-class RankViewSet(NestedViewSetMixin,
+class RankViewSet(IdempotencyMixin,
+                  CourseConditionalMixin,
+                  FrozenCourseMixin,
+                  PeriodMixin,
+                  NestedViewSetMixin,
                   CourseNestedMixin,
                   mixins.ListModelMixin,
                   mixins.CreateModelMixin,
@@ -32,14 +65,24 @@ class RankViewSet(NestedViewSetMixin,
     queryset = Rank.objects.select_related('course', 'lab')
     permission_classes = [IsCourseMember | IsAdmin]
     serializer_class = RankSerializer
+    conditional_actions = ('list', 'summary')
+    idempotent_headers = ('Location', RANK_SET_VERSION_HEADER)
+    frozen_write_actions = ('create', 'import_csv')
 
     def get_permissions(self):
-        if self.action == 'summary':
+        if self.action in ('summary', 'summary_stream', 'assignment', 'probability', 'advise'):
             self.permission_classes = [
                 (IsCourseMember & GPARequirement & RankSubmitted & ScreenNameRequirement) | IsAdmin
             ]
+        elif self.action == 'import_csv' or self.action == 'changes':
+            self.permission_classes = [(IsCourseMember & IsCourseAdmin) | IsAdmin]
         return super(RankViewSet, self).get_permissions()
 
+    def get_frozen_payload_key(self):
+        if self.action == 'summary':
+            return PAYLOAD_SUMMARY, 'rank_readers'
+        return None
+
     def get_serializer_class(self):
         if self.action == 'create':
             return RankSerializer
@@ -70,7 +113,20 @@ class RankViewSet(NestedViewSetMixin,
         lab_submitted = Lab.objects.filter(course_id=course.pk).prefetch_related('rank_set') \
             .filter(rank__user=request.user).order_by('rank__order').all()
         serializer = LabAbstractSerializer(lab_submitted, many=True)
-        return Response(serializer.data)
+        version = RankSetVersion.objects.get_version(course, request.user)
+        return Response(serializer.data, headers={RANK_SET_VERSION_HEADER: str(version)})
+
+    def get_expected_version(self, request) -> 'Optional[int]':
+        """クライアントが取得した志望順位のバージョンをヘッダから読み込む"""
+        value = request.META.get('HTTP_' + RANK_SET_VERSION_HEADER.upper().replace('-', '_'), None)
+        if value is None:
+            if getattr(settings, 'RANK_SET_VERSION_REQUIRED', False):
+                raise PreconditionRequired()
+            return None
+        try:
+            return int(value)
+        except ValueError:
+            raise exceptions.ValidationError({RANK_SET_VERSION_HEADER: 'バージョンは整数で指定してください．'})
 
     @swagger_auto_schema(
         request_body=RankSerializer(many=True)
@@ -79,9 +135,25 @@ class RankViewSet(NestedViewSetMixin,
         course = self.get_course()
         serializer = self.get_serializer(data=request.data, many=True)
         serializer.is_valid(raise_exception=True)
-        serializer.save()
-        update_summary_cache(course)
+        expected = self.get_expected_version(request)
+        try:
+            with transaction.atomic():
+                # 先にバージョンを上げ，同じユーザの同時の提出は待たずに競合として返す
+                version = RankSetVersion.objects.bump(course, request.user, expected)
+                previous = (request.user.gpa, load_user_labs(course.pk, request.user.pk))
+                ranks = serializer.save()
+                # 保存されたサマリーも志望順位と同じトランザクションで更新する
+                update_summary_for_user(course, request.user, [rank.lab_id for rank in ranks], previous)
+        except RankVersionConflictError as e:
+            return Response({'detail': str(e)}, status=status.HTTP_409_CONFLICT,
+                            headers={RANK_SET_VERSION_HEADER: str(e.version)})
+        # 変更履歴はコミットした後にキューに加え，他の提出とまとめて追記する
+        append_rank_change(course.pk, request.user.pk, [rank.lab_id for rank in ranks], actor_pk=request.user.pk)
+        # まとめて書き込むためシグナルは飛ばない
+        bump_course_version(course.pk)
+        update_assignment_for_user(course, request.user, [rank.lab_id for rank in ranks])
         headers = self.get_success_headers(serializer.data)
+        headers[RANK_SET_VERSION_HEADER] = str(version)
         return Response(serializer.data, status=status.HTTP_201_CREATED, headers=headers)
 
     @swagger_auto_schema(responses={
@@ -91,6 +163,185 @@ class RankViewSet(NestedViewSetMixin,
     })
     @decorators.action(['GET'], detail=False, url_path='summary')
     def summary(self, request, *args, **kwargs):
-        """希望調査のサマリーを取得する"""
+        """
+        希望調査のサマリーを取得する．
+        再集計の間隔内で古いサマリーを返す場合は，課程のバージョンから作ったETagを付けない
+        """
+        course = self.get_course()
+        summary = get_summary(course)
+        self.stale_body = is_summary_stale(course.pk, fresh=True)
+        return Response(summary)
+
+    @swagger_auto_schema(responses={
+        200: "text/event-stream．最初に'summary'イベントでサマリー全体を，以降は'diff'イベントで変更された研究室を送る",
+        403: "閲覧資格を満たしていません",
+        404: "存在しない課程です"
+    })
+    @decorators.action(['GET'], detail=False, url_path='summary/stream')
+    def summary_stream(self, request, *args, **kwargs):
+        """
+        希望調査のサマリーの更新をServer-Sent Eventsで配信する．
+        サーバの設定によっては1度送った後に切断するため，クライアントはretryの間隔で再接続すること
+        """
+        course = self.get_course()
+        last_event_id = request.META.get('HTTP_LAST_EVENT_ID', None)
+        response = StreamingHttpResponse(stream_summary(course, last_event_id), content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # nginxによるバッファリングを無効にする
+        response['X-Accel-Buffering'] = 'no'
+        return response
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('mechanism', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description="配属の方式．'serial_dictatorship'（既定），'deferred_acceptance'，"
+                                          "または志望の満足度を最大化する'welfare'"),
+        ],
+        responses={
+            200: "研究室ごとの予測される配属人数とボーダー（cutoff），自分の予測される配属先（lab）",
+            403: "閲覧資格を満たしていません",
+            404: "存在しない課程です"
+        }
+    )
+    @decorators.action(['GET'], detail=False, url_path='assignment')
+    def assignment(self, request, *args, **kwargs):
+        """
+        現在の志望順位とGPAから予測される配属を取得する．ボーダーはGPAを表示する課程のみ返す．
+        課程の管理者には全てのユーザの配属先（users）も返す
+        """
+        course = self.get_course()
+        mechanism = request.query_params.get('mechanism', MECHANISM_SERIAL_DICTATORSHIP)
+        if mechanism not in MECHANISMS:
+            raise exceptions.ValidationError({'mechanism': f'{", ".join(MECHANISMS)}のいずれかを指定してください．'})
+        assignment = get_assignment(course, mechanism)
+        show_gpa = get_config_cache(course.pk)['show_gpa']
+        data = {
+            'mechanism': mechanism,
+            'labs': [dict(lab, cutoff=lab['cutoff'] if show_gpa else None) for lab in assignment['labs']],
+            'lab': assignment['users'].get(request.user.pk, None),
+        }
+        if request.user.is_staff or IsCourseAdmin().has_object_permission(request, self, course):
+            data['users'] = [{'user': user_pk, 'lab': lab_pk} for user_pk, lab_pk in assignment['users'].items()]
+        return Response(data)
+
+    @swagger_auto_schema(responses={
+        200: "研究室ごとの自分の配属確率（labs）．staleがtrueの場合は古い志望順位から推定した値で，再計算中",
+        202: "配属確率がまだ推定されていません",
+        403: "閲覧資格を満たしていません",
+        404: "存在しない課程です"
+    })
+    @decorators.action(['GET'], detail=False, url_path='probability')
+    def probability(self, request, *args, **kwargs):
+        """
+        他のユーザのGPAや未提出の志望順位を観測された分布から抽出して推定した，研究室ごとの自分の配属確率を取得する．
+        推定はestimate_probabilitiesコマンドで定期的に行い，このリクエストでは保存された結果のみを返す
+        """
+        course = self.get_course()
+        table = get_probabilities(course)
+        if table is None:
+            return Response({'detail': '配属確率はまだ推定されていません．'}, status=status.HTTP_202_ACCEPTED)
+        probabilities = table['users'].get(request.user.pk, {})
+        return Response({
+            'version': table['version'],
+            'stale': table['stale'],
+            'trials': table['trials'],
+            'labs': [{'pk': lab_pk, 'probability': value} for lab_pk, value in probabilities.items()],
+        })
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('labs', openapi.IN_QUERY, type=openapi.TYPE_STRING,
+                              description='希望する順にカンマで区切った候補の研究室のpk．'
+                                          '省略した場合は提出済みの志望順位の後に残りの研究室を並べる'),
+            openapi.Parameter('limit', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='返す組の数（既定は5，最大は20）'),
+        ],
+        responses={
+            200: "配属される確率（probability）の高い順に並べた志望順位の組（lists）．"
+                 "各組は志望順位の提出数まで残りの研究室で埋め，埋めた数をpaddedとする",
+            400: "候補の研究室の指定に誤りがあります",
+            403: "閲覧資格を満たしていません",
+            404: "存在しない課程です"
+        }
+    )
+    @decorators.action(['GET'], detail=False, url_path='advise')
+    def advise(self, request, *args, **kwargs):
+        """
+        候補の研究室から作れる志望順位の組のうち，自分が配属される確率の高いものを返す．
+        志望順位は提出されず，他のユーザの配属も変わらない
+        """
+        course = self.get_course()
+        lab_pks = None
+        labs = request.query_params.get('labs', None)
+        if labs is not None:
+            values = [value.strip() for value in labs.split(',') if value.strip()]
+            if not values or not all(value.isdigit() for value in values):
+                raise exceptions.ValidationError({'labs': '研究室のpkをカンマで区切って指定してください．'})
+            lab_pks = [int(value) for value in values]
+            if Lab.objects.filter(course_id=course.pk, pk__in=lab_pks).count() != len(set(lab_pks)):
+                raise exceptions.ValidationError({'labs': 'この課程に存在しない研究室が含まれています．'})
+        limit = request.query_params.get('limit', '5')
+        if not limit.isdigit() or not 1 <= int(limit) <= ADVISE_MAX_LISTS:
+            raise exceptions.ValidationError({'limit': f'1から{ADVISE_MAX_LISTS}の整数で指定してください．'})
+        return Response(advise_ranks(course, request.user, lab_pks, int(limit)))
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('file', openapi.IN_FORM, type=openapi.TYPE_FILE, required=True,
+                              description='1行につき「ユーザ名,志望順位,研究室名」のCSV（UTF-8）．志望順位は1から始まる'),
+            openapi.Parameter('dry_run', openapi.IN_QUERY, type=openapi.TYPE_BOOLEAN, description='検証のみを行う'),
+        ],
+        responses={
+            200: "登録した志望順位の数，ユーザの数",
+            400: "CSVに誤りがあります．何も登録されません",
+            403: "課程の管理者ではありません",
+            404: "存在しない課程です"
+        }
+    )
+    @decorators.action(['POST'], detail=False, url_path='import', parser_classes=[parsers.MultiPartParser])
+    def import_csv(self, request, *args, **kwargs):
+        """CSVから複数のユーザの志望順位を一括で登録する"""
+        course = self.get_course()
+        upload = request.FILES.get('file', None)
+        if upload is None:
+            raise exceptions.ValidationError({'file': 'CSVファイルを指定してください．'})
+        dry_run = request.query_params.get('dry_run', 'false').lower() == 'true'
+        # アップロードされたファイルは1行ずつ読み込む
+        lines = io.TextIOWrapper(upload.file, encoding='utf-8-sig', newline='')
+        try:
+            result = import_ranks(course, lines, dry_run=dry_run, actor_pk=request.user.pk)
+        except UnicodeDecodeError:
+            raise exceptions.ValidationError({'file': 'CSVファイルはUTF-8で指定してください．'})
+        status_code = status.HTTP_400_BAD_REQUEST if result.errors else status.HTTP_200_OK
+        return Response(result._asdict(), status=status_code)
+
+    @swagger_auto_schema(
+        manual_parameters=[
+            openapi.Parameter('user', openapi.IN_QUERY, type=openapi.TYPE_INTEGER, description='ユーザのpk'),
+            openapi.Parameter('since', openapi.IN_QUERY, description='期間の開始（ISO 8601）', type=openapi.TYPE_STRING),
+            openapi.Parameter('until', openapi.IN_QUERY, description='期間の終了（ISO 8601）', type=openapi.TYPE_STRING),
+            openapi.Parameter('before', openapi.IN_QUERY, type=openapi.TYPE_INTEGER,
+                              description='次のページ．前のレスポンスのnextを指定する'),
+        ],
+        responses={
+            200: RankChangeSerializer(many=True),
+            403: "課程の管理者ではありません",
+            404: "存在しない課程です"
+        }
+    )
+    @decorators.action(['GET'], detail=False, url_path='changes')
+    def changes(self, request, *args, **kwargs):
+        """志望順位の変更履歴を新しい順に取得する"""
         course = self.get_course()
-        return Response(get_summary(course))
+        params = dict()
+        for key in ('user', 'before'):
+            value = request.query_params.get(key, None)
+            if value is None:
+                continue
+            if not value.isdigit():
+                raise exceptions.ValidationError({key: '整数で指定してください．'})
+            params[key] = int(value)
+        changes, next_before = get_rank_changes(
+            course, user_pk=params.get('user', None), before=params.get('before', None), **self.get_period(request)
+        )
+        return Response({'results': RankChangeSerializer(changes, many=True).data, 'next': next_before})